@@ -1,6 +1,6 @@
 """The CIDC cloud functions."""
 
-from .uploads import ingest_upload
+from .uploads import ingest_upload, remove_expired_gcs_bindings
 from .emails import send_email
 from .upload_postprocessing import (
     derive_files_from_manifest_upload,
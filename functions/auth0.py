@@ -4,7 +4,7 @@ import requests
 from datetime import datetime
 from typing import List, Optional
 
-from google.cloud import storage, logging
+from google.cloud import logging
 
 from .settings import (
     AUTH0_CLIENT_ID,
@@ -12,6 +12,7 @@ from .settings import (
     AUTH0_DOMAIN,
     GOOGLE_LOGS_BUCKET,
 )
+from .util import get_storage_client
 
 MANAGEMENT_API = f"{AUTH0_DOMAIN}/api/v2/"
 # Auth0's free tier expects no more than 2 requests/second.
@@ -81,7 +82,7 @@ __log_bucket = None
 def _get_log_bucket():
     global __log_bucket
     if __log_bucket is None:
-        client = storage.Client()
+        client = get_storage_client()
         __log_bucket = client.bucket(GOOGLE_LOGS_BUCKET)
     return __log_bucket
 
@@ -5,7 +5,12 @@ from typing import Any, Dict, Iterator
 from urllib.parse import quote as url_escape
 
 from .settings import ENV, INTERNAL_USER_EMAIL
-from .util import BackgroundContext, extract_pubsub_data, sqlalchemy_session
+from .util import (
+    BackgroundContext,
+    decode_pubsub_message,
+    extract_pubsub_data,
+    sqlalchemy_session,
+)
 
 from cidc_api.csms import get_with_paging
 from cidc_api.models.csms_api import (
@@ -29,10 +34,11 @@ def update_cidc_from_csms(event: dict, context: BackgroundContext):
     If it's a new manifest ie throws NewManifestError, put it through new manifest insert functions
     Send a singular email at the end with a description of the results of each new/changed manifest
 
-    `event` data is base64-encoded str(dict) in the form {"trial_id": "<trial>", "manifest_id": "<manifest>"}
+    `event` data is a base64-encoded pub/sub message (see util.decode_pubsub_message)
+        with data in the form {"trial_id": "<trial>", "manifest_id": "<manifest>"}
         values for "trial_id" and "manifest_id" are used to see whether a manifest should be processed
         special value "*" matches all
-        fallback case if dict(data) raises error is dry run of all manifests
+        fallback case if decoding the data raises an error is dry run of all manifests
     NOTE This matching should be reconsidered once all CIDC / CSMS data is aligned and we're out of testing
     """
     dry_run: bool = True
@@ -42,7 +48,9 @@ def update_cidc_from_csms(event: dict, context: BackgroundContext):
         # this returns the str, then convert it to a dict
         # uses event["data"] and then assumes format, so will error if no/malformatted data
         data: str = extract_pubsub_data(event)
-        data: dict = dict(eval(data))
+        data: dict = decode_pubsub_message(
+            data, schema={"trial_id": (str,), "manifest_id": (str,)}
+        )
     except Exception as e:
         # if anything errors, don't actually do any inserting
         # just dry-run all of the manifest changes
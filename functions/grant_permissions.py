@@ -1,10 +1,26 @@
 from datetime import datetime
+import json
 import logging
 import sys
 from typing import Dict, List, Optional, Tuple, Union
 
-from .settings import ENV, GOOGLE_WORKER_TOPIC
-from .util import BackgroundContext, extract_pubsub_data, sqlalchemy_session
+from .settings import (
+    ENV,
+    GOOGLE_WORKER_TOPIC,
+    PERMISSIONS_WORKER_MAX_BLOBS_PER_CHUNK,
+    PERMISSIONS_WORKER_MAX_MESSAGE_BYTES,
+    PERMISSIONS_WORKER_MIN_BLOBS_PER_CHUNK,
+    PERMISSIONS_WORKER_SECONDS_PER_GRANT,
+    PERMISSIONS_WORKER_TARGET_SECONDS,
+)
+from .util import (
+    BackgroundContext,
+    BatchPublisher,
+    decode_pubsub_message,
+    encode_pubsub_message,
+    extract_pubsub_data,
+    sqlalchemy_session,
+)
 
 from cidc_api.models import Permissions
 from cidc_api.shared.gcloud_client import (
@@ -22,7 +38,19 @@ logger.addHandler(logging.StreamHandler(sys.stdout))
 logger.setLevel(logging.DEBUG if ENV == "dev" else logging.INFO)
 
 
-BLOBS_PER_CHUNK: int = 100  # how many files to bundle together for permissions handling
+# allowed types for the fields of grant_download_permissions / permissions_worker messages;
+# legacy str(dict) messages may hold tuples where JSON messages hold lists
+GRANT_DOWNLOAD_PERMISSIONS_SCHEMA = {
+    "trial_id": (str, type(None)),
+    "upload_type": (str, list, tuple, type(None)),
+    "user_email_list": (list, tuple, type(None)),
+    "revoke": (bool,),
+}
+PERMISSIONS_WORKER_SCHEMA = {
+    "user_email_list": (list,),
+    "blob_name_list": (list,),
+    "revoke": (bool,),
+}
 
 
 def grant_download_permissions(event: dict, context: BackgroundContext):
@@ -34,7 +62,7 @@ def grant_download_permissions(event: dict, context: BackgroundContext):
     trial_id: Optional[str]
         the trial_id for the trial to affect
         explicitly pass None for cross-trial
-    upload_type: Optional[Union[str, List[str]]]
+    upload_type: Optional[Union[str, List[str], Tuple[str]]]
         the upload_type, as stored in the Permissions table
         explicitly pass None for cross-assay (excludes clinical_data)
 
@@ -50,7 +78,9 @@ def grant_download_permissions(event: dict, context: BackgroundContext):
         # this returns the str, then convert it to a dict
         # uses event["data"] and then assumes format, so will error if no/malformatted data
         raw_data: str = extract_pubsub_data(event)
-        data: dict = dict(eval(raw_data))
+        data: dict = decode_pubsub_message(
+            raw_data, schema=GRANT_DOWNLOAD_PERMISSIONS_SCHEMA
+        )
     except:
         raise
 
@@ -68,7 +98,9 @@ def grant_download_permissions(event: dict, context: BackgroundContext):
         trial_id: Optional[str] = data.get("trial_id")
 
         upload_type: Optional[Tuple[str]] = None
-        raw_upload_type: Optional[Union[str, List[str]]] = data.get("upload_type")
+        raw_upload_type: Optional[Union[str, List[str], Tuple[str]]] = data.get(
+            "upload_type"
+        )
         if raw_upload_type:
             if isinstance(raw_upload_type, str):
                 upload_type = (raw_upload_type,)
@@ -108,6 +140,9 @@ def grant_download_permissions(event: dict, context: BackgroundContext):
                     for trial, upload_dict in user_email_dict.items()
                 }
 
+                # Publish worker messages without waiting on each one in turn
+                publisher = BatchPublisher(_encode_and_publish, GOOGLE_WORKER_TOPIC)
+
                 upload_dict: Dict[Optional[Tuple[str]], List[str]]
                 for trial_id, upload_dict in blob_name_dict.items():
                     upload: Optional[Tuple[str]]
@@ -120,12 +155,7 @@ def grant_download_permissions(event: dict, context: BackgroundContext):
                         if not user_email_list or not blob_name_list:
                             continue
 
-                        blob_name_list_chunks = [
-                            blob_name_list[i : i + BLOBS_PER_CHUNK]
-                            for i in range(0, len(blob_name_list), BLOBS_PER_CHUNK)
-                        ]
-
-                        for chunk in blob_name_list_chunks:
+                        for chunk in _chunk_blob_names(user_email_list, blob_name_list):
                             kwargs = {
                                 "_fn": "permissions_worker",
                                 "user_email_list": user_email_list,
@@ -133,12 +163,15 @@ def grant_download_permissions(event: dict, context: BackgroundContext):
                                 "revoke": revoke,
                             }
 
-                            report = _encode_and_publish(
-                                str(kwargs), GOOGLE_WORKER_TOPIC
-                            )
-                            # Wait for response from pub/sub
-                            if report:
-                                report.result()
+                            publisher.publish(encode_pubsub_message(kwargs))
+
+                # Wait for responses from pub/sub
+                failures = publisher.wait()
+                if failures:
+                    raise Exception(
+                        f"Failed to publish {len(failures)} of {publisher.published} permissions_worker messages: "
+                        + ", ".join(sorted(set(repr(e) for _, e in failures)))
+                    )
 
             except Exception as e:
                 logger.error(f"Error: {e}", exc_info=True)
@@ -150,6 +183,51 @@ def grant_download_permissions(event: dict, context: BackgroundContext):
                 raise e
 
 
+def _get_blobs_per_chunk(user_email_list: List[str], blob_name_list: List[str]) -> int:
+    """
+    Choose how many blobs to send to each permissions_worker, so that each worker's
+    estimated IAM work takes about PERMISSIONS_WORKER_TARGET_SECONDS and each message
+    stays under PERMISSIONS_WORKER_MAX_MESSAGE_BYTES. See settings for the cost model.
+    """
+    num_users = max(len(user_email_list), 1)
+    by_runtime = int(
+        PERMISSIONS_WORKER_TARGET_SECONDS
+        / (PERMISSIONS_WORKER_SECONDS_PER_GRANT * num_users)
+    )
+    by_runtime = min(
+        max(by_runtime, PERMISSIONS_WORKER_MIN_BLOBS_PER_CHUNK),
+        PERMISSIONS_WORKER_MAX_BLOBS_PER_CHUNK,
+    )
+
+    # everything but the blob names, plus some slack for the message envelope
+    fixed_bytes = len(json.dumps(user_email_list)) + 200
+    # each blob name is quoted and comma-separated in the message
+    blob_bytes = max((len(json.dumps(name)) + 2 for name in blob_name_list), default=1)
+    by_size = max(
+        int((PERMISSIONS_WORKER_MAX_MESSAGE_BYTES - fixed_bytes) / blob_bytes), 1
+    )
+
+    blobs_per_chunk = min(by_runtime, by_size)
+    logger.info(
+        f"Sending {len(blob_name_list)} blobs for {num_users} users to permissions_worker "
+        f"in chunks of {blobs_per_chunk} blobs (limited by "
+        f"{'message size' if by_size < by_runtime else 'worker runtime'}), "
+        f"estimated {blobs_per_chunk * num_users * PERMISSIONS_WORKER_SECONDS_PER_GRANT:.1f}s per chunk"
+    )
+    return blobs_per_chunk
+
+
+def _chunk_blob_names(
+    user_email_list: List[str], blob_name_list: List[str]
+) -> List[List[str]]:
+    """Split `blob_name_list` into chunks sized by `_get_blobs_per_chunk`."""
+    blobs_per_chunk = _get_blobs_per_chunk(user_email_list, blob_name_list)
+    return [
+        blob_name_list[i : i + blobs_per_chunk]
+        for i in range(0, len(blob_name_list), blobs_per_chunk)
+    ]
+
+
 def permissions_worker(
     user_email_list: List[str] = [],
     blob_name_list: List[str] = [],
@@ -23,19 +23,103 @@ ENV = os.environ.get("ENV")
 secrets = get_secrets_manager(TESTING)
 
 # GCP config
+# the memory allotted to this function's instances, which the python37 runtime provides
+FUNCTION_MEMORY_BYTES = int(os.environ.get("FUNCTION_MEMORY_MB", 1024)) * 1024 * 1024
 SQLALCHEMY_DATABASE_URI = get_sqlalchemy_database_uri(TESTING)
 GOOGLE_UPLOAD_BUCKET = os.environ.get("GOOGLE_UPLOAD_BUCKET")
 GOOGLE_ACL_DATA_BUCKET = os.environ.get("GOOGLE_ACL_DATA_BUCKET")
 GOOGLE_LOGS_BUCKET = os.environ.get("GOOGLE_LOGS_BUCKET")
 GOOGLE_ANALYSIS_GROUP_ROLE = f"projects/{GCP_PROJECT}/roles/CIDC_biofx"
 GOOGLE_ANALYSIS_PERMISSIONS_GRANT_FOR_DAYS = 60
+# ingest_upload copies objects with up to GCS_COPY_MAX_THREADS concurrent rewrites, fewer for
+# large objects so that no more than GCS_COPY_MAX_BYTES_IN_FLIGHT are being copied at once. That
+# scales with the instance (16 GiB for ingest_upload's 2 GiB), so only a few multi-GB objects copy
+# at a time, each getting far enough between saves of its progress.
+GCS_COPY_MAX_THREADS = 32
+GCS_COPY_MAX_BYTES_IN_FLIGHT = 8 * FUNCTION_MEMORY_BYTES
+# ingest_upload lists the upload and data buckets to look up an upload's objects, reading at most
+# this many objects (under the objects' common prefix) per object it's looking for, and looking up
+# the objects one at a time if that doesn't cover the whole prefix
+GCS_LIST_MAX_RESULTS_PER_OBJECT = 10
+# ingest_upload saves its copy progress (rewrite tokens, finished copies) in the upload bucket under
+# this prefix at most this often, so re-ingesting a job whose copies failed resumes unfinished copies.
+# A failed job's progress is kept for this many ingestion attempts in all, then deleted.
+INGEST_COPY_PROGRESS_PREFIX = "_ingest_progress/"
+INGEST_COPY_PROGRESS_SAVE_INTERVAL_SECONDS = 30
+INGEST_COPY_MAX_ATTEMPTS = 3
+# ingest_upload merges each batch of this many copied artifacts into the upload's metadata while
+# the rest are still copying, and publishes its messages while granting download permissions.
+# If not pipelined, each stage waits for the previous one to finish.
+INGEST_UPLOAD_PIPELINED = True
+INGEST_MERGE_BATCH_SIZE = 100
+# bucket IAM policy updates are retried this many times when a concurrent write changes the policy's etag
+GOOGLE_IAM_POLICY_MAX_ATTEMPTS = 5
+# how long a warm function instance may reuse a bucket handle before refetching it
+GOOGLE_BUCKET_CACHE_TTL_SECONDS = 60 * 60
+# streamed blob downloads are fetched in ranged reads of this size (a multiple of 256 KB),
+# and blobs larger than BLOB_SPOOL_MAX_MEMORY_BYTES are streamed to a temp file instead of memory
+BLOB_DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+BLOB_SPOOL_MAX_MEMORY_BYTES = 32 * 1024 * 1024
 GOOGLE_ASSAY_OR_ANALYSIS_UPLOAD_TOPIC = os.environ.get(
     "GOOGLE_ASSAY_OR_ANALYSIS_UPLOAD_TOPIC"
 )
 GOOGLE_WORKER_TOPIC = os.environ.get("GOOGLE_WORKER_TOPIC")
+GOOGLE_ARTIFACT_UPLOAD_TOPIC = os.environ.get("GOOGLE_ARTIFACT_UPLOAD_TOPIC")
 GOOGLE_GRANT_DOWNLOAD_PERMISSIONS_TOPIC = os.environ.get(
     "GOOGLE_GRANT_DOWNLOAD_PERMISSIONS_TOPIC"
 )
+# pub/sub messages built with util.encode_pubsub_message are compressed above this size
+PUBSUB_COMPRESSION_THRESHOLD_BYTES = 32 * 1024
+# how many messages util.BatchPublisher leaves awaiting confirmation at once
+PUBSUB_MAX_IN_FLIGHT_MESSAGES = 100
+# util.BatchPublisher tries messages that fail with transient errors this many times in all, backing off
+# about PUBSUB_PUBLISH_RETRY_DELAY_SECONDS * 2^n (jittered) before each retry, and counts messages that
+# aren't confirmed, or can't be sent for want of a free slot, within PUBSUB_PUBLISH_TIMEOUT_SECONDS of
+# waiting as failures
+PUBSUB_PUBLISH_MAX_ATTEMPTS = 3
+PUBSUB_PUBLISH_RETRY_DELAY_SECONDS = 1
+PUBSUB_PUBLISH_TIMEOUT_SECONDS = 60
+
+# Cost model for sizing the chunks of blobs sent to each permissions_worker.
+# Each worker's IAM work is estimated as (# users) x (# blobs) x SECONDS_PER_GRANT,
+# and chunks are sized to finish in about TARGET_SECONDS, within the MIN/MAX blob bounds.
+# Regardless, a chunk's message is kept under MAX_MESSAGE_BYTES (pub/sub's limit is 10 MB).
+PERMISSIONS_WORKER_TARGET_SECONDS = 120
+PERMISSIONS_WORKER_SECONDS_PER_GRANT = 0.1
+PERMISSIONS_WORKER_MIN_BLOBS_PER_CHUNK = 1
+PERMISSIONS_WORKER_MAX_BLOBS_PER_CHUNK = 1000
+PERMISSIONS_WORKER_MAX_MESSAGE_BYTES = 1024 * 1024
+
+# vis_preprocessing caches the metadata dataframes it builds from each trial's participants.csv
+# and samples.csv, evicting the least recently used past either limit
+METADATA_DF_CACHE_MAX_ENTRIES = 32
+METADATA_DF_CACHE_MAX_BYTES = 128 * 1024 * 1024
+# manifest postprocessing stores each trial's merged metadata dataframe as Parquet in the upload
+# bucket (which users can't read) under this prefix, which vis_preprocessing reads instead of
+# re-merging the CSVs
+METADATA_SNAPSHOT_PREFIX = "_cache/metadata/"
+# how many trials' object URL -> assay instance indexes vis_preprocessing keeps, per metadata version
+ARTIFACT_INDEX_CACHE_MAX_ENTRIES = 16
+# clustergrammer configs are cached in the upload bucket (which users can't read) under this prefix,
+# named for a hash of the data file's checksums, its trial's metadata and the clustergrammer version
+CLUSTERGRAMMER_CACHE_PREFIX = "_cache/clustergrammer/"
+# how many of an upload's files ingest_upload sends to each vis_preprocessing invocation
+VIS_PREPROCESSING_BATCH_SIZE = 50
+# vis_preprocessing clusters data in worker processes limited to this much extra memory (half the
+# function instance's memory, leaving the rest to the function itself) and wall-clock time,
+# skipping the clustergrammer config for files that exceed either and recording them in the
+# upload bucket under VIS_CLUSTERING_SKIPPED_PREFIX
+VIS_CLUSTERING_ISOLATED = True
+VIS_CLUSTERING_TIMEOUT_SECONDS = 5 * 60
+VIS_CLUSTERING_MAX_MEMORY_BYTES = FUNCTION_MEMORY_BYTES // 2
+VIS_CLUSTERING_SKIPPED_PREFIX = "_skipped/clustergrammer/"
+# before clustering, data is reduced to the rows (features) with the highest variance
+# and an evenly spaced subset of columns (samples) past these limits; None disables either
+CLUSTERGRAMMER_MAX_ROWS = 1000
+CLUSTERGRAMMER_MAX_COLUMNS = 1000
+# the shape of the IHC combined plot data stored on file records: "records" (a list of row
+# objects) or "columnar" (column names once, value arrays, dictionary-encoded strings)
+IHC_COMBINED_PLOT_FORMAT = os.environ.get("IHC_COMBINED_PLOT_FORMAT", "records")
 
 
 # Auth0 config
@@ -1,12 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 from .util import (
     BackgroundContext,
     extract_pubsub_data,
     sqlalchemy_session,
-    get_blob_as_stream as fetch_artifact,
+    get_blob_as_stream,
     upload_to_data_bucket,
+    publish_artifact_upload_batches,
 )
+from .visualizations import update_metadata_snapshot
 
 from cidc_api.models import (
     DownloadableFiles,
@@ -16,6 +19,14 @@ from cidc_api.models import (
     UploadJobStatus,
     unprism,
 )
+from cidc_api.shared.gcloud_client import _encode_and_publish
+
+THREADPOOL_THREADS = 16
+
+
+def fetch_artifact(object_name: str, as_string: bool = False):
+    """Stream an artifact needed for file derivation from the CIDC data bucket."""
+    return get_blob_as_stream(object_name, as_string=as_string, streaming=True)
 
 
 def derive_files_from_manifest_upload(event: dict, context: BackgroundContext):
@@ -97,14 +108,34 @@ def _derive_files_from_upload(trial_id: str, upload_type: str, upload_id: str, s
         )
         return
 
-    # TODO: consider parallelizing this step if necessary
-    for artifact in derivation_result.artifacts:
-        # Save to GCS
-        blob = upload_to_data_bucket(
-            object_name=artifact.object_url,
-            data=artifact.data,
+    # Save to GCS in parallel, checking that every upload succeeded before
+    # touching the database
+    artifacts = derivation_result.artifacts
+    with ThreadPoolExecutor(THREADPOOL_THREADS) as executor:
+        upload_futures = [
+            executor.submit(
+                upload_to_data_bucket,
+                object_name=artifact.object_url,
+                data=artifact.data,
+            )
+            for artifact in artifacts
+        ]
+    failures = [
+        (artifact.object_url, future.exception())
+        for artifact, future in zip(artifacts, upload_futures)
+        if future.exception() is not None
+    ]
+    if failures:
+        raise Exception(
+            f"Failed to upload {len(failures)} of {len(artifacts)} derived files for upload {upload_id}: "
+            + ", ".join(f"{url} ({e!r})" for url, e in failures)
         )
 
+    blobs = []
+    for artifact, future in zip(artifacts, upload_futures):
+        blob = future.result()
+        blobs.append(blob)
+
         # Build basic facet group
         facet_group = f"{artifact.data_format}|{artifact.file_type}"
 
@@ -112,7 +143,7 @@ def _derive_files_from_upload(trial_id: str, upload_type: str, upload_id: str, s
         if artifact.file_type in ("participants info", "samples info"):
             file_upload_type = artifact.file_type
 
-        # Save to database
+        # Stage the record in the session; everything is committed together below
         df_record = DownloadableFiles.create_from_blob(
             trial_id=trial_record.trial_id,
             upload_type=file_upload_type,
@@ -120,7 +151,7 @@ def _derive_files_from_upload(trial_id: str, upload_type: str, upload_id: str, s
             facet_group=facet_group,
             blob=blob,
             session=session,
-            alert_artifact_upload=True,
+            commit=False,
         )
         df_record.additional_metadata = artifact.metadata
         # Assume that a derived file will be directly useful for data analysis
@@ -130,3 +161,20 @@ def _derive_files_from_upload(trial_id: str, upload_type: str, upload_id: str, s
     trial_record.metadata_json = derivation_result.trial_metadata
 
     session.commit()
+
+    # Cached metadata dataframes are keyed on the participants/samples CSVs' generations, so
+    # rewriting them needs no invalidation; rewriting both updates the trial's metadata snapshot
+    metadata_csvs = {
+        artifact.file_type: (blob, artifact.data)
+        for artifact, blob in zip(artifacts, blobs)
+        if artifact.file_type in ("participants info", "samples info")
+    }
+    if len(metadata_csvs) == 2:
+        update_metadata_snapshot(
+            trial_id,
+            *metadata_csvs["participants info"],
+            *metadata_csvs["samples info"],
+        )
+
+    # Trigger post-processing on the derived files, now that their records exist
+    publish_artifact_upload_batches(_encode_and_publish, [blob.name for blob in blobs])
@@ -1,11 +1,25 @@
 """A pub/sub triggered functions that respond to data upload events"""
+import json
+import os
+import random
+import re
 import sys
 import logging
+import threading
+import time
 import warnings
-from concurrent.futures import ThreadPoolExecutor
-from contextlib import contextmanager
-from typing import Optional, Tuple, NamedTuple
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager, nullcontext
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    NamedTuple,
+)
+from datetime import date, datetime, timedelta, timezone
 
 from .settings import (
     ENV,
@@ -14,15 +28,33 @@ from .settings import (
     GOOGLE_ANALYSIS_GROUP_ROLE,
     GOOGLE_ASSAY_OR_ANALYSIS_UPLOAD_TOPIC,
     GOOGLE_ANALYSIS_PERMISSIONS_GRANT_FOR_DAYS,
+    GOOGLE_IAM_POLICY_MAX_ATTEMPTS,
+    GCS_COPY_MAX_BYTES_IN_FLIGHT,
+    GCS_COPY_MAX_THREADS,
+    GCS_LIST_MAX_RESULTS_PER_OBJECT,
+    INGEST_COPY_MAX_ATTEMPTS,
+    INGEST_COPY_PROGRESS_PREFIX,
+    INGEST_COPY_PROGRESS_SAVE_INTERVAL_SECONDS,
+    INGEST_MERGE_BATCH_SIZE,
+    INGEST_UPLOAD_PIPELINED,
 )
 from .util import (
     BackgroundContext,
+    publish_artifact_upload_batches,
     extract_pubsub_data,
     sqlalchemy_session,
     make_pseudo_blob,
+    get_bucket,
 )
 
 from flask import jsonify
+from google.api_core.exceptions import (
+    BadRequest,
+    Conflict,
+    NotFound,
+    PreconditionFailed,
+)
+from google.api_core.iam import Policy
 from google.cloud import storage
 from cidc_api.models import (
     DownloadableFiles,
@@ -32,14 +64,13 @@ from cidc_api.models import (
     UploadJobs,
     UploadJobStatus,
 )
-from cidc_api.shared.gcloud_client import publish_artifact_upload, _encode_and_publish
+from cidc_api.models.models import make_etag
+from cidc_api.shared.gcloud_client import _encode_and_publish
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 logger.setLevel(logging.DEBUG if ENV == "dev" else logging.INFO)
 
-THREADPOOL_THREADS = 16
-
 
 class URLBundle(NamedTuple):
     upload_url: str
@@ -48,25 +79,47 @@ class URLBundle(NamedTuple):
 
 
 @contextmanager
-def saved_failure_status(job: UploadJobs, session):
-    """Save an upload failure to the database before raising an exception."""
+def saved_failure_status(job: UploadJobs, session, progress: "_CopyProgress" = None):
+    """
+    Save an upload failure to the database before raising an exception,
+    deleting the job's copy `progress`, if given, since it won't be used again.
+    """
     try:
         yield
     except Exception as e:
         job.status = UploadJobStatus.MERGE_FAILED.value
         job.status_details = str(e)
         session.commit()
+        if progress is not None:
+            progress.delete()
         raise e
 
 
+@contextmanager
+def _copy_failure_status(job: UploadJobs, session, progress: "_CopyProgress"):
+    """
+    Like `saved_failure_status`, but while the job's saved copy `progress` has attempts
+    left, keep it, so that re-ingesting the job (once its status is reset) resumes its copies.
+    """
+    try:
+        yield
+    except Exception as e:
+        resumable = progress.saved and progress.attempts < INGEST_COPY_MAX_ATTEMPTS
+        if resumable:
+            logger.warning(
+                f"Copying artifacts for upload job {job.id} failed on attempt {progress.attempts} "
+                f"of {INGEST_COPY_MAX_ATTEMPTS}; keeping its copy progress for a re-ingest"
+            )
+        with saved_failure_status(job, session, None if resumable else progress):
+            raise e
+
+
 def ingest_upload(event: dict, context: BackgroundContext):
     """
     When a successful upload event is published, move the data associated
     with the upload job into the download bucket and merge the upload metadata
     into the appropriate clinical trial JSON.
     """
-    storage_client = storage.Client()
-
     job_id = int(extract_pubsub_data(event))
 
     logger.info(f"ingest_upload execution started on upload job id {job_id}")
@@ -97,36 +150,38 @@ def ingest_upload(event: dict, context: BackgroundContext):
             URLBundle(*bundle) for bundle in job.upload_uris_with_data_uris_with_uuids()
         ]
 
-        # Copy GCS blobs in parallel
-        logger.info("Copying artifacts from upload bucket to data bucket.")
-        with ThreadPoolExecutor(THREADPOOL_THREADS) as executor, saved_failure_status(
-            job, session
-        ):
-            destination_objects = executor.map(
-                lambda url_bundle: _gcs_copy(
-                    storage_client,
-                    GOOGLE_UPLOAD_BUCKET,
-                    url_bundle.upload_url,
-                    GOOGLE_ACL_DATA_BUCKET,
-                    url_bundle.target_url,
-                ),
-                url_bundles,
-            )
-
+        # Copy GCS blobs in parallel, resuming any copies a previous attempt started,
+        # and add each batch of copied artifacts' metadata to the metadata patch
+        logger.info(
+            "Copying artifacts from upload bucket to data bucket and adding their metadata to metadata patch."
+        )
+        progress = _CopyProgress(job_id)
         metadata_patch = job.metadata_patch
-        logger.info("Adding artifact metadata to metadata patch.")
-        metadata_patch, downloadable_files = TrialMetadata.merge_gcs_artifacts(
-            metadata_patch,
-            job.upload_type,
-            zip([ub.artifact_uuid for ub in url_bundles], destination_objects),
+        downloadable_files = []
+        copied_batches = _gcs_copy_all(
+            url_bundles,
+            progress,
+            batch_size=INGEST_MERGE_BATCH_SIZE if INGEST_UPLOAD_PIPELINED else None,
         )
+        with closing(copied_batches):
+            while True:
+                with _copy_failure_status(job, session, progress):
+                    copied = next(copied_batches, None)
+                if copied is None:
+                    break
+                metadata_patch, merged_files = TrialMetadata.merge_gcs_artifacts(
+                    metadata_patch,
+                    job.upload_type,
+                    [(ub.artifact_uuid, blob) for ub, blob in copied],
+                )
+                downloadable_files.extend(merged_files)
 
         # Add metadata for this upload to the database
         logger.info(
             "Merging metadata from upload %d into trial %s: " % (job.id, trial_id),
             metadata_patch,
         )
-        with saved_failure_status(job, session):
+        with saved_failure_status(job, session, progress):
             trial = TrialMetadata.patch_assays(
                 trial_id, metadata_patch, session=session
             )
@@ -136,23 +191,14 @@ def ingest_upload(event: dict, context: BackgroundContext):
         # in order to avoid violating a foreign-key constraint on the trial_id
         # in the event that this is the first upload for a trial.
         logger.info("Saving artifact records to the downloadable_files table.")
-        for artifact_metadata, additional_metadata in downloadable_files:
-            logger.debug(
-                f"Saving metadata to downloadable_files table: {artifact_metadata}"
-            )
-            DownloadableFiles.create_from_metadata(
-                trial_id,
-                job.upload_type,
-                artifact_metadata,
-                additional_metadata=additional_metadata,
-                session=session,
-                commit=False,
-            )
+        _bulk_create_downloadable_files(
+            trial_id, job.upload_type, downloadable_files, session=session
+        )
 
         # Additionally, make the metadata xlsx a downloadable file
-        with saved_failure_status(job, session):
+        with saved_failure_status(job, session, progress):
             _, xlsx_blob = _get_bucket_and_blob(
-                storage_client, GOOGLE_ACL_DATA_BUCKET, job.gcs_xlsx_uri
+                GOOGLE_ACL_DATA_BUCKET, job.gcs_xlsx_uri
             )
             full_uri = f"gs://{GOOGLE_ACL_DATA_BUCKET}/{xlsx_blob.name}"
             data_format = "Assay Metadata"
@@ -173,21 +219,24 @@ def ingest_upload(event: dict, context: BackgroundContext):
         # Save the upload success and trigger email alert if transaction succeeds
         job.ingestion_success(trial, session=session, send_email=True, commit=True)
 
-        # Trigger post-processing on uploaded data files
-        logger.info(f"Publishing object URLs to 'artifact_upload' topic")
-        with ThreadPoolExecutor(THREADPOOL_THREADS) as executor:
-            executor.map(
-                lambda url_bundle: publish_artifact_upload(url_bundle.target_url),
-                url_bundles,
-            )
+        # The copies won't be needed again
+        progress.delete()
 
-        # Trigger post-processing on entire upload
-        report = _encode_and_publish(str(job.id), GOOGLE_ASSAY_OR_ANALYSIS_UPLOAD_TOPIC)
-        if report:
-            report.result()
-
-        # Trigger download permissions for this upload job
-        Permissions.grant_download_permissions_for_upload_job(job, session=session)
+        # Trigger post-processing on the upload and its data files, and download permissions
+        # for this upload job. Nothing is published until the upload is committed above.
+        target_urls = [ub.target_url for ub in url_bundles]
+        if INGEST_UPLOAD_PIPELINED:
+            with ThreadPoolExecutor(1) as executor:
+                published = executor.submit(
+                    _publish_ingestion_messages, job.id, target_urls
+                )
+                Permissions.grant_download_permissions_for_upload_job(
+                    job, session=session
+                )
+                published.result()
+        else:
+            _publish_ingestion_messages(job.id, target_urls)
+            Permissions.grant_download_permissions_for_upload_job(job, session=session)
 
     # Google won't actually do anything with this response; it's
     # provided for testing purposes only.
@@ -196,57 +245,187 @@ def ingest_upload(event: dict, context: BackgroundContext):
     )
 
 
-def _gcs_add_prefix_reader_permission(
-    storage_client: storage.Client, group_email: str, prefix: str
+def _publish_ingestion_messages(job_id: int, object_urls: List[str]):
+    """Trigger post-processing on an ingested upload's data files and on the upload as a whole."""
+    # Trigger post-processing on uploaded data files, a batch of files per message
+    logger.info(f"Publishing object URLs to 'artifact_upload' topic")
+    publish_artifact_upload_batches(_encode_and_publish, object_urls)
+
+    # Trigger post-processing on entire upload
+    report = _encode_and_publish(str(job_id), GOOGLE_ASSAY_OR_ANALYSIS_UPLOAD_TOPIC)
+    if report:
+        report.result()
+
+
+def _bulk_create_downloadable_files(
+    trial_id: str,
+    upload_type: str,
+    downloadable_files: List[Tuple[dict, dict]],
+    session,
 ):
+    """
+    Create or update DownloadableFiles records for a list of (artifact metadata, additional metadata)
+    pairs, as `DownloadableFiles.create_from_metadata(..., commit=False)` does for one artifact,
+    but with one query for existing records and one bulk write each for inserts and updates.
+    """
+    if not downloadable_files:
+        return
+
+    supported_columns = DownloadableFiles.__table__.columns.keys()
+    # bulk writes skip the ORM, so new rows get the Python-side column defaults a new
+    # DownloadableFiles would; SQL defaults like _created's are still applied by the insert
+    insert_defaults = {
+        column.name: column.default.arg
+        for column in DownloadableFiles.__table__.columns
+        if column.default is not None and column.default.is_scalar
+    }
+    rows: Dict[str, dict] = {}
+    for artifact_metadata, additional_metadata in downloadable_files:
+        logger.debug(
+            f"Saving metadata to downloadable_files table: {artifact_metadata}"
+        )
+        row = {
+            "trial_id": trial_id,
+            "upload_type": upload_type,
+            "additional_metadata": additional_metadata,
+        }
+        for key, value in artifact_metadata.items():
+            if key in supported_columns:
+                row[key] = value
+        row["_etag"] = make_etag(row.values())
+        rows[row["object_url"]] = row
+
+    existing_ids = dict(
+        session.query(DownloadableFiles.object_url, DownloadableFiles.id)
+        .filter(DownloadableFiles.object_url.in_(rows.keys()))
+        .with_for_update()
+        .all()
+    )
+    new_rows, updated_rows = [], []
+    for object_url, row in rows.items():
+        if object_url in existing_ids:
+            updated_rows.append({"id": existing_ids[object_url], **row})
+        else:
+            new_rows.append({**insert_defaults, **row})
+
+    logger.info(
+        f"Inserting {len(new_rows)} and updating {len(updated_rows)} downloadable_files records."
+    )
+    session.bulk_insert_mappings(DownloadableFiles, new_rows)
+    session.bulk_update_mappings(DownloadableFiles, updated_rows)
+
+
+def _gcs_add_prefix_reader_permission(group_email: str, prefix: str):
     """
     Gives reader privileges on GCS bucket (default: GOOGLE_ACL_DATA_BUCKET) to `group_email` for all objects within a `prefix`.
+    Any existing bindings for the same group and prefix are replaced. If the policy is changed
+    concurrently, the update is retried on the new policy up to GOOGLE_IAM_POLICY_MAX_ATTEMPTS times.
     """
     logger.info(
         f"Adding {group_email} {GOOGLE_ANALYSIS_GROUP_ROLE} access to GCS {GOOGLE_ACL_DATA_BUCKET} policy"
     )
 
-    # get the bucket
-    bucket = storage_client.get_bucket(GOOGLE_ACL_DATA_BUCKET)
+    grant_until_date = (
+        datetime.now() + timedelta(GOOGLE_ANALYSIS_PERMISSIONS_GRANT_FOR_DAYS)
+    ).date()
+    if not _update_data_bucket_policy(
+        lambda policy: _apply_prefix_reader_grant(
+            policy, group_email, prefix, grant_until_date
+        )
+    ):
+        logger.info("GCS policy already has the requested binding")
 
-    # get v3 policy to use condition in bindings
-    policy = bucket.get_iam_policy(requested_policy_version=3)
 
-    # Set the policy's version to 3 to use condition in bindings.
-    policy.version = 3
+def _update_data_bucket_policy(update: Callable[[Policy], bool]) -> bool:
+    """
+    Read-modify-write GOOGLE_ACL_DATA_BUCKET's (v3) IAM policy, where `update` modifies
+    the policy in place, returning False if nothing needed changing. If the policy is
+    changed concurrently, `update` is retried on the new policy up to
+    GOOGLE_IAM_POLICY_MAX_ATTEMPTS times. Returns whether the policy was written.
+    """
+    bucket = get_bucket(GOOGLE_ACL_DATA_BUCKET)
+    for attempt in range(1, GOOGLE_IAM_POLICY_MAX_ATTEMPTS + 1):
+        # get v3 policy to use condition in bindings
+        policy = bucket.get_iam_policy(requested_policy_version=3)
+
+        # Set the policy's version to 3 to use condition in bindings.
+        policy.version = 3
+
+        if not update(policy):
+            return False
+
+        try:
+            # the policy's etag makes this fail if the policy changed since we read it
+            bucket.set_iam_policy(policy)
+            return True
+        except (Conflict, PreconditionFailed) as e:
+            if attempt == GOOGLE_IAM_POLICY_MAX_ATTEMPTS:
+                raise
+            logger.warning(
+                f"GCS {GOOGLE_ACL_DATA_BUCKET} policy changed during update (attempt {attempt}), retrying: {e}"
+            )
+            time.sleep(random.uniform(0, 0.5 * 2**attempt))
 
-    cleaned_prefix = prefix.replace('"', '\\"').lstrip("/")
-    grant_until_date = (
-        (datetime.now() + timedelta(GOOGLE_ANALYSIS_PERMISSIONS_GRANT_FOR_DAYS))
-        .date()
-        .isoformat()
-    )
 
-    prefix_check = f'resource.name.startsWith("projects/_/buckets/{GOOGLE_ACL_DATA_BUCKET}/objects/{cleaned_prefix}/")'
-    expiry_check = f'request.time < timestamp("{grant_until_date}T00:00:00Z")'
+def _clean_prefix(prefix: str) -> str:
+    """Escape `prefix` for use in a CEL string literal."""
+    return prefix.replace('"', '\\"').lstrip("/")
+
+
+# matches the prefix in the conditions of bindings created by _gcs_add_prefix_reader_permission
+_PREFIX_CHECK_REGEX = re.compile(
+    r'resource\.name\.startsWith\("projects/_/buckets/'
+    + re.escape(GOOGLE_ACL_DATA_BUCKET)
+    + r'/objects/((?:[^"\\]|\\.)*)/"\)'
+)
+
+
+def _apply_prefix_reader_grant(
+    policy: Policy, group_email: str, prefix: str, expiry: date
+) -> bool:
+    """
+    Add a binding granting `group_email` reader access to `prefix` until `expiry` to `policy`,
+    replacing existing bindings for the same group and prefix. Returns False if `policy`
+    already had the binding.
+    """
     group_member = f"group:{group_email}"
+    cleaned_prefix = _clean_prefix(prefix)
+    grant_until_date = expiry.isoformat()
 
-    # look for a duplicate conditional binding
-    matching_binding_index = None
-    for i, binding in enumerate(policy.bindings):
-        role_matches = binding.get("role") == GOOGLE_ANALYSIS_GROUP_ROLE
-        member_matches = group_member in binding.get("members", {})
-        prefix_matches = prefix_check in binding.get("condition", {}).get(
-            "expression", ""
+    prefix_check = f'resource.name.startsWith("projects/_/buckets/{GOOGLE_ACL_DATA_BUCKET}/objects/{cleaned_prefix}/")'
+    expiry_check = f'request.time < timestamp("{grant_until_date}T00:00:00Z")'
+    expression = f"{prefix_check} && {expiry_check}"
+
+    matching_binding_indexes = [
+        i
+        for i, binding in enumerate(policy.bindings)
+        if binding.get("role") == GOOGLE_ANALYSIS_GROUP_ROLE
+        and group_member in binding.get("members", ())
+        and cleaned_prefix
+        in _PREFIX_CHECK_REGEX.findall(
+            binding.get("condition", {}).get("expression", "")
         )
-        if role_matches and member_matches and prefix_matches:
-            # we shouldn't have multiple bindings matching these conditions
-            if matching_binding_index is not None:
-                warnings.warn(
-                    f"Found multiple conditional bindings for {group_email} on {prefix}. This is an invariant violation - "
-                    "check out permissions on the CIDC GCS buckets to debug."
-                )
-                break
-            matching_binding_index = i
-
-    # if one exists, delete it so we can replace it below
-    if matching_binding_index is not None:
-        policy.bindings.pop(matching_binding_index)
+    ]
+    # we shouldn't have multiple bindings matching these conditions
+    if len(matching_binding_indexes) > 1:
+        warnings.warn(
+            f"Found multiple conditional bindings for {group_email} on {prefix}. This is an invariant violation - "
+            "check out permissions on the CIDC GCS buckets to debug."
+        )
+    elif (
+        matching_binding_indexes
+        and policy.bindings[matching_binding_indexes[0]]["condition"]["expression"]
+        == expression
+    ):
+        # this exact grant already exists
+        return False
+
+    # delete any existing bindings so we can replace them below
+    policy.bindings = [
+        binding
+        for i, binding in enumerate(policy.bindings)
+        if i not in matching_binding_indexes
+    ]
 
     # following https://github.com/GoogleCloudPlatform/python-docs-samples/pull/2730/files
     policy.bindings.append(
@@ -256,38 +435,304 @@ def _gcs_add_prefix_reader_permission(
             "condition": {
                 "title": f"Biofx {prefix} until {grant_until_date}",
                 "description": f"Auto-assigned from cidc-cloud-functions/uploads on {datetime.now()}",
-                "expression": f"{prefix_check} && {expiry_check}",
+                "expression": expression,
             },
         }
     )
+    return True
+
+
+def remove_expired_gcs_bindings(*args) -> int:
+    """
+    Remove conditional bindings from GOOGLE_ACL_DATA_BUCKET's IAM policy that can no
+    longer apply because their `request.time < timestamp(...)` expiry has passed,
+    e.g., reader permissions granted by `_gcs_add_prefix_reader_permission`.
+    Returns the number of bindings removed.
+    """
+    now = datetime.now(timezone.utc)
+    removed = []
+
+    def remove_expired(policy: Policy) -> bool:
+        removed.clear()
+        bindings = []
+        for binding in policy.bindings:
+            expiry = _get_binding_expiry(binding)
+            if expiry is not None and expiry <= now:
+                removed.append(binding)
+            else:
+                bindings.append(binding)
+        policy.bindings = bindings
+        return len(removed) > 0
+
+    _update_data_bucket_policy(remove_expired)
+    logger.info(
+        f"Removed {len(removed)} expired conditional bindings from GCS {GOOGLE_ACL_DATA_BUCKET} policy"
+    )
+    return len(removed)
+
+
+# matches an expiry check like the ones created by _gcs_add_prefix_reader_permission
+_EXPIRY_CHECK_REGEX = re.compile(r'^request\.time\s*<\s*timestamp\("([^"]+)"\)$')
+
 
-    bucket.set_iam_policy(policy)
+def _get_binding_expiry(binding: dict) -> Optional[datetime]:
+    """
+    Get the time after which a conditional binding's condition is always false, if its
+    expression is a conjunction including an expiry check, like `A && request.time < timestamp(...)`.
+    """
+    expression = binding.get("condition", {}).get("expression", "")
+    # anything but a plain conjunction could still be true after the expiry
+    if "||" in expression or "!" in expression:
+        return None
+
+    expiries = []
+    for term in expression.split("&&"):
+        match = _EXPIRY_CHECK_REGEX.match(term.strip())
+        if match:
+            try:
+                expiries.append(
+                    datetime.fromisoformat(match.group(1).replace("Z", "+00:00"))
+                )
+            except ValueError:
+                continue
+    # timestamps without a time zone aren't valid CEL, so can't be compared
+    expiries = [expiry for expiry in expiries if expiry.tzinfo is not None]
+    return min(expiries) if expiries else None
+
+
+class _CopyProgress:
+    """
+    Copy progress for an upload job's URL bundles, keyed on target URL: rewrite tokens
+    for unfinished copies, and which copies finished, along with which attempt to ingest
+    the job this is. It's saved to the upload bucket at most every
+    INGEST_COPY_PROGRESS_SAVE_INTERVAL_SECONDS (and when copying fails), and loaded by
+    later attempts to ingest the same job.
+    """
+
+    def __init__(self, job_id: int):
+        self.object_name = f"{INGEST_COPY_PROGRESS_PREFIX}{job_id}.json"
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.copies: Dict[str, dict] = {}
+        self.attempts = 1
+        self.last_saved = time.monotonic()
+        self.saved = False
+
+        if ENV == "dev":
+            return
+
+        bucket = get_bucket(GOOGLE_UPLOAD_BUCKET)
+        blob = bucket.get_blob(self.object_name)
+        if blob is not None:
+            saved = json.loads(blob.download_as_string())
+            self.copies = saved["copies"]
+            self.attempts = saved["attempts"] + 1
+            self.saved = True
+            logger.info(
+                f"Resuming upload job {job_id} (attempt {self.attempts}): "
+                f"{sum(c['done'] for c in self.copies.values())} "
+                f"of {len(self.copies)} started copies finished"
+            )
+
+    def get(self, target_url: str) -> dict:
+        with self.lock:
+            return self.copies.get(target_url, {"token": None, "done": False})
+
+    def update(self, target_url: str, token: Optional[str], done: bool):
+        with self.lock:
+            self.copies[target_url] = {"token": token, "done": done}
+            should_save = (
+                time.monotonic() - self.last_saved
+                > INGEST_COPY_PROGRESS_SAVE_INTERVAL_SECONDS
+            )
+        if should_save:
+            self.save()
+
+    def save(self):
+        if ENV == "dev":
+            return
+        # serialize saves, so an older snapshot of the progress can't overwrite a newer one
+        with self.save_lock:
+            with self.lock:
+                data = json.dumps({"attempts": self.attempts, "copies": self.copies})
+                self.last_saved = time.monotonic()
+                self.saved = True
+            bucket = get_bucket(GOOGLE_UPLOAD_BUCKET)
+            bucket.blob(self.object_name).upload_from_string(data)
+
+    def delete(self):
+        if ENV == "dev" or not self.saved:
+            return
+        bucket = get_bucket(GOOGLE_UPLOAD_BUCKET)
+        try:
+            bucket.delete_blob(self.object_name)
+        except NotFound:
+            pass
+
+
+class _ByteBudget:
+    """Limits the total size of objects being copied at once (a larger object waits for its share)."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, num_bytes: int):
+        # objects bigger than the whole budget are copied one at a time
+        num_bytes = min(num_bytes, self.capacity)
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_use + num_bytes <= self.capacity)
+            self.in_use += num_bytes
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_use -= num_bytes
+                self.condition.notify_all()
+
+
+def _gcs_copy_all(
+    url_bundles: List[URLBundle],
+    progress: _CopyProgress,
+    batch_size: Optional[int] = None,
+) -> Iterator[List[Tuple[URLBundle, storage.Blob]]]:
+    """
+    Copy all `url_bundles` from the upload bucket to the data bucket, recording `progress`.
+    Objects already in the data bucket with the same contents aren't copied again.
+    Many small objects are copied at once, but fewer large ones (see GCS_COPY_MAX_BYTES_IN_FLIGHT).
+
+    Yields (URL bundle, copied object) pairs in the order the copies finish, `batch_size`
+    at a time while the rest are still copying, or all at once if `batch_size` is None.
+    Closing the generator early cancels the copies that haven't started.
+    """
+    # objects the listings miss are looked up one at a time
+    source_objects, _ = _list_objects(
+        GOOGLE_UPLOAD_BUCKET, [url_bundle.upload_url for url_bundle in url_bundles]
+    )
+    existing_objects, listed_all_targets = _list_objects(
+        GOOGLE_ACL_DATA_BUCKET, [url_bundle.target_url for url_bundle in url_bundles]
+    )
+    budget = _ByteBudget(GCS_COPY_MAX_BYTES_IN_FLIGHT)
+    try:
+        with ThreadPoolExecutor(GCS_COPY_MAX_THREADS) as executor:
+            futures = {
+                executor.submit(
+                    _gcs_copy,
+                    GOOGLE_UPLOAD_BUCKET,
+                    url_bundle.upload_url,
+                    GOOGLE_ACL_DATA_BUCKET,
+                    url_bundle.target_url,
+                    progress=progress,
+                    budget=budget,
+                    source_blob=source_objects.get(url_bundle.upload_url),
+                    existing_object=existing_objects.get(url_bundle.target_url),
+                    look_up_target=not listed_all_targets,
+                ): url_bundle
+                for url_bundle in url_bundles
+            }
+            try:
+                copied = []
+                for future in as_completed(futures):
+                    copied.append((futures[future], future.result()))
+                    if len(copied) == batch_size:
+                        yield copied
+                        copied = []
+                if copied:
+                    yield copied
+            finally:
+                for future in futures:
+                    future.cancel()
+    except (Exception, GeneratorExit):
+        # keep what was copied for the next attempt
+        progress.save()
+        raise
+
+
+def _list_objects(
+    bucket_name: str, object_names: List[str]
+) -> Tuple[Dict[str, storage.Blob], bool]:
+    """
+    Get the blobs in `bucket_name` among `object_names`, by name, with one listing of
+    their common prefix, and whether that listing was complete. The prefix may hold many
+    other objects (it's often just the trial and assay), so the listing stops after
+    GCS_LIST_MAX_RESULTS_PER_OBJECT objects per name; if it does, or the prefix is too
+    broad to list at all, objects that weren't found may still exist.
+    """
+    if ENV == "dev" or not object_names:
+        return {}, not object_names
+
+    prefix = os.path.commonprefix(object_names)
+    # never list the whole bucket
+    if "/" not in prefix.lstrip("/"):
+        return {}, False
+
+    max_results = len(object_names) * GCS_LIST_MAX_RESULTS_PER_OBJECT
+    wanted = set(object_names)
+    bucket = get_bucket(bucket_name)
+    blobs = list(bucket.list_blobs(prefix=prefix, max_results=max_results))
+    return (
+        {blob.name: blob for blob in blobs if blob.name in wanted},
+        len(blobs) < max_results,
+    )
+
+
+def _same_contents(blob: storage.Blob, other_blob: storage.Blob) -> bool:
+    """Compare blobs' checksums (composite objects only have a CRC32C)."""
+    if blob.crc32c and other_blob.crc32c:
+        return blob.crc32c == other_blob.crc32c
+    return bool(blob.md5_hash) and blob.md5_hash == other_blob.md5_hash
 
 
 def _gcs_copy(
-    storage_client: storage.Client,
     source_bucket: str,
     source_object: str,
     target_bucket: str,
     target_object: str,
+    progress: Optional[_CopyProgress] = None,
+    budget: Optional[_ByteBudget] = None,
+    source_blob: Optional[storage.Blob] = None,
+    existing_object: Optional[storage.Blob] = None,
+    look_up_target: bool = False,
 ):
-    """Copy a GCS object from one bucket to another"""
+    """
+    Copy a GCS object from one bucket to another with the rewrite API, resuming from and
+    recording to `progress` if provided, and reserving the object's size from `budget` while copying.
+    `source_blob` is the source object's metadata, if it's already been fetched.
+    The copy is skipped if `existing_object`, the target object, already has the same contents.
+    If `existing_object` isn't given but the target may exist (`look_up_target`, or `progress`
+    says a previous attempt finished this copy), the target object is looked up instead.
+    """
     if ENV == "dev":
         logger.debug(
             f"Would've copied gs://{source_bucket}/{source_object} gs://{target_bucket}/{target_object}"
         )
         return make_pseudo_blob(target_object)
 
-    logger.debug(
-        f"Copying gs://{source_bucket}/{source_object} to gs://{target_bucket}/{target_object}"
-    )
-    from_bucket, from_object = _get_bucket_and_blob(
-        storage_client, source_bucket, source_object
-    )
+    from_object = source_blob
+    if from_object is None:
+        _, from_object = _get_bucket_and_blob(source_bucket, source_object)
     if from_object is None:
         raise Exception(f"Couldn't get the GCS blob to copy: {source_object}")
-    to_bucket, _ = _get_bucket_and_blob(storage_client, target_bucket, None)
-    to_object = from_bucket.copy_blob(from_object, to_bucket, new_name=target_object)
+    to_bucket = get_bucket(target_bucket)
+
+    copy_progress = (
+        progress.get(target_object) if progress else {"token": None, "done": False}
+    )
+    if existing_object is None and (look_up_target or copy_progress["done"]):
+        existing_object = to_bucket.get_blob(target_object)
+
+    if existing_object is not None and _same_contents(from_object, existing_object):
+        logger.debug(f"Skipping copy to identical gs://{target_bucket}/{target_object}")
+        to_object = existing_object
+    else:
+        logger.debug(
+            f"Copying gs://{source_bucket}/{source_object} to gs://{target_bucket}/{target_object}"
+        )
+        to_object = to_bucket.blob(target_object)
+        with budget.reserve(from_object.size or 0) if budget else nullcontext():
+            _gcs_rewrite(from_object, to_object, copy_progress["token"], progress)
 
     # We want to maintain the actual upload time of this object, which is the moment
     # it was originally created in the upload bucket, not the moment it was moved
@@ -300,8 +745,44 @@ def _gcs_copy(
     return to_object
 
 
+def _gcs_rewrite(
+    from_object: storage.Blob,
+    to_object: storage.Blob,
+    token: Optional[str],
+    progress: Optional[_CopyProgress],
+):
+    """
+    Rewrite `from_object` into `to_object`, resuming from rewrite `token` if given.
+    Large objects take several rewrite calls; each returns a token for continuing the copy.
+    """
+    resuming = token is not None
+    while True:
+        try:
+            token, bytes_rewritten, total_bytes = to_object.rewrite(
+                from_object, token=token
+            )
+        except (BadRequest, NotFound) as e:
+            # saved tokens expire, and are invalidated by changes to the source object
+            if not resuming:
+                raise
+            resuming = False
+            logger.warning(
+                f"Restarting copy of {from_object.name}, its rewrite token was rejected: {e}"
+            )
+            token = None
+            continue
+
+        if progress:
+            progress.update(to_object.name, token, done=token is None)
+        if token is None:
+            return
+        logger.debug(
+            f"Copied {bytes_rewritten} of {total_bytes} bytes of {from_object.name}"
+        )
+
+
 def _get_bucket_and_blob(
-    storage_client: storage.Client, bucket_name: str, object_name: Optional[str]
+    bucket_name: str, object_name: Optional[str]
 ) -> Tuple[storage.Bucket, Optional[storage.Blob]]:
     """Get GCS metadata for a storage bucket and blob"""
 
@@ -311,8 +792,8 @@ def _get_bucket_and_blob(
         )
         return (bucket_name, make_pseudo_blob(object_name))
 
-    # get the bucket.
-    bucket = storage_client.get_bucket(bucket_name)
+    # get the bucket, reusing this instance's handle if we already have one
+    bucket = get_bucket(bucket_name)
 
     # get the blob and return it
     blob = bucket.get_blob(object_name) if object_name else None
@@ -1,19 +1,58 @@
 """Helpers for working with Cloud Functions."""
+import ast
 import base64
+import json
+import multiprocessing
+import os
+import random
+import resource
+import threading
+import time
+import zlib
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
 from contextlib import contextmanager
-from io import BytesIO, StringIO
-from typing import NamedTuple, Union
+from io import BytesIO, StringIO, TextIOWrapper
+from tempfile import TemporaryFile
+from typing import IO, Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 from collections import namedtuple
 
+from google.api_core.exceptions import (
+    Aborted,
+    DeadlineExceeded,
+    InternalServerError,
+    ServiceUnavailable,
+    TooManyRequests,
+)
 from google.cloud import storage
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from .settings import SQLALCHEMY_DATABASE_URI, ENV, GOOGLE_ACL_DATA_BUCKET
+from .settings import (
+    SQLALCHEMY_DATABASE_URI,
+    ENV,
+    GOOGLE_ACL_DATA_BUCKET,
+    GOOGLE_BUCKET_CACHE_TTL_SECONDS,
+    GOOGLE_UPLOAD_BUCKET,
+    BLOB_DOWNLOAD_CHUNK_SIZE,
+    BLOB_SPOOL_MAX_MEMORY_BYTES,
+    PUBSUB_COMPRESSION_THRESHOLD_BYTES,
+    PUBSUB_MAX_IN_FLIGHT_MESSAGES,
+    PUBSUB_PUBLISH_MAX_ATTEMPTS,
+    PUBSUB_PUBLISH_RETRY_DELAY_SECONDS,
+    PUBSUB_PUBLISH_TIMEOUT_SECONDS,
+    GOOGLE_ARTIFACT_UPLOAD_TOPIC,
+    VIS_PREPROCESSING_BATCH_SIZE,
+)
 
 _engine = None
 
+# Process-wide GCS client and bucket handles, shared across invocations
+# on a warm function instance. See `get_storage_client` and `get_bucket`.
+_storage_client = None
+_bucket_cache: Dict[str, Tuple[float, storage.Bucket]] = {}
+_storage_lock = threading.Lock()
+
 _pseudo_blob = namedtuple(
     "_pseudo_blob", ["name", "size", "md5_hash", "crc32c", "time_created"]
 )
@@ -37,7 +76,13 @@ def sqlalchemy_session():
     """Get a SQLAlchemy session from the connection pool"""
     global _engine
     if not _engine:
-        _engine = create_engine(SQLALCHEMY_DATABASE_URI)
+        engine_options = {}
+        if SQLALCHEMY_DATABASE_URI.startswith("postgresql"):
+            # send bulk inserts/updates as a few multi-row statements, rather than
+            # one round trip per row. This only changes how executemany is sent: bulk
+            # writes still skip the ORM, so callers fill in model defaults themselves
+            engine_options["executemany_mode"] = "values"
+        _engine = create_engine(SQLALCHEMY_DATABASE_URI, **engine_options)
     session = sessionmaker(bind=_engine)()
 
     try:
@@ -58,6 +103,322 @@ def extract_pubsub_data(event: dict) -> str:
     return data
 
 
+PUBSUB_MESSAGE_VERSION = 1
+
+
+def encode_pubsub_message(data: dict) -> str:
+    """
+    Encode `data` as a versioned JSON pub/sub message, decodable with `decode_pubsub_message`.
+    Messages larger than PUBSUB_COMPRESSION_THRESHOLD_BYTES are zlib-compressed.
+    """
+    payload = json.dumps(data, separators=(",", ":"))
+    if len(payload) < PUBSUB_COMPRESSION_THRESHOLD_BYTES:
+        return json.dumps({"_v": PUBSUB_MESSAGE_VERSION, "data": data})
+
+    compressed = zlib.compress(payload.encode("utf-8"))
+    return json.dumps(
+        {
+            "_v": PUBSUB_MESSAGE_VERSION,
+            "zlib": base64.b64encode(compressed).decode("utf-8"),
+        }
+    )
+
+
+def decode_pubsub_message(
+    message: str, schema: Optional[Dict[str, Tuple[type, ...]]] = None
+) -> Dict[str, Any]:
+    """
+    Decode a pub/sub message produced by `encode_pubsub_message`. Plain JSON objects and
+    legacy `str(dict)`-style messages are also accepted.
+
+    If `schema` is provided, it maps field names to the types allowed for that field,
+    and a TypeError is raised for any field in the message with a value of another type.
+    Fields missing from the message are not checked.
+    """
+    try:
+        decoded = json.loads(message)
+    except ValueError:
+        # legacy messages were built with `str(dict)`
+        try:
+            decoded = dict(ast.literal_eval(message))
+        except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+            raise ValueError(f"Could not decode pub/sub message: {message!r}")
+
+    if isinstance(decoded, dict) and "_v" in decoded:
+        if decoded["_v"] != PUBSUB_MESSAGE_VERSION:
+            raise ValueError(f"Unsupported pub/sub message version: {decoded['_v']}")
+        if "zlib" in decoded:
+            payload = zlib.decompress(base64.b64decode(decoded["zlib"]))
+            decoded = json.loads(payload.decode("utf-8"))
+        else:
+            decoded = decoded.get("data")
+
+    if not isinstance(decoded, dict):
+        raise ValueError(f"Expected a pub/sub message containing a dict: {message!r}")
+
+    for field, types in (schema or {}).items():
+        if field in decoded and not isinstance(decoded[field], types):
+            raise TypeError(
+                f"Invalid pub/sub message: {field} must be {' or '.join(t.__name__ for t in types)}, got {type(decoded[field]).__name__}"
+            )
+
+    return decoded
+
+
+# publish errors worth retrying, since pub/sub may well accept the same message a moment later
+_TRANSIENT_PUBLISH_ERRORS = (
+    Aborted,
+    DeadlineExceeded,
+    InternalServerError,
+    ServiceUnavailable,
+    TooManyRequests,
+)
+
+
+class BatchPublisher:
+    """
+    Publish many messages to a pub/sub topic without waiting for each one to be
+    confirmed before sending the next. At most `max_in_flight` messages are awaiting
+    confirmation at any time; `publish` blocks until a slot frees up, for up to `timeout_seconds`,
+    after which the message counts as a failure.
+
+    `publish_fn` is called as `publish_fn(message, topic)` and should return a future
+    (or None if nothing was published), e.g. `cidc_api.shared.gcloud_client._encode_and_publish`.
+    Call `wait` once everything is published to retry transient failures and collect the rest,
+    and `summary` to describe the outcome.
+    """
+
+    def __init__(
+        self,
+        publish_fn: Callable[[str, str], Any],
+        topic: str,
+        max_in_flight: int = PUBSUB_MAX_IN_FLIGHT_MESSAGES,
+        max_attempts: int = PUBSUB_PUBLISH_MAX_ATTEMPTS,
+        timeout_seconds: float = PUBSUB_PUBLISH_TIMEOUT_SECONDS,
+    ):
+        self.publish_fn = publish_fn
+        self.topic = topic
+        self.max_attempts = max_attempts
+        self.timeout_seconds = timeout_seconds
+        self.published = 0
+        self.retried = 0
+        self.failures: List[Tuple[str, Exception]] = []
+        # (message, attempt, future) for unconfirmed messages
+        self._futures: List[Tuple[str, int, Any]] = []
+        # (message, next attempt, last error) for messages to retry
+        self._retries: List[Tuple[str, int, Exception]] = []
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        # set once waiting for a slot has timed out, so that later messages don't wait again
+        # until a slot frees up
+        self._stalled = False
+
+    def publish(self, message: str):
+        """Publish `message`, blocking while `max_in_flight` messages are unconfirmed."""
+        self.published += 1
+        self._send(message, 1, time.monotonic() + self.timeout_seconds)
+
+    def _send(self, message: str, attempt: int, deadline: float):
+        timeout = 0 if self._stalled else max(deadline - time.monotonic(), 0)
+        self._stalled = not self._slots.acquire(timeout=timeout)
+        if self._stalled:
+            self.failures.append(
+                (
+                    message,
+                    TimeoutError(
+                        f"no publish slot freed up within {self.timeout_seconds} seconds"
+                    ),
+                )
+            )
+            return
+
+        try:
+            future = self.publish_fn(message, self.topic)
+        except Exception as e:
+            self._slots.release()
+            self._failed(message, attempt, e)
+            return
+
+        if future is None:
+            self._slots.release()
+            return
+
+        self._futures.append((message, attempt, future))
+        future.add_done_callback(lambda _: self._slots.release())
+
+    def _failed(self, message: str, attempt: int, error: Exception):
+        if isinstance(error, _TRANSIENT_PUBLISH_ERRORS) and attempt < self.max_attempts:
+            self._retries.append((message, attempt + 1, error))
+        else:
+            self.failures.append((message, error))
+
+    def wait(
+        self, timeout_seconds: Optional[float] = None
+    ) -> List[Tuple[str, Exception]]:
+        """
+        Block until every published message is confirmed or has failed, returning (message, error)
+        failures. Transient failures are republished after a jittered exponential backoff, and
+        messages still unconfirmed or waiting to be retried after `timeout_seconds` (by default,
+        the publisher's `timeout_seconds`) are failures.
+        """
+        if timeout_seconds is None:
+            timeout_seconds = self.timeout_seconds
+        deadline = time.monotonic() + timeout_seconds
+        while self._futures or self._retries:
+            futures, self._futures = self._futures, []
+            for message, attempt, future in futures:
+                try:
+                    future.result(timeout=max(deadline - time.monotonic(), 0))
+                except (TimeoutError, FutureTimeoutError):
+                    self.failures.append(
+                        (
+                            message,
+                            TimeoutError(
+                                f"not confirmed within {timeout_seconds} seconds"
+                            ),
+                        )
+                    )
+                except Exception as e:
+                    self._failed(message, attempt, e)
+
+            if not self._retries:
+                break
+            retries, self._retries = self._retries, []
+            attempt = max(attempt for _, attempt, _ in retries)
+            delay = PUBSUB_PUBLISH_RETRY_DELAY_SECONDS * 2 ** (attempt - 2)
+            delay *= random.uniform(0.5, 1.5)
+            if time.monotonic() + delay > deadline:
+                self.failures.extend((message, error) for message, _, error in retries)
+                break
+            time.sleep(delay)
+            for message, attempt, _ in retries:
+                self.retried += 1
+                self._send(message, attempt, deadline)
+
+        return list(self.failures)
+
+    def summary(self) -> str:
+        """Describe how publishing went, e.g. to log once `wait` returns."""
+        return (
+            f"{self.published - len(self.failures)} of {self.published} {self.topic} messages "
+            f"confirmed ({self.retried} retries, {len(self.failures)} failed)"
+        )
+
+
+def publish_artifact_upload_batches(
+    publish_fn: Callable[[str, str], Any], object_urls: List[str]
+):
+    """
+    Publish `object_urls` to the artifact_upload topic with `publish_fn` (as for `BatchPublisher`)
+    in batches of VIS_PREPROCESSING_BATCH_SIZE, so that vis_preprocessing handles several files
+    per invocation. Transient failures are retried, and the rest are logged, since the files
+    themselves have already been saved.
+    """
+    publisher = BatchPublisher(publish_fn, GOOGLE_ARTIFACT_UPLOAD_TOPIC)
+    for i in range(0, len(object_urls), VIS_PREPROCESSING_BATCH_SIZE):
+        batch = object_urls[i : i + VIS_PREPROCESSING_BATCH_SIZE]
+        publisher.publish(encode_pubsub_message({"object_urls": batch}))
+
+    failures = publisher.wait()
+    print(publisher.summary())
+    if failures:
+        print(
+            f"Failed to publish {len(failures)} of {publisher.published} artifact_upload messages: "
+            + ", ".join(repr(e) for _, e in failures)
+        )
+
+
+# budgeted workers are forked from a single-threaded server process, started by the first
+# `run_with_budget` call with the module defining the function it runs (and so pandas,
+# clustergrammer, etc.) already imported, so each worker starts quickly
+_worker_context = None
+_worker_context_lock = threading.Lock()
+
+
+def _get_worker_context(fn: Callable):
+    global _worker_context
+    with _worker_context_lock:
+        if _worker_context is None:
+            _worker_context = multiprocessing.get_context("forkserver")
+            _worker_context.set_forkserver_preload([fn.__module__])
+        return _worker_context
+
+
+class BudgetExceeded(Exception):
+    """Raised when a function run with `run_with_budget` exceeds its time or memory budget."""
+
+
+def run_with_budget(
+    fn: Callable, *args, timeout_seconds: float, max_memory_bytes: int
+) -> Any:
+    """
+    Run `fn(*args)` in a worker process, returning its result. The worker may grow its
+    address space by at most `max_memory_bytes`, and is killed after `timeout_seconds`;
+    either raises BudgetExceeded. Other exceptions raised by `fn` are re-raised here.
+
+    `fn`, `args` and the result are pickled between processes, so `fn` must be
+    defined at module level.
+    """
+    worker_context = _get_worker_context(fn)
+    receiver, sender = worker_context.Pipe(duplex=False)
+    worker = worker_context.Process(
+        target=_budgeted_worker,
+        args=(sender, max_memory_bytes, fn, args),
+        daemon=True,
+    )
+    worker.start()
+    sender.close()
+    try:
+        if not receiver.poll(timeout_seconds):
+            raise BudgetExceeded(
+                f"{fn.__name__} exceeded its {timeout_seconds}s time budget"
+            )
+        try:
+            status, value = receiver.recv()
+        except EOFError:
+            # the worker died without reporting back, e.g. killed for using too much memory
+            worker.join()
+            raise BudgetExceeded(
+                f"{fn.__name__} worker exited unexpectedly with code {worker.exitcode}"
+            )
+    finally:
+        receiver.close()
+        if worker.is_alive():
+            worker.kill()
+        worker.join()
+
+    if status == "memory":
+        raise BudgetExceeded(
+            f"{fn.__name__} exceeded its {max_memory_bytes} byte memory budget"
+        )
+    if status == "error":
+        raise value
+    return value
+
+
+def _budgeted_worker(sender, max_memory_bytes: int, fn: Callable, args: tuple):
+    """Run `fn(*args)` under an address space limit, sending back (status, value)."""
+    with open("/proc/self/statm") as statm:
+        address_space_bytes = int(statm.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+    resource.setrlimit(
+        resource.RLIMIT_AS, (address_space_bytes + max_memory_bytes, hard_limit)
+    )
+
+    try:
+        result = ("ok", fn(*args))
+    except MemoryError:
+        result = ("memory", None)
+    except Exception as e:
+        result = ("error", e)
+
+    try:
+        sender.send(result)
+    except Exception as e:
+        # e.g., the result or exception couldn't be pickled
+        sender.send(("error", RuntimeError(f"{fn.__name__} worker failed: {e!r}")))
+    sender.close()
+
+
 class BackgroundContext(NamedTuple):
     """
     Model of the context object passed to a background cloud function.
@@ -71,43 +432,149 @@ class BackgroundContext(NamedTuple):
     resource: str
 
 
+def get_storage_client() -> storage.Client:
+    """Get the GCS client shared by all functions running on this instance."""
+    global _storage_client
+    if _storage_client is None:
+        with _storage_lock:
+            if _storage_client is None:
+                _storage_client = storage.Client()
+    return _storage_client
+
+
+def get_bucket(bucket_name: str) -> storage.Bucket:
+    """
+    Get a handle to the GCS bucket `bucket_name`. The bucket's metadata is only
+    fetched from GCS if we haven't done so in the last GOOGLE_BUCKET_CACHE_TTL_SECONDS.
+    """
+    now = time.monotonic()
+    with _storage_lock:
+        cached = _bucket_cache.get(bucket_name)
+        if cached and now - cached[0] < GOOGLE_BUCKET_CACHE_TTL_SECONDS:
+            return cached[1]
+
+    bucket = get_storage_client().get_bucket(bucket_name)
+    with _storage_lock:
+        _bucket_cache[bucket_name] = (now, bucket)
+    return bucket
+
+
+def clear_storage_cache():
+    """Drop the shared GCS client and any cached bucket handles."""
+    global _storage_client
+    with _storage_lock:
+        _storage_client = None
+        _bucket_cache.clear()
+
+
 def get_blob_as_stream(
-    object_name: str, as_string: bool = False
-) -> Union[BytesIO, StringIO]:
-    """Download data from the CIDC data bucket as a byte or string stream."""
+    object_name: str, as_string: bool = False, streaming: bool = False
+) -> Union[BytesIO, StringIO, IO]:
+    """
+    Download data from the CIDC data bucket as a byte or string stream.
+
+    If `streaming` is True, the blob is downloaded in BLOB_DOWNLOAD_CHUNK_SIZE ranged
+    reads straight into the returned stream, which is backed by a temporary file on disk
+    for blobs larger than BLOB_SPOOL_MAX_MEMORY_BYTES. This avoids holding several copies
+    of a large file in memory at once.
+    """
+    if streaming:
+        return stream_blob(get_data_blob(object_name), as_string=as_string)
+
     file_bytes = _download_blob_bytes(object_name)
     if as_string:
         return StringIO(file_bytes.decode("utf-8"))
     return BytesIO(file_bytes)
 
 
-def _download_blob_bytes(object_name: str) -> bytes:
+def get_data_blob(object_name: str) -> storage.Blob:
     """
-    Download a blob as bytes from GCS. Throws a FileNotFound exception
+    Get GCS metadata for a blob in the CIDC data bucket. Throws a FileNotFound exception
     if the object doesn't exist.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(GOOGLE_ACL_DATA_BUCKET)
+    bucket = get_bucket(GOOGLE_ACL_DATA_BUCKET)
     blob = bucket.get_blob(object_name)
     if not blob:
-        FileNotFoundError(
+        raise FileNotFoundError(
             f"Could not find file {object_name} in {GOOGLE_ACL_DATA_BUCKET}"
         )
-    return blob.download_as_string()
+    return blob
+
+
+def _download_blob_bytes(object_name: str) -> bytes:
+    """
+    Download a blob as bytes from GCS. Throws a FileNotFound exception
+    if the object doesn't exist.
+    """
+    return get_data_blob(object_name).download_as_string()
+
+
+def stream_blob(blob: storage.Blob, as_string: bool = False) -> IO:
+    """
+    Download `blob` in chunks into an in-memory buffer, or into a temporary file
+    on disk if the blob is larger than BLOB_SPOOL_MAX_MEMORY_BYTES.
+    """
+    # setting a chunk size makes the client fetch the object with ranged requests,
+    # writing each chunk out as it arrives
+    blob.chunk_size = BLOB_DOWNLOAD_CHUNK_SIZE
+
+    if blob.size is not None and blob.size <= BLOB_SPOOL_MAX_MEMORY_BYTES:
+        spool = BytesIO()
+    else:
+        spool = TemporaryFile()
+
+    try:
+        blob.download_to_file(spool)
+    except:
+        spool.close()
+        raise
+    spool.seek(0)
+
+    if as_string:
+        return TextIOWrapper(spool, encoding="utf-8")
+    return spool
 
 
-def upload_to_data_bucket(object_name: str, data: Union[str, bytes]) -> storage.Blob:
-    """Upload data to blob called `object_name` in the CIDC data bucket."""
+def upload_to_data_bucket(
+    object_name: str, data: Union[str, bytes], metadata: Optional[dict] = None
+) -> storage.Blob:
+    """
+    Upload data to blob called `object_name` in the CIDC data bucket,
+    with optional custom `metadata` on the blob.
+    """
     if ENV == "dev":
         fname = object_name.replace("/", "_")
         print(f"writing {fname}")
-        with open(fname, "w") as f:
+        with open(fname, "wb" if isinstance(data, bytes) else "w") as f:
             f.write(data)
         return make_pseudo_blob(fname)
 
-    client = storage.Client()
-    bucket = client.get_bucket(GOOGLE_ACL_DATA_BUCKET)
+    bucket = get_bucket(GOOGLE_ACL_DATA_BUCKET)
     blob = bucket.blob(object_name)
+    if metadata:
+        blob.metadata = metadata
     blob.upload_from_string(data)
 
     return blob
+
+
+def get_internal_blob(object_name: str) -> Optional[storage.Blob]:
+    """
+    Get GCS metadata for a blob stored for internal use (e.g., a cache entry) in the upload
+    bucket, which users can't read, or None if the object doesn't exist.
+    """
+    return get_bucket(GOOGLE_UPLOAD_BUCKET).get_blob(object_name)
+
+
+def upload_to_internal_bucket(
+    object_name: str, data: Union[str, bytes], metadata: Optional[dict] = None
+) -> storage.Blob:
+    """
+    Upload data for internal use to blob called `object_name` in the upload bucket,
+    with optional custom `metadata` on the blob.
+    """
+    blob = get_bucket(GOOGLE_UPLOAD_BUCKET).blob(object_name)
+    if metadata:
+        blob.metadata = metadata
+    blob.upload_from_string(data)
+    return blob
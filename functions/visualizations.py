@@ -1,6 +1,14 @@
+import hashlib
 import json
-from io import BytesIO
-from typing import Optional
+import logging
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO, StringIO
+from itertools import islice
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
 
 # clustergrammer2 via sklearn uses np.float which is deprecated as of numpy==1.20
 import warnings
@@ -8,62 +16,267 @@ import warnings
 warnings.filterwarnings(
     action="ignore", category=DeprecationWarning, module="scikit-learn"
 )
+import numpy as np
 import pandas as pd
 
-from clustergrammer2 import Network as CGNetwork
-from deepdiff import DeepSearch
+from clustergrammer2 import Network as CGNetwork, __version__ as CG_VERSION
 from openpyxl import load_workbook
 from cidc_api.models import DownloadableFiles, prism, TrialMetadata
 
+from .settings import (
+    ARTIFACT_INDEX_CACHE_MAX_ENTRIES,
+    CLUSTERGRAMMER_CACHE_PREFIX,
+    CLUSTERGRAMMER_MAX_COLUMNS,
+    CLUSTERGRAMMER_MAX_ROWS,
+    ENV,
+    IHC_COMBINED_PLOT_FORMAT,
+    METADATA_DF_CACHE_MAX_BYTES,
+    METADATA_DF_CACHE_MAX_ENTRIES,
+    METADATA_SNAPSHOT_PREFIX,
+    VIS_CLUSTERING_ISOLATED,
+    VIS_CLUSTERING_MAX_MEMORY_BYTES,
+    VIS_CLUSTERING_SKIPPED_PREFIX,
+    VIS_CLUSTERING_TIMEOUT_SECONDS,
+)
 from .util import (
     BackgroundContext,
+    BudgetExceeded,
+    decode_pubsub_message,
     extract_pubsub_data,
     sqlalchemy_session,
     get_blob_as_stream,
+    get_data_blob,
+    get_internal_blob,
+    stream_blob,
+    run_with_budget,
+    upload_to_internal_bucket,
 )
 
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+logger.setLevel(logging.DEBUG if ENV == "dev" else logging.INFO)
+
 
 # sets the maximum number of divisions within a category
 ## that is shown on the top of the clustergrammer
 CLUSTERGRAMMER_MAX_CATEGORY_CARDINALITY = 5
 
 
+# batch messages list the object URLs of several files to process together
+VIS_PREPROCESSING_SCHEMA = {"object_urls": (list,)}
+
+
 def vis_preprocessing(event: dict, context: BackgroundContext):
+    """
+    Generate visualization data for downloadable files. The message is either a single
+    object URL, or a pub/sub message like `{"object_urls": [...]}` for a batch of files
+    (e.g., from one upload), which share metadata lookups and are committed together.
+    A file that fails is logged and skipped, so it doesn't hold back the rest of its batch;
+    once the rest are saved, an error listing the files that failed is raised.
+    """
+    object_urls = _get_object_urls(extract_pubsub_data(event))
+
     with sqlalchemy_session() as session:
-        object_url = extract_pubsub_data(event)
-        file_record: DownloadableFiles = DownloadableFiles.get_by_object_url(
-            object_url, session=session
-        )
+        transforms = _get_transforms()
+        transform_context = _TransformContext(session)
+        metadata_dfs = {}
+        failures = []
+        for object_url in object_urls:
+            try:
+                file_record = DownloadableFiles.get_by_object_url(
+                    object_url, session=session
+                )
+                if not file_record:
+                    raise Exception(
+                        f"No downloadable file with object URL {object_url} found."
+                    )
 
-        if not file_record:
-            raise Exception(f"No downloadable file with object URL {object_url} found.")
+                if file_record.trial_id not in metadata_dfs:
+                    metadata_dfs[file_record.trial_id] = _get_metadata_df(
+                        file_record.trial_id
+                    )
+                metadata_df = metadata_dfs[file_record.trial_id]
 
-        metadata_df = _get_metadata_df(file_record.trial_id)
+                vis_jsons = _apply_transforms(
+                    transforms, file_record, metadata_df, transform_context
+                )
+            except Exception as e:
+                logger.error(
+                    f"Error generating visualization data for {object_url}: {e!r}",
+                    exc_info=True,
+                )
+                failures.append((object_url, e))
+                continue
 
-        # Apply the transformations and get derivative data for visualization.
-        for transform_name, transform in _get_transforms().items():
-            vis_json = transform(file_record, metadata_df)
-            if vis_json:
-                # Add the vis config to the file_record
+            # Add the vis configs to the file_record
+            for transform_name, vis_json in vis_jsons.items():
                 setattr(file_record, transform_name, vis_json)
 
         # Save the derivative data additions to the database.
-        session.commit()
+        if len(failures) < len(object_urls):
+            session.commit()
+
+        if failures:
+            raise Exception(
+                f"Failed to generate visualization data for {len(failures)} of {len(object_urls)} files: "
+                + ", ".join(object_url for object_url, _ in failures)
+                + f" (first error: {failures[0][1]!r})"
+            ) from failures[0][1]
+
+
+def _apply_transforms(
+    transforms: dict,
+    file_record: DownloadableFiles,
+    metadata_df: pd.DataFrame,
+    transform_context: "_TransformContext",
+) -> Dict[str, dict]:
+    """
+    Apply the transformations and get derivative data for visualization, by transform name.
+    They're independent, so run them concurrently; clustering runs in its own
+    process, and only `_add_antibody_metadata` uses the session.
+    """
+    with ThreadPoolExecutor(max_workers=len(transforms)) as executor:
+        futures = {
+            transform_name: executor.submit(
+                transform, file_record, metadata_df, transform_context
+            )
+            for transform_name, transform in transforms.items()
+        }
+    vis_jsons = {}
+    for transform_name, future in futures.items():
+        vis_json = future.result()
+        if vis_json:
+            vis_jsons[transform_name] = vis_json
+    return vis_jsons
+
+
+def _get_object_urls(data: str) -> List[str]:
+    """Get the object URLs listed in a vis_preprocessing message."""
+    # single-file messages are just the object URL
+    if not data.startswith("{"):
+        return [data]
+
+    message = decode_pubsub_message(data, schema=VIS_PREPROCESSING_SCHEMA)
+    if "object_urls" not in message:
+        raise ValueError(f"vis_preprocessing message has no object_urls: {data!r}")
+    return message["object_urls"]
+
+
+class MetadataDFCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    entries: int
+    size_bytes: int
+
+
+class _MetadataDFCache:
+    """
+    Per-instance LRU cache of metadata dataframes, keyed on trial ID and the GCS generations
+    of the participants.csv and samples.csv they were built from, so a rewrite of either file
+    is never served stale. Bounded by both entry count and estimated dataframe memory.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, Tuple[pd.DataFrame, int]]" = OrderedDict()
+        self._size_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[pd.DataFrame]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: tuple, metadata_df: pd.DataFrame):
+        size_bytes = int(metadata_df.memory_usage(deep=True).sum())
+        with self._lock:
+            # older generations of this trial's files won't be requested again
+            self._evict(lambda k: k[0] == key[0])
+            if size_bytes > self.max_bytes:
+                return
+            self._entries[key] = (metadata_df, size_bytes)
+            self._size_bytes += size_bytes
+            while (
+                len(self._entries) > self.max_entries
+                or self._size_bytes > self.max_bytes
+            ):
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._size_bytes -= evicted_bytes
+
+    def invalidate(self, trial_id: Optional[str] = None):
+        with self._lock:
+            self._evict(lambda k: trial_id is None or k[0] == trial_id)
+
+    def info(self) -> MetadataDFCacheInfo:
+        with self._lock:
+            return MetadataDFCacheInfo(
+                self._hits, self._misses, len(self._entries), self._size_bytes
+            )
+
+    def _evict(self, should_evict):
+        for key in [k for k in self._entries if should_evict(k)]:
+            _, evicted_bytes = self._entries.pop(key)
+            self._size_bytes -= evicted_bytes
+
+
+_metadata_df_cache = _MetadataDFCache(
+    METADATA_DF_CACHE_MAX_ENTRIES, METADATA_DF_CACHE_MAX_BYTES
+)
+
+
+def metadata_df_cache_info() -> MetadataDFCacheInfo:
+    """Get hit/miss counts and the current size of this instance's metadata dataframe cache."""
+    return _metadata_df_cache.info()
+
+
+def invalidate_metadata_df_cache(trial_id: Optional[str] = None):
+    """
+    Drop cached metadata dataframes for `trial_id`, or for every trial if None. This only frees
+    memory: entries are keyed on CSV generations, so rewritten CSVs are never served stale.
+    """
+    _metadata_df_cache.invalidate(trial_id)
 
 
 def _get_metadata_df(trial_id: str) -> pd.DataFrame:
     """
     Build a dataframe containing the participant/sample metadata for this trial,
-    joined on CIMAC ID and indexed on CIMAC ID.
+    joined on CIMAC ID and indexed on CIMAC ID. This is read from the trial's metadata
+    snapshot if it's up to date, and otherwise built from the participants/samples CSVs.
+
+    Dataframes are cached for as long as the underlying CSVs are unchanged, so callers
+    must not modify the dataframe returned.
     """
-    participants_blob = get_blob_as_stream(
-        f"{trial_id}/participants.csv", as_string=True
-    )
-    samples_blob = get_blob_as_stream(f"{trial_id}/samples.csv", as_string=True)
+    participants_blob = get_data_blob(f"{trial_id}/participants.csv")
+    samples_blob = get_data_blob(f"{trial_id}/samples.csv")
+
+    cache_key = (trial_id, participants_blob.generation, samples_blob.generation)
+    metadata_df = _metadata_df_cache.get(cache_key)
+    if metadata_df is not None:
+        return metadata_df
+
+    metadata_df = _read_metadata_snapshot(trial_id, participants_blob, samples_blob)
+    if metadata_df is None:
+        metadata_df = _merge_metadata(
+            pd.read_csv(stream_blob(participants_blob, as_string=True)),
+            pd.read_csv(stream_blob(samples_blob, as_string=True)),
+        )
+
+    _metadata_df_cache.put(cache_key, metadata_df)
+    return metadata_df
 
-    participants_df = pd.read_csv(participants_blob)
-    samples_df = pd.read_csv(samples_blob)
 
+def _merge_metadata(
+    participants_df: pd.DataFrame, samples_df: pd.DataFrame
+) -> pd.DataFrame:
+    """Join participants and samples dataframes, indexed on CIMAC ID."""
     metadata_df = pd.merge(
         participants_df,
         samples_df,
@@ -72,14 +285,185 @@ def _get_metadata_df(trial_id: str) -> pd.DataFrame:
         how="outer",
     )
     metadata_df.set_index("cimac_id", inplace=True)
+    return _normalize_metadata_df(metadata_df)
 
+
+def _normalize_metadata_df(metadata_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Give `metadata_df`'s object columns the same values whether it was built from the CSVs
+    or read from a metadata snapshot: missing values are NaN (Parquet reads them as None),
+    and columns mixing strings with other values (which Parquet can't store) are all strings.
+    """
+    for i in np.flatnonzero((metadata_df.dtypes == object).to_numpy()):
+        values = metadata_df.iloc[:, i].to_numpy(dtype=object, copy=True)
+        missing = pd.isna(values)
+        if not all(type(v) is str for v in values[~missing]):
+            values[~missing] = values[~missing].astype(str)
+        values[missing] = np.nan
+        metadata_df.iloc[:, i] = values
     return metadata_df
 
 
+# metadata snapshots, like clustergrammer configs, aren't cached in dev
+_metadata_snapshots_enabled = ENV != "dev"
+
+
+def _metadata_snapshot_generations(participants_blob, samples_blob) -> dict:
+    """The custom blob metadata tying a metadata snapshot to the CSVs it was built from."""
+    return {
+        "participants_generation": str(participants_blob.generation),
+        "samples_generation": str(samples_blob.generation),
+    }
+
+
+def _read_metadata_snapshot(
+    trial_id: str, participants_blob, samples_blob
+) -> Optional[pd.DataFrame]:
+    """
+    Read the trial's metadata snapshot, or return None if it doesn't exist, can't be read,
+    or wasn't built from the current versions of `participants_blob` and `samples_blob`.
+    """
+    if not _metadata_snapshots_enabled:
+        return None
+
+    try:
+        snapshot_blob = get_internal_blob(
+            f"{METADATA_SNAPSHOT_PREFIX}{trial_id}.parquet"
+        )
+        if snapshot_blob is None:
+            return None
+        if snapshot_blob.metadata != _metadata_snapshot_generations(
+            participants_blob, samples_blob
+        ):
+            print(f"Metadata snapshot for {trial_id} is out of date")
+            return None
+        return _normalize_metadata_df(pd.read_parquet(stream_blob(snapshot_blob)))
+    except Exception as e:
+        # the snapshot is only an optimization, so fall back to the CSVs
+        print(f"Error reading metadata snapshot for {trial_id}: {e!r}")
+        return None
+
+
+def update_metadata_snapshot(
+    trial_id: str,
+    participants_blob,
+    participants_csv: str,
+    samples_blob,
+    samples_csv: str,
+):
+    """
+    Update the trial's metadata snapshot from newly uploaded participants/samples CSVs
+    (`*_csv` being the contents of `*_blob`). If the merged metadata hasn't changed, only
+    the snapshot's record of the CSV versions it matches is updated.
+    Errors are logged rather than raised, since `_get_metadata_df` can always use the CSVs.
+    """
+    if not _metadata_snapshots_enabled:
+        return
+
+    snapshot_name = f"{METADATA_SNAPSHOT_PREFIX}{trial_id}.parquet"
+    generations = _metadata_snapshot_generations(participants_blob, samples_blob)
+    try:
+        metadata_df = _merge_metadata(
+            pd.read_csv(StringIO(participants_csv)), pd.read_csv(StringIO(samples_csv))
+        )
+
+        snapshot_blob = get_internal_blob(snapshot_name)
+        if snapshot_blob is not None and metadata_df.equals(
+            _normalize_metadata_df(pd.read_parquet(stream_blob(snapshot_blob)))
+        ):
+            print(f"Metadata snapshot for {trial_id} is unchanged")
+            snapshot_blob.metadata = generations
+            snapshot_blob.patch()
+            return
+
+        upload_to_internal_bucket(
+            snapshot_name, metadata_df.to_parquet(), metadata=generations
+        )
+        print(f"Wrote metadata snapshot for {trial_id}")
+    except Exception as e:
+        print(f"Error updating metadata snapshot for {trial_id}: {e!r}")
+
+
+class _TransformContext:
+    """
+    State shared by all the transforms run in one vis_preprocessing invocation:
+    its database session, and trial metadata loaded at most once per trial.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._trials: Dict[str, TrialMetadata] = {}
+
+    def get_trial_metadata(self, trial_id: str) -> dict:
+        """Get the metadata JSON for `trial_id`, loading it on first use."""
+        return self._get_trial(trial_id).metadata_json
+
+    def get_artifact_index(self, trial_id: str) -> Dict[str, List[Tuple[str, int]]]:
+        """
+        Get the `_build_artifact_index` index for `trial_id`'s metadata, reusing
+        the index from earlier invocations while the metadata is unchanged.
+        """
+        trial = self._get_trial(trial_id)
+        # key on the metadata itself, since it can be rewritten without changing the trial's _etag
+        metadata_hash = hashlib.sha256(
+            json.dumps(trial.metadata_json, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        cache_key = (trial_id, metadata_hash)
+        if cache_key in _artifact_index_cache:
+            _artifact_index_cache.move_to_end(cache_key)
+        else:
+            _artifact_index_cache[cache_key] = _build_artifact_index(
+                trial.metadata_json
+            )
+            while len(_artifact_index_cache) > ARTIFACT_INDEX_CACHE_MAX_ENTRIES:
+                _artifact_index_cache.popitem(last=False)
+        return _artifact_index_cache[cache_key]
+
+    def _get_trial(self, trial_id: str) -> TrialMetadata:
+        if trial_id not in self._trials:
+            self._trials[trial_id] = TrialMetadata.find_by_trial_id(
+                trial_id, session=self.session
+            )
+        return self._trials[trial_id]
+
+
+_artifact_index_cache: "OrderedDict[Tuple[str, str], dict]" = OrderedDict()
+
+
+def _build_artifact_index(trial_metadata: dict) -> Dict[str, List[Tuple[str, int]]]:
+    """
+    Map each object URL in `trial_metadata["assays"]` to the (assay type, instance index)
+    of every assay instance it appears in, for assays with a list of instances.
+    """
+    index: Dict[str, List[Tuple[str, int]]] = {}
+    for assay_type, assay_instances in trial_metadata.get("assays", {}).items():
+        if not isinstance(assay_instances, list):
+            continue
+        for i, assay_instance in enumerate(assay_instances):
+            for object_url in _iter_object_urls(assay_instance):
+                index.setdefault(object_url, []).append((assay_type, i))
+    return index
+
+
+def _iter_object_urls(metadata) -> Iterator[str]:
+    """Yield every `object_url` value nested anywhere within `metadata`."""
+    stack = [metadata]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == "object_url" and isinstance(value, str):
+                    yield value
+                elif isinstance(value, (dict, list)):
+                    stack.append(value)
+        elif isinstance(node, list):
+            stack.extend(node)
+
+
 def _get_transforms() -> dict:
     """
-    Get a list of functions taking an open file and
-    that file's downloadable file record as arguments, returning
+    Get a list of functions taking a downloadable file record, the metadata dataframe
+    for its trial, and an optional `_TransformContext` as arguments, returning
     a JSON blob that the frontend will use for visualization.
     """
     return {
@@ -90,7 +474,9 @@ def _get_transforms() -> dict:
 
 
 def _add_antibody_metadata(
-    file_record: DownloadableFiles, metadata_df: pd.DataFrame
+    file_record: DownloadableFiles,
+    metadata_df: pd.DataFrame,
+    context: Optional[_TransformContext] = None,
 ) -> Optional[dict]:
     """
     Pseudo transformation to add antibody data to the DownloadableFiles.additional_metadata JSON
@@ -107,10 +493,13 @@ def _add_antibody_metadata(
     if upload_type not in transforms.keys():
         return None
 
-    with sqlalchemy_session() as session:
-        ct_md = TrialMetadata.find_by_trial_id(
-            file_record.trial_id, session=session
-        ).metadata_json
+    if context is None:
+        with sqlalchemy_session() as session:
+            return _add_antibody_metadata(
+                file_record, metadata_df, _TransformContext(session)
+            )
+
+    ct_md = context.get_trial_metadata(file_record.trial_id)
 
     assay_instances = ct_md.get("assays", {}).get(upload_type, [])
     # asserting that this will return a list, which is not necessarily true
@@ -120,29 +509,21 @@ def _add_antibody_metadata(
         # only exception to list, eg olink
         assay_md = assay_instances
     elif isinstance(assay_instances, list):
-        ds = DeepSearch(assay_instances, file_record.object_url)
-        if "matched_values" in ds:
-            if len(ds["matched_values"]) != 1:
-                raise Exception(
-                    f"Issue loading antibodies for {file_record.object_url} in {file_record.trial_id}: {file_record.object_url} is not unique in ct['assays'][{upload_type}]"
-                )
-
-            # matched_value = ["root[path][to][matching]"]
-            matching_path = list(ds["matched_values"])[0]
-            index = matching_path.split("[")[1].split("]")[0]
-            if index.isdigit():  # not technically needed, see below
-                assay_md = assay_instances[int(index)]
-            else:
-                # technically can't get here because DeepSearch on assay_instances: list has return bounded to "root[ int ]..."
-                # if some error occurs, need to error or need assay_md defined
-                # testing this doesn't seem necessary, but would likely need patching DeepSearch
-                try:
-                    assay_md = assay_instances[index]  # should work for all root[...]
-                except:
-                    # add a bit of actual context, as any IndexError thrown would not be useful
-                    raise Exception(
-                        f"Issue loading antibodies for {file_record.object_url} in {file_record.trial_id}: unable to search ct['assays']['{upload_type}']"
-                    )
+        artifact_index = context.get_artifact_index(file_record.trial_id)
+        matching_indexes = [
+            i
+            for assay_type, i in artifact_index.get(file_record.object_url, [])
+            if assay_type == upload_type
+        ]
+        if len(matching_indexes) > 1:
+            raise Exception(
+                f"Issue loading antibodies for {file_record.object_url} in {file_record.trial_id}: {file_record.object_url} is not unique in ct['assays'][{upload_type}]"
+            )
+        if not matching_indexes:
+            raise Exception(
+                f"Issue loading antibodies for {file_record.object_url} in {file_record.trial_id}: {file_record.object_url} not found in ct['assays'][{upload_type}]"
+            )
+        assay_md = assay_instances[matching_indexes[0]]
 
     else:
         raise TypeError(
@@ -243,53 +624,184 @@ def _mif_antibody_md(assay_md: dict) -> Optional[str]:
 
 
 def _ihc_combined_transform(
-    file_record: DownloadableFiles, metadata_df: pd.DataFrame
+    file_record: DownloadableFiles,
+    metadata_df: pd.DataFrame,
+    context: Optional[_TransformContext] = None,
 ) -> Optional[dict]:
     """
-    Prepare an IHC combined file for visualization by joining it with relevant metadata
+    Prepare an IHC combined file for visualization by joining it with relevant metadata,
+    in the format given by IHC_COMBINED_PLOT_FORMAT.
     """
     if file_record.upload_type.lower() != "ihc marker combined":
         return None
 
     print(f"Generating IHC combined visualization config for file {file_record.id}")
-    data_file = get_blob_as_stream(file_record.object_url)
+    data_file = get_blob_as_stream(file_record.object_url, streaming=True)
 
     data_df = pd.read_csv(data_file)
     full_df = data_df.join(metadata_df, on="cimac_id", how="inner")
 
+    if IHC_COMBINED_PLOT_FORMAT == "columnar":
+        return _to_columnar(full_df)
     return json.loads(full_df.to_json(orient="records"))
 
 
+def _to_columnar(df: pd.DataFrame) -> dict:
+    """
+    Convert `df` (ignoring its index) to a JSON-serializable columnar dict, e.g.
+    {
+        "format": "columnar",
+        "columns": ["cimac_id", "foo", "cohort_name"],
+        "data": [["CTTTTPPS1.01", "CTTTTPPS2.01"], [1, 3], [0, 0]],
+        "categories": {"cohort_name": ["Arm_A"]},
+    }
+    String columns with fewer distinct values than half their length are dictionary-encoded:
+    their data are indexes into their "categories". Missing values are None.
+    """
+    columns, data, categories = [], [], {}
+    for name, series in df.items():
+        name = str(name)
+        columns.append(name)
+
+        if series.dtype == object:
+            codes, levels = pd.factorize(series)
+            if len(levels) < len(series) / 2:
+                categories[name] = levels.tolist()
+                values = codes.astype(object)
+                values[codes == -1] = None
+                data.append(values.tolist())
+                continue
+
+        values = series.to_numpy()
+        if series.hasnans:
+            values = values.astype(object)
+            values[series.isna().to_numpy()] = None
+        data.append(values.tolist())
+
+    return {
+        "format": "columnar",
+        "columns": columns,
+        "data": data,
+        "categories": categories,
+    }
+
+
+class _ClustergrammerCache:
+    """
+    Clustergrammer configs stored as JSON in the upload bucket, out of users' reach, keyed on
+    a hash of everything that determines them, so reprocessing an unchanged file skips
+    downloading and clustering it. Disabled in dev.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(
+        data_fingerprint: str, metadata_fingerprint: str, limits: tuple
+    ) -> str:
+        content = json.dumps(
+            [data_fingerprint, metadata_fingerprint, limits, CG_VERSION]
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            blob = get_internal_blob(f"{CLUSTERGRAMMER_CACHE_PREFIX}{key}.json")
+            viz = json.loads(blob.download_as_string()) if blob else None
+        except Exception as e:
+            # the cache is only an optimization, so never let it fail the transform
+            print(f"Error reading clustergrammer cache entry {key}: {e!r}")
+            viz = None
+
+        if viz is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        print(
+            f"Clustergrammer cache {'hit' if viz is not None else 'miss'} for {key} "
+            f"({self.hits} hits, {self.misses} misses on this instance)"
+        )
+        return viz
+
+    def put(self, key: str, viz: dict):
+        try:
+            upload_to_internal_bucket(
+                f"{CLUSTERGRAMMER_CACHE_PREFIX}{key}.json", json.dumps(viz)
+            )
+        except Exception as e:
+            print(f"Error writing clustergrammer cache entry {key}: {e!r}")
+
+
+_clustergrammer_cache = _ClustergrammerCache(enabled=ENV != "dev")
+
+
+def _metadata_fingerprint(metadata_df: pd.DataFrame) -> str:
+    """Hash the column names, index and values of a trial's metadata dataframe."""
+    digest = hashlib.sha256(json.dumps([str(c) for c in metadata_df.columns]).encode())
+    digest.update(pd.util.hash_pandas_object(metadata_df, index=True).values.tobytes())
+    return digest.hexdigest()
+
+
 class _ClustergrammerTransform:
     def __call__(
-        self, file_record: DownloadableFiles, metadata_df: pd.DataFrame
+        self,
+        file_record: DownloadableFiles,
+        metadata_df: pd.DataFrame,
+        context: Optional[_TransformContext] = None,
     ) -> Optional[dict]:
         """
         Prepare the data file for visualization in clustergrammer.
         NOTE: `metadata_df` should contain data from the participants and samples CSVs
         for this file's trial, joined on CIMAC ID and indexed on CIMAC ID.
+        Configs are cached with `_clustergrammer_cache` for files with checksums.
         """
         if file_record.object_url.endswith("npx.xlsx"):
-            data_file = get_blob_as_stream(file_record.object_url)
-            return self.npx(data_file, metadata_df)
+            prepare = self.npx
         elif file_record.upload_type.lower() in (
             "cell counts compartment",
             "cell counts assignment",
             "cell counts profiling",
         ):
-            data_file = get_blob_as_stream(file_record.object_url)
-            return self.cytof_summary(data_file, metadata_df)
-
-        return None
+            prepare = self.cytof_summary
+        else:
+            return None
 
-    def npx(self, data_file, metadata_df: pd.DataFrame) -> dict:
+        # the file's checksums identify its contents, so the cache is checked before downloading it
+        cache_key = None
+        if (
+            file_record.md5_hash or file_record.crc32c_hash
+        ) and _clustergrammer_cache.enabled:
+            cache_key = _clustergrammer_cache.make_key(
+                f"{file_record.md5_hash}|{file_record.crc32c_hash}",
+                _metadata_fingerprint(metadata_df),
+                (CLUSTERGRAMMER_MAX_ROWS, CLUSTERGRAMMER_MAX_COLUMNS),
+            )
+            viz = _clustergrammer_cache.get(cache_key)
+            if viz is not None:
+                return viz
+
+        data_file = get_blob_as_stream(file_record.object_url, streaming=True)
+        try:
+            viz = prepare(data_file, metadata_df)
+        except BudgetExceeded as e:
+            print(f"Skipping clustergrammer config for {file_record.object_url}: {e}")
+            _record_skipped_clustergrammer(file_record, e)
+            return None
+        if viz is not None and cache_key:
+            _clustergrammer_cache.put(cache_key, viz)
+        return viz
+
+    def npx(self, data_file, metadata_df: pd.DataFrame) -> Optional[dict]:
         """Prepare an NPX file for visualization in clustergrammer"""
         # Load the NPX data into a dataframe.
         npx_df = _npx_to_dataframe(data_file)
 
         return self._clustergrammerify(npx_df, metadata_df)
 
-    def cytof_summary(self, data_file, metadata_df: pd.DataFrame) -> dict:
+    def cytof_summary(self, data_file, metadata_df: pd.DataFrame) -> Optional[dict]:
         """Prepare CyTOF summary csv for visualization in clustergrammer"""
         # Load the CyTOF summary data into a dataframe
         cytof_df = _cytof_summary_to_dataframe(data_file)
@@ -297,10 +809,14 @@ class _ClustergrammerTransform:
 
     def _clustergrammerify(
         self, data_df: pd.DataFrame, metadata_df: pd.DataFrame
-    ) -> dict:
+    ) -> Optional[dict]:
         """
         Produce the clustergrammer config for the given data and metadata dfs.
         `data_df` must be a dataframe with CIMAC ID column headers.
+        Data larger than CLUSTERGRAMMER_MAX_ROWS x CLUSTERGRAMMER_MAX_COLUMNS is reduced
+        with `_downsample` first, and the reduction recorded in the config's "downsampling".
+        If VIS_CLUSTERING_ISOLATED, clustering runs in a worker process, and BudgetExceeded
+        is raised if it exceeds its memory or time budget.
         """
         assert (
             data_df.shape[1] > 1
@@ -311,12 +827,97 @@ class _ClustergrammerTransform:
         # TODO: find a better way to handle missing values
         data_df.fillna(0, inplace=True)
 
-        # Produce a clustergrammer JSON blob for this dataframe.
-        net = CGNetwork()
-        net.load_df(data_df)
-        net.normalize()
-        net.cluster()
-        return net.viz
+        data_df, downsampling = _downsample(
+            data_df, CLUSTERGRAMMER_MAX_ROWS, CLUSTERGRAMMER_MAX_COLUMNS
+        )
+
+        if not VIS_CLUSTERING_ISOLATED:
+            viz = _cluster(data_df)
+        else:
+            viz = run_with_budget(
+                _cluster,
+                data_df,
+                timeout_seconds=VIS_CLUSTERING_TIMEOUT_SECONDS,
+                max_memory_bytes=VIS_CLUSTERING_MAX_MEMORY_BYTES,
+            )
+
+        if downsampling:
+            viz["downsampling"] = downsampling
+        return viz
+
+
+def _record_skipped_clustergrammer(file_record: DownloadableFiles, error: Exception):
+    """
+    Record that `file_record`'s clustergrammer config was skipped in the upload bucket,
+    so skipped files can be found and reprocessed later, e.g. with a larger budget.
+    """
+    if ENV == "dev":
+        return
+
+    record = {
+        "object_url": file_record.object_url,
+        "md5_hash": file_record.md5_hash,
+        "crc32c_hash": file_record.crc32c_hash,
+        "reason": str(error),
+        "skipped_at": datetime.utcnow().isoformat(),
+    }
+    try:
+        upload_to_internal_bucket(
+            f"{VIS_CLUSTERING_SKIPPED_PREFIX}{file_record.object_url}.json",
+            json.dumps(record),
+        )
+    except Exception as e:
+        print(
+            f"Error recording skipped clustergrammer config for {file_record.object_url}: {e!r}"
+        )
+
+
+def _downsample(
+    data_df: pd.DataFrame, max_rows: Optional[int], max_columns: Optional[int]
+) -> Tuple[pd.DataFrame, Optional[dict]]:
+    """
+    Reduce `data_df` to at most `max_rows` rows, keeping those with the highest variance,
+    and at most `max_columns` evenly spaced columns, preserving their order.
+    Returns the reduced dataframe, and a description of the reduction (None if there wasn't one)
+    like {"rows": {"original": 5000, "kept": 1000, "selection": "variance"}}.
+    """
+    downsampling = {}
+
+    num_rows, num_columns = data_df.shape
+    if max_rows is not None and num_rows > max_rows:
+        variances = data_df.var(axis=1, numeric_only=True).values
+        # positions of the highest-variance rows, ties broken by position
+        keep = np.sort(np.argsort(-variances, kind="stable")[:max_rows])
+        data_df = data_df.iloc[keep]
+        downsampling["rows"] = {
+            "original": num_rows,
+            "kept": max_rows,
+            "selection": "variance",
+        }
+
+    if max_columns is not None and num_columns > max_columns:
+        keep = np.linspace(0, num_columns - 1, max_columns).round().astype(int)
+        data_df = data_df.iloc[:, keep]
+        downsampling["columns"] = {
+            "original": num_columns,
+            "kept": max_columns,
+            "selection": "even spacing",
+        }
+
+    if downsampling:
+        print(
+            f"Downsampled {num_rows}x{num_columns} data for clustering: {downsampling}"
+        )
+    return data_df, downsampling or None
+
+
+def _cluster(data_df: pd.DataFrame) -> dict:
+    """Produce a clustergrammer JSON blob for this dataframe."""
+    net = CGNetwork()
+    net.load_df(data_df)
+    net.normalize()
+    net.cluster()
+    return net.viz
 
 
 def _metadata_to_categories(metadata_df: pd.DataFrame) -> list:
@@ -324,14 +925,14 @@ def _metadata_to_categories(metadata_df: pd.DataFrame) -> list:
     Add category information to `data_df`'s column headers in the format that Clustergrammer expects:
         "([Category 1]: [Value 1], [Category 2]: [Value 2], ...)"
     """
-    metadata_df = metadata_df.copy()  # so don't modify original
-
     CLINICAL_FIELD_PREFIX = "arbitrary_trial_specific_clinical_annotations."
-    columns = []
-    for c in metadata_df.columns:
-        # go through and check cardinality = # unique
-        # also rename the columns to pretty things
-        cardinality = len(metadata_df[c].unique())
+
+    # go through and check cardinality = # unique, all columns in one pass
+    cardinalities = metadata_df.nunique(dropna=False)
+
+    # positions of the columns kept, and their pretty names
+    positions, columns, bool_columns = [], [], []
+    for i, (c, cardinality) in enumerate(zip(metadata_df.columns, cardinalities)):
         if (
             cardinality > CLUSTERGRAMMER_MAX_CATEGORY_CARDINALITY
             or cardinality <= 1
@@ -345,13 +946,8 @@ def _metadata_to_categories(metadata_df: pd.DataFrame) -> list:
                 "collection_event_name",
             ]:
                 # we want to keep the above no matter what
-                metadata_df.pop(c)
                 continue
 
-        if "(1=Yes,0=No)" in c:
-            # these are boolean! let's treat them that way
-            metadata_df[c] = metadata_df[c].astype(bool)
-
         if c.startswith(CLINICAL_FIELD_PREFIX):
             # for 10021 participants.csv:
             ## remove the prefix
@@ -372,16 +968,17 @@ def _metadata_to_categories(metadata_df: pd.DataFrame) -> list:
 
         # strip so it's pretty!
         if cat.strip() not in columns:
+            positions.append(i)
             columns.append(cat.strip())
-        else:
-            # if it's a repeated name, pop it
-            metadata_df.pop(c)
+            if "(1=Yes,0=No)" in c:
+                # these are boolean! let's treat them that way
+                bool_columns.append(cat.strip())
+        # otherwise it's a repeated name, so skip it
 
-    metadata_df.columns = columns
     print("CG Category options:", ", ".join(columns))
 
     # cut down to only the categories we want
-    columns = [
+    wanted_columns = [
         c
         for c in [
             "Participant Id",
@@ -391,56 +988,74 @@ def _metadata_to_categories(metadata_df: pd.DataFrame) -> list:
             "Disease progression",
             "RECIST clinical benefit status",
         ]
-        if c in metadata_df.columns
+        if c in columns
     ]
-    columns = sorted(columns, key=lambda c: len(metadata_df[c].unique()))
+    metadata_df = metadata_df.iloc[
+        :, [positions[columns.index(c)] for c in wanted_columns]
+    ]
+    metadata_df.columns = wanted_columns
+    metadata_df = metadata_df.astype(
+        {c: bool for c in bool_columns if c in wanted_columns}
+    )
+
+    cardinalities = metadata_df.nunique(dropna=False)
+    columns = sorted(wanted_columns, key=lambda c: cardinalities[c])
     metadata_df = metadata_df[columns]
 
     if "Disease progression" in columns:
         columns[columns.index("Disease progression")] = "Disease prog"
     if "RECIST clinical benefit status" in columns:
         columns[columns.index("RECIST clinical benefit status")] = "Clin benefit"
-    metadata_df.columns = columns
-
-    # build the output str in ClusterGrammer compatible format
-    categories = []
-    for idx, row in metadata_df.iterrows():
-        temp = [f"CIMAC Id: {idx}"]
 
-        for cat, val in row.items():
-            temp.append(f"{cat}: {val}")
-
-        categories.append(tuple(temp))
+    # build the output str in ClusterGrammer compatible format, a column at a time.
+    # `.values` and `.tolist()` give each cell the same type as a row from `iterrows`.
+    values = metadata_df.values
+    category_columns = [
+        [f"CIMAC Id: {idx}" for idx in metadata_df.index.tolist()],
+        *(
+            [f"{cat}: {val}" for val in values[:, j].tolist()]
+            for j, cat in enumerate(columns)
+        ),
+    ]
 
-    return categories
+    return list(zip(*category_columns))
 
 
 def _npx_to_dataframe(fname, sheet_name="NPX Data") -> pd.DataFrame:
     """Load raw data from an NPX file into a pandas dataframe."""
 
-    wb = load_workbook(fname)
-    if sheet_name not in wb.sheetnames:
-        raise ValueError(f"Couldn't locate expected worksheet '{sheet_name}'.")
-    ws = wb[sheet_name]
-
-    extract_values = lambda xlsx_row: [cell.value for cell in xlsx_row]
-
-    # Assay labels (row 5 of the spreadsheet)
-    assay_labels = extract_values(ws[4][1:-2])
-
-    # Raw data (row 8 of the spreadsheet onwards)
-    rows = []
-    num_cols = len(assay_labels) + 1
-    for row in ws.iter_rows(min_row=8):
-        sample_id = row[0].value
-        # If we hit a blank line, there's no more data to read.
-        if not sample_id:
-            break
-        # Only include rows pertaining to CIMAC ids
-        if prism.cimac_id_regex.match(sample_id):
-            new_row = extract_values(row[0:num_cols])
-            rows.append(new_row)
-    raw = pd.DataFrame(rows).set_index(0)
+    # read-only mode streams rows from the file, rather than loading every cell of
+    # the workbook into memory up front
+    wb = load_workbook(fname, read_only=True)
+    try:
+        if sheet_name not in wb.sheetnames:
+            raise ValueError(f"Couldn't locate expected worksheet '{sheet_name}'.")
+        ws = wb[sheet_name]
+        # read-only mode would otherwise stop at, and pad or cut rows to, the sheet's
+        # declared dimensions, which may not match its contents
+        ws.reset_dimensions()
+        rows = ws.iter_rows(values_only=True)
+
+        # Assay labels (row 5 of the spreadsheet)
+        assay_labels = list(next(islice(rows, 3, None))[1:-2])
+
+        # Raw data (row 8 of the spreadsheet onwards)
+        num_cols = len(assay_labels) + 1
+        values = []
+        for row in islice(rows, 3, None):
+            sample_id = row[0] if row else None
+            # If we hit a blank line, there's no more data to read.
+            if not sample_id:
+                break
+            # Only include rows pertaining to CIMAC ids; rows end at their last
+            # non-empty cell, so pad them to the full width
+            if prism.cimac_id_regex.match(sample_id):
+                row = row[0:num_cols]
+                values.append(row + (None,) * (num_cols - len(row)))
+    finally:
+        wb.close()
+
+    raw = pd.DataFrame(values).set_index(0)
     raw.index.name = "cimac_id"
     raw.columns = assay_labels
 
@@ -1,5 +1,5 @@
-from .grant_permissions import permissions_worker
-from .util import BackgroundContext, extract_pubsub_data
+from .grant_permissions import permissions_worker, PERMISSIONS_WORKER_SCHEMA
+from .util import BackgroundContext, decode_pubsub_message, extract_pubsub_data
 
 
 def worker(event: dict, context: BackgroundContext):
@@ -19,7 +19,9 @@ def worker(event: dict, context: BackgroundContext):
         # this returns the str, then convert it to a dict
         # uses event["data"] and then assumes format, so will error if no/malformatted data
         data: str = extract_pubsub_data(event)
-        data: dict = dict(eval(data))
+        data: dict = decode_pubsub_message(
+            data, schema={"_fn": (str,), **PERMISSIONS_WORKER_SCHEMA}
+        )
     except:
         raise
 
@@ -9,6 +9,7 @@ from functions import (
     derive_files_from_assay_or_analysis_upload,
     disable_inactive_users,
     refresh_download_permissions,
+    remove_expired_gcs_bindings,
     update_cidc_from_csms,
     grant_download_permissions,
     worker,
@@ -29,6 +30,7 @@ topics_to_functions = {
         store_auth0_logs,
         disable_inactive_users,
         refresh_download_permissions,
+        remove_expired_gcs_bindings,
     ],
     "emails": send_email,
     "worker": worker,
@@ -1,6 +1,17 @@
 import functions.grant_permissions
-from functions.grant_permissions import grant_download_permissions, permissions_worker
-from functions.settings import GOOGLE_WORKER_TOPIC
+from functions.grant_permissions import (
+    grant_download_permissions,
+    permissions_worker,
+    _chunk_blob_names,
+)
+from functions.settings import (
+    GOOGLE_WORKER_TOPIC,
+    PERMISSIONS_WORKER_MAX_MESSAGE_BYTES,
+    PERMISSIONS_WORKER_SECONDS_PER_GRANT,
+    PERMISSIONS_WORKER_TARGET_SECONDS,
+)
+from functions.util import decode_pubsub_message, encode_pubsub_message
+from tests.util import FakeTopic
 import pytest
 from typing import Any, List, Optional, Set, Tuple, Union
 from unittest.mock import MagicMock, call
@@ -64,6 +75,10 @@ def test_grant_download_permissions(monkeypatch):
         return mock_blob_name_list(trial_id=trial_id, upload_type=upload_type, **kwargs)
 
     monkeypatch.setattr(functions.grant_permissions, "get_blob_names", mock_blob_list)
+    # chunk size is otherwise chosen from the cost model, see test_chunk_blob_names
+    monkeypatch.setattr(
+        functions.grant_permissions, "PERMISSIONS_WORKER_MAX_BLOBS_PER_CHUNK", 100
+    )
 
     mock_encode_and_publish = MagicMock()
     monkeypatch.setattr(
@@ -111,7 +126,7 @@ def test_grant_download_permissions(monkeypatch):
     assert mock_encode_and_publish.call_count == 6
     assert mock_encode_and_publish.call_args_list == [
         call(
-            str(
+            encode_pubsub_message(
                 {
                     "_fn": "permissions_worker",
                     "user_email_list": user_email_list[:1],
@@ -122,7 +137,7 @@ def test_grant_download_permissions(monkeypatch):
             GOOGLE_WORKER_TOPIC,
         ),
         call(
-            str(
+            encode_pubsub_message(
                 {
                     "_fn": "permissions_worker",
                     "user_email_list": user_email_list[:1],
@@ -133,7 +148,7 @@ def test_grant_download_permissions(monkeypatch):
             GOOGLE_WORKER_TOPIC,
         ),
         call(
-            str(
+            encode_pubsub_message(
                 {
                     "_fn": "permissions_worker",
                     "user_email_list": user_email_list[1:2],
@@ -144,7 +159,7 @@ def test_grant_download_permissions(monkeypatch):
             GOOGLE_WORKER_TOPIC,
         ),
         call(
-            str(
+            encode_pubsub_message(
                 {
                     "_fn": "permissions_worker",
                     "user_email_list": user_email_list[1:2],
@@ -155,7 +170,7 @@ def test_grant_download_permissions(monkeypatch):
             GOOGLE_WORKER_TOPIC,
         ),
         call(
-            str(
+            encode_pubsub_message(
                 {
                     "_fn": "permissions_worker",
                     "user_email_list": user_email_list[-1:],
@@ -166,7 +181,7 @@ def test_grant_download_permissions(monkeypatch):
             GOOGLE_WORKER_TOPIC,
         ),
         call(
-            str(
+            encode_pubsub_message(
                 {
                     "_fn": "permissions_worker",
                     "user_email_list": user_email_list[-1:],
@@ -210,7 +225,7 @@ def test_grant_download_permissions(monkeypatch):
     assert mock_encode_and_publish.call_count == 2
     assert mock_encode_and_publish.call_args_list == [
         call(
-            str(
+            encode_pubsub_message(
                 {
                     "_fn": "permissions_worker",
                     "user_email_list": user_email_list,
@@ -221,7 +236,7 @@ def test_grant_download_permissions(monkeypatch):
             GOOGLE_WORKER_TOPIC,
         ),
         call(
-            str(
+            encode_pubsub_message(
                 {
                     "_fn": "permissions_worker",
                     "user_email_list": user_email_list,
@@ -233,6 +248,30 @@ def test_grant_download_permissions(monkeypatch):
         ),
     ]
 
+    # legacy str(dict) messages may hold tuples rather than lists
+    mock_encode_and_publish.reset_mock()
+    mock_blob_name_list.reset_mock()
+    mock_extract_data.return_value = str(
+        {
+            "trial_id": "foo",
+            "upload_type": ("bar", "baz"),
+            "user_email_list": tuple(user_email_list),
+            "revoke": True,
+        }
+    )
+    grant_download_permissions({}, None)
+
+    assert mock_blob_name_list.call_count == 1
+    _, kwargs = mock_blob_name_list.call_args
+    assert kwargs["upload_type"] == ("bar", "baz")
+    assert mock_encode_and_publish.call_count == 2
+    assert decode_pubsub_message(mock_encode_and_publish.call_args[0][0]) == {
+        "_fn": "permissions_worker",
+        "user_email_list": user_email_list,
+        "blob_name_list": list(mock_blob_name_list.return_value)[100:],
+        "revoke": True,
+    }
+
 
 def test_permissions_worker(monkeypatch):
     user_email_list = ["foo@bar.com", "user@test.com"]
@@ -274,3 +313,83 @@ def test_permissions_worker(monkeypatch):
         user_email_list=user_email_list,
         blob_name_list=blob_name_list,
     )
+
+
+def test_grant_download_permissions_publish_failures(monkeypatch):
+    """Check that worker messages are published concurrently and failures are reported at the end"""
+    blob_name_list = [f"blob{n}" for n in range(1000)]
+    monkeypatch.setattr(
+        functions.grant_permissions,
+        "get_blob_names",
+        lambda **kwargs: blob_name_list,
+    )
+    monkeypatch.setattr(
+        functions.grant_permissions, "PERMISSIONS_WORKER_MAX_BLOBS_PER_CHUNK", 100
+    )
+    topic = FakeTopic(latency=0.01, fail=lambda message: "blob500" in message)
+    monkeypatch.setattr(functions.grant_permissions, "_encode_and_publish", topic)
+    send_email = MagicMock()
+    monkeypatch.setattr(functions.grant_permissions, "send_email", send_email)
+
+    mock_extract_data = MagicMock()
+    mock_extract_data.return_value = str(
+        {"trial_id": "foo", "upload_type": "bar", "user_email_list": ["foo@bar.com"]}
+    )
+    monkeypatch.setattr(
+        functions.grant_permissions, "extract_pubsub_data", mock_extract_data
+    )
+
+    with pytest.raises(
+        Exception, match="Failed to publish 1 of 10 permissions_worker messages"
+    ):
+        grant_download_permissions({}, None)
+
+    # every chunk was still published, and not one at a time
+    assert len(topic.messages) == 10
+    assert topic.max_in_flight > 1
+    send_email.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "num_users,num_blobs,blob_name_length",
+    [
+        (1, 5, 60),  # tiny trial, single user
+        (3, 150, 60),  # small trial
+        (10, 5_000, 80),  # typical assay upload
+        (50, 40_000, 100),  # large WES trial
+        (500, 2_000, 80),  # cross-trial grant to many users
+        (5, 20_000, 2_000),  # very long blob names
+    ],
+)
+def test_chunk_blob_names(num_users, num_blobs, blob_name_length):
+    """Simulate chunking across realistic trial shapes and check each chunk's estimated cost"""
+    user_email_list = [f"user{n}@example.com" for n in range(num_users)]
+    blob_name_list = [
+        f"CIMAC-{n:06d}/".ljust(blob_name_length, "x") for n in range(num_blobs)
+    ]
+
+    chunks = _chunk_blob_names(user_email_list, blob_name_list)
+
+    # every blob is sent exactly once, in order
+    assert [b for chunk in chunks for b in chunk] == blob_name_list
+
+    for chunk in chunks:
+        message = encode_pubsub_message(
+            {
+                "_fn": "permissions_worker",
+                "user_email_list": user_email_list,
+                "blob_name_list": chunk,
+                "revoke": False,
+            }
+        )
+        assert len(message) < PERMISSIONS_WORKER_MAX_MESSAGE_BYTES
+
+    estimated_seconds = (
+        len(chunks[0]) * num_users * PERMISSIONS_WORKER_SECONDS_PER_GRANT
+    )
+    # many users fall back to the minimum chunk size rather than exceeding the target
+    if (
+        len(chunks[0])
+        > functions.grant_permissions.PERMISSIONS_WORKER_MIN_BLOBS_PER_CHUNK
+    ):
+        assert estimated_seconds <= PERMISSIONS_WORKER_TARGET_SECONDS
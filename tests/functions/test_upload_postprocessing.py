@@ -1,3 +1,5 @@
+import threading
+import time
 from unittest.mock import MagicMock
 
 import pytest
@@ -87,12 +89,26 @@ def test_derive_files_from_upload(monkeypatch):
     ]
     monkeypatch.setattr(upload_postprocessing.unprism, "derive_files", derive_files)
 
+    publish_artifact_upload_batches = MagicMock()
+    monkeypatch.setattr(
+        upload_postprocessing,
+        "publish_artifact_upload_batches",
+        publish_artifact_upload_batches,
+    )
+
+    update_metadata_snapshot = MagicMock()
+    monkeypatch.setattr(
+        upload_postprocessing, "update_metadata_snapshot", update_metadata_snapshot
+    )
+
     session = MagicMock()
 
     def reset_mocks():
         upload_to_data_bucket.reset_mock()
+        update_metadata_snapshot.reset_mock()
         create_from_blob.reset_mock()
         derive_files.reset_mock()
+        publish_artifact_upload_batches.reset_mock()
         session.reset_mock()
 
     # Call the function
@@ -107,9 +123,47 @@ def test_derive_files_from_upload(monkeypatch):
     derive_files.assert_called()
     upload_to_data_bucket.assert_called()
     create_from_blob.assert_called()
-    session.commit.assert_called()
+    session.commit.assert_called_once()
     assert blob in create_from_blob.call_args[1].values()
+    assert create_from_blob.call_args[1]["commit"] is False
     assert downloadable_file.analysis_friendly is True
+    publish_artifact_upload_batches.assert_called_once_with(
+        upload_postprocessing._encode_and_publish, [blob.name]
+    )
+    update_metadata_snapshot.assert_not_called()
+    reset_mocks()
+
+    # rewriting just one of a trial's participants/samples CSVs leaves its snapshot alone
+    derive_files.return_value.artifacts = [
+        upload_postprocessing.unprism.Artifact(
+            "test-trial/participants.csv", "", "participants info", "csv", {}
+        )
+    ]
+    upload_postprocessing._derive_files_from_upload(
+        trial_id="test-trial",
+        upload_type="test-upload",
+        upload_id="foo",
+        session=session,
+    )
+    update_metadata_snapshot.assert_not_called()
+    reset_mocks()
+
+    # and rewriting both updates its metadata snapshot
+    derive_files.return_value.artifacts = [
+        upload_postprocessing.unprism.Artifact(
+            "test-trial/participants.csv", "p", "participants info", "csv", {}
+        ),
+        upload_postprocessing.unprism.Artifact(
+            "test-trial/samples.csv", "s", "samples info", "csv", {}
+        ),
+    ]
+    upload_postprocessing._derive_files_from_upload(
+        trial_id="test-trial",
+        upload_type="test-upload",
+        upload_id="foo",
+        session=session,
+    )
+    update_metadata_snapshot.assert_called_once_with("test-trial", blob, "p", blob, "s")
     reset_mocks()
 
     # test graceful logging on null return
@@ -128,6 +182,83 @@ def test_derive_files_from_upload(monkeypatch):
     upload_to_data_bucket.assert_not_called()
     create_from_blob.assert_not_called()
     session.commit.assert_not_called()
+    publish_artifact_upload_batches.assert_not_called()
     mock_print.assert_called_once_with(
         "No file derivation registered for test-upload - skipping for upload foo"
     )
+
+
+def test_derive_files_from_upload_parallel_uploads(monkeypatch):
+    """Check that derived files are uploaded concurrently and upload failures are reported together"""
+    latency, num_artifacts = 0.05, 32
+    lock = threading.Lock()
+    in_flight = {"now": 0, "max": 0}
+
+    def upload_to_data_bucket(object_name, data):
+        with lock:
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        time.sleep(latency)
+        with lock:
+            in_flight["now"] -= 1
+        if object_name.endswith("3"):
+            raise Exception("upload failed")
+        blob = MagicMock()
+        blob.name = object_name
+        return blob
+
+    monkeypatch.setattr(
+        upload_postprocessing, "upload_to_data_bucket", upload_to_data_bucket
+    )
+    create_from_blob = MagicMock()
+    monkeypatch.setattr(
+        upload_postprocessing.DownloadableFiles, "create_from_blob", create_from_blob
+    )
+    publish_artifact_upload_batches = MagicMock()
+    monkeypatch.setattr(
+        upload_postprocessing,
+        "publish_artifact_upload_batches",
+        publish_artifact_upload_batches,
+    )
+    derive_files = MagicMock()
+    monkeypatch.setattr(upload_postprocessing.unprism, "derive_files", derive_files)
+    session = MagicMock()
+
+    derive_files.return_value.artifacts = [
+        upload_postprocessing.unprism.Artifact(f"file{i}", "", "", "", {})
+        for i in range(num_artifacts)
+    ]
+    with pytest.raises(Exception, match="Failed to upload 3 of 32 derived files"):
+        upload_postprocessing._derive_files_from_upload(
+            trial_id="test-trial",
+            upload_type="test-upload",
+            upload_id="foo",
+            session=session,
+        )
+    # nothing is written to the database if any upload fails
+    create_from_blob.assert_not_called()
+    session.commit.assert_not_called()
+    publish_artifact_upload_batches.assert_not_called()
+
+    derive_files.return_value.artifacts = [
+        upload_postprocessing.unprism.Artifact(f"file{i}", "", "", "", {})
+        for i in range(num_artifacts)
+        if not str(i).endswith("3")
+    ]
+    upload_postprocessing._derive_files_from_upload(
+        trial_id="test-trial",
+        upload_type="test-upload",
+        upload_id="foo",
+        session=session,
+    )
+
+    # uploads overlapped, up to the thread pool's size at once
+    assert 1 < in_flight["max"] <= upload_postprocessing.THREADPOOL_THREADS
+    assert [c[1]["blob"].name for c in create_from_blob.call_args_list] == [
+        a.object_url for a in derive_files.return_value.artifacts
+    ]
+    session.commit.assert_called_once()
+    publish_artifact_upload_batches.assert_called_once_with(
+        upload_postprocessing._encode_and_publish,
+        [a.object_url for a in derive_files.return_value.artifacts],
+    )
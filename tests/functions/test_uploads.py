@@ -1,8 +1,17 @@
 from unittest.mock import MagicMock, call
 from collections import namedtuple
+import copy
 import datetime
+import threading
+from typing import List, Optional
 
 import pytest
+from google.api_core.exceptions import PreconditionFailed
+from google.api_core.iam import Policy
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import sessionmaker
 
 from cidc_api.models import (
     UploadJobs,
@@ -12,11 +21,16 @@ from cidc_api.models import (
     prism,
 )
 
-from functions import uploads
+from functions import uploads, util
 from functions.uploads import ingest_upload, saved_failure_status
+from functions.util import encode_pubsub_message
 from functions.settings import (
     GOOGLE_ACL_DATA_BUCKET,
+    GOOGLE_ANALYSIS_PERMISSIONS_GRANT_FOR_DAYS,
+    GOOGLE_ARTIFACT_UPLOAD_TOPIC,
     GOOGLE_ASSAY_OR_ANALYSIS_UPLOAD_TOPIC,
+    GOOGLE_UPLOAD_BUCKET,
+    INGEST_COPY_MAX_ATTEMPTS,
 )
 
 from tests.util import make_pubsub_event, with_app_context
@@ -81,7 +95,7 @@ def test_ingest_upload(caplog, monkeypatch):
 
     # Mock data transfer functionality
     _gcs_copy = MagicMock()
-    _gcs_copy.side_effect = lambda storage_client, source_bucket, source_object, target_bucket, target_object: _gcs_obj_mock(
+    _gcs_copy.side_effect = lambda source_bucket, source_object, target_bucket, target_object, **kwargs: _gcs_obj_mock(
         target_object,
         100,
         datetime.datetime.now(),
@@ -95,11 +109,10 @@ def test_ingest_upload(caplog, monkeypatch):
     _get_bucket_and_blob.return_value = None, xlsx_blob
     monkeypatch.setattr("functions.uploads._get_bucket_and_blob", _get_bucket_and_blob)
 
-    # mocking `google.cloud.storage.Client()` to not actually create a client
+    # mocking the shared `google.cloud.storage.Client()` to not actually create a client
     _storage_client = MagicMock("_storage_client")
-    monkeypatch.setattr(
-        "functions.uploads.storage.Client", lambda *a, **kw: _storage_client
-    )
+    monkeypatch.setattr(util, "_storage_client", _storage_client)
+    monkeypatch.setattr(util, "_bucket_cache", {})
 
     _bucket = MagicMock("_bucket")
     _storage_client.get_bucket = lambda *a, **kw: _bucket
@@ -110,8 +123,8 @@ def test_ingest_upload(caplog, monkeypatch):
     _api_request.return_value = {"bindings": []}
 
     # Mock metadata merging functionality
-    _save_file = MagicMock("_save_file")
-    monkeypatch.setattr(DownloadableFiles, "create_from_metadata", _save_file)
+    _save_files = MagicMock("_save_files")
+    monkeypatch.setattr(uploads, "_bulk_create_downloadable_files", _save_files)
 
     _save_blob_file = MagicMock("_save_blob_file")
     monkeypatch.setattr(DownloadableFiles, "create_from_blob", _save_blob_file)
@@ -137,9 +150,6 @@ def test_ingest_upload(caplog, monkeypatch):
     _merge_metadata.return_value = trial
     monkeypatch.setattr(TrialMetadata, "patch_assays", _merge_metadata)
 
-    publish_artifact_upload = MagicMock("publish_artifact_upload")
-    monkeypatch.setattr(uploads, "publish_artifact_upload", publish_artifact_upload)
-
     _encode_and_publish = MagicMock("_encode_and_publish")
     monkeypatch.setattr(uploads, "_encode_and_publish", _encode_and_publish)
 
@@ -161,13 +171,12 @@ def test_ingest_upload(caplog, monkeypatch):
     # Check that we copied multiple objects
     _gcs_copy.assert_called() and not _gcs_copy.assert_called_once()
     # Check that we tried to save multiple files
-    _save_file.assert_called() and not _save_file.assert_called_once()
+    _save_files.assert_called_once()
+    assert len(_save_files.call_args[0][2]) == 2
     # Check that we tried to merge metadata once
     _merge_metadata.assert_called_once()
     # Check that we got the xlsx blob metadata from GCS
-    _get_bucket_and_blob.assert_called_with(
-        _storage_client, GOOGLE_ACL_DATA_BUCKET, job.gcs_xlsx_uri
-    )
+    _get_bucket_and_blob.assert_called_with(GOOGLE_ACL_DATA_BUCKET, job.gcs_xlsx_uri)
     # Check that we created a downloadable file for the xlsx file blob
     assert _save_blob_file.call_args[:-1][0] == (
         "CIMAC-12345",
@@ -180,11 +189,14 @@ def test_ingest_upload(caplog, monkeypatch):
     # Check that the job status was updated to reflect a successful upload
     assert job.status == UploadJobStatus.MERGE_COMPLETED.value
     assert email_was_sent(caplog.text)
-    publish_artifact_upload.assert_called()
     grant_download_permissions_for_upload_job.assert_called()
 
     # Check that triggered downstream processing and biofx permisssions assignment
     expected_calls = [
+        call(
+            encode_pubsub_message({"object_urls": [URI1, URI2]}),
+            GOOGLE_ARTIFACT_UPLOAD_TOPIC,
+        ),
         call(str(job.id), GOOGLE_ASSAY_OR_ANALYSIS_UPLOAD_TOPIC),
     ]
     assert all(
@@ -217,3 +229,671 @@ def test_saved_failure_status(caplog):
     session.commit.assert_called_once()
 
     assert not email_was_sent(caplog.text)
+
+
+class _FakeBlob:
+    def __init__(self, bucket, name: str, size: int = 100):
+        self.bucket = bucket
+        self.name = name
+        self.size = size
+        self.md5_hash = "fake_md5"
+        self.crc32c = "fake_crc32c"
+        self.time_created = datetime.datetime.now()
+        self._properties = {}
+
+    def rewrite(self, source, token=None):
+        """Copy `source`, `rewrite_chunk_size` bytes per call"""
+        backend = self.bucket.backend
+        backend.requests.append(
+            ("POST", f"{source.bucket.name}/{source.name}/rewriteTo/{self.name}")
+        )
+        if backend.fail_rewrites and backend.fail_rewrites(self.name, token):
+            raise uploads.BadRequest("rewrite failed")
+        rewritten = int(token or 0) + backend.rewrite_chunk_size
+        if rewritten >= source.size:
+            backend.objects[(self.bucket.name, self.name)] = source.size
+            return None, source.size, source.size
+        return str(rewritten), rewritten, source.size
+
+    def download_as_string(self):
+        return self.bucket.backend.objects[(self.bucket.name, self.name)]
+
+    def upload_from_string(self, data):
+        self.bucket.backend.requests.append(("POST", f"{self.bucket.name}/{self.name}"))
+        self.bucket.backend.objects[(self.bucket.name, self.name)] = data
+
+
+class _FakeBucket:
+    def __init__(self, backend, name: str):
+        self.backend = backend
+        self.name = name
+
+    def get_blob(self, object_name: str):
+        self.backend.requests.append(("GET", f"{self.name}/{object_name}"))
+        if object_name.startswith(uploads.INGEST_COPY_PROGRESS_PREFIX):
+            if (self.name, object_name) not in self.backend.objects:
+                return None
+        # every other object exists
+        blob = _FakeBlob(self, object_name, self.backend.object_size)
+        blob.crc32c = self.backend.checksums.get(object_name, blob.crc32c)
+        return blob
+
+    def blob(self, object_name: str):
+        return _FakeBlob(self, object_name)
+
+    def list_blobs(self, prefix: str, max_results: Optional[int] = None):
+        self.backend.requests.append(("GET", f"{self.name}/o?prefix={prefix}"))
+        blobs = []
+        for bucket_name, object_name in sorted(self.backend.objects):
+            if bucket_name == self.name and object_name.startswith(prefix):
+                blob = _FakeBlob(self, object_name, self.backend.object_size)
+                blob.crc32c = self.backend.checksums.get(object_name, blob.crc32c)
+                blobs.append(blob)
+        return blobs[:max_results]
+
+    def delete_blob(self, object_name: str):
+        self.backend.requests.append(("DELETE", f"{self.name}/{object_name}"))
+        del self.backend.objects[(self.name, object_name)]
+
+
+class _FakeStorageBackend:
+    """Stands in for `storage.Client`, recording every HTTP round trip it would make."""
+
+    def __init__(self, object_size: int = 100, rewrite_chunk_size: int = 100):
+        self.requests = []
+        self.objects = {}
+        self.object_size = object_size
+        self.rewrite_chunk_size = rewrite_chunk_size
+        # called with the target object name and token before each rewrite
+        self.fail_rewrites = None
+        # CRC32Cs of data bucket objects that don't match their uploads
+        self.checksums = {}
+
+    def get_bucket(self, bucket_name: str):
+        self.requests.append(("GET", bucket_name))
+        return _FakeBucket(self, bucket_name)
+
+    def add_uploads(self, upload_urls: List[str]):
+        for upload_url in upload_urls:
+            self.objects[(GOOGLE_UPLOAD_BUCKET, upload_url)] = self.object_size
+
+
+@with_app_context
+def test_ingest_upload_gcs_round_trips(monkeypatch):
+    """Count GCS requests made by ingest_upload on a cold and a warm instance."""
+    TRIAL_ID = "CIMAC-12345"
+    num_artifacts = 50
+    file_map = {
+        f"/path/to/file{i}{UPLOAD_DATE_PATH}": f"uuid{i}" for i in range(num_artifacts)
+    }
+
+    backend = _FakeStorageBackend()
+    backend.add_uploads(file_map)
+    monkeypatch.setattr(util, "_storage_client", backend)
+    monkeypatch.setattr(util, "_bucket_cache", {})
+    monkeypatch.setattr(uploads, "ENV", "prod")
+
+    find_by_id = MagicMock()
+    monkeypatch.setattr(UploadJobs, "find_by_id", find_by_id)
+    merge_gcs_artifacts = MagicMock()
+    merge_gcs_artifacts.return_value = ({prism.PROTOCOL_ID_FIELD_NAME: TRIAL_ID}, [])
+    monkeypatch.setattr(TrialMetadata, "merge_gcs_artifacts", merge_gcs_artifacts)
+    monkeypatch.setattr(TrialMetadata, "patch_assays", MagicMock())
+    monkeypatch.setattr(DownloadableFiles, "create_from_blob", MagicMock())
+    monkeypatch.setattr(uploads, "_encode_and_publish", MagicMock())
+    monkeypatch.setattr(
+        uploads.Permissions, "grant_download_permissions_for_upload_job", MagicMock()
+    )
+
+    def run_ingestion():
+        job = UploadJobs(
+            id=JOB_ID,
+            uploader_email="test@email.com",
+            trial_id=TRIAL_ID,
+            gcs_xlsx_uri="test.xlsx",
+            gcs_file_map=file_map,
+            metadata_patch={prism.PROTOCOL_ID_FIELD_NAME: TRIAL_ID},
+            status=UploadJobStatus.UPLOAD_COMPLETED.value,
+            upload_type="wes_bam",
+        )
+        job.ingestion_success = MagicMock()
+        find_by_id.return_value = job
+        backend.requests.clear()
+        ingest_upload(make_pubsub_event(str(job.id)), None)
+        return list(backend.requests)
+
+    # Cold instance: each bucket's metadata is fetched exactly once
+    cold_requests = run_ingestion()
+    bucket_gets = [r for r in cold_requests if "/" not in r[1]]
+    assert sorted(bucket_gets) == sorted(
+        [("GET", GOOGLE_UPLOAD_BUCKET), ("GET", GOOGLE_ACL_DATA_BUCKET)]
+    )
+    # one copy per artifact, plus the copy progress lookup, one listing each
+    # of the uploads and existing copies, and the metadata xlsx lookup
+    assert len(cold_requests) == len(bucket_gets) + num_artifacts + 4
+
+    # Warm instance: no bucket metadata requests at all, and nothing to recopy
+    warm_requests = run_ingestion()
+    assert all("/" in r[1] for r in warm_requests)
+    assert len(warm_requests) == 4
+
+    # Broad prefix: the data bucket's listing is cut short by other objects under the
+    # copies' common prefix, so each copy is looked up on its own, and nothing is recopied
+    for i in range(1000):
+        backend.objects[(GOOGLE_ACL_DATA_BUCKET, f"/path/to/file.{i:04d}")] = 100
+    broad_requests = run_ingestion()
+    assert len(broad_requests) == num_artifacts + 4
+    assert not any("rewriteTo" in r[1] for r in broad_requests)
+
+    # uploads the listing misses are looked up on their own, too
+    monkeypatch.setattr(uploads, "GCS_LIST_MAX_RESULTS_PER_OBJECT", 0)
+    fallback_requests = run_ingestion()
+    assert len(fallback_requests) == 2 * num_artifacts + 4
+    assert not any("rewriteTo" in r[1] for r in fallback_requests)
+
+
+def test_gcs_copy_finished_progress(monkeypatch):
+    """Check that copies saved as finished aren't redone, even if the target wasn't listed"""
+    backend = _FakeStorageBackend()
+    monkeypatch.setattr(util, "_storage_client", backend)
+    monkeypatch.setattr(util, "_bucket_cache", {})
+    monkeypatch.setattr(uploads, "ENV", "prod")
+
+    progress = uploads._CopyProgress(JOB_ID)
+    progress.update("target/file", None, done=True)
+    copy = lambda: uploads._gcs_copy(
+        GOOGLE_UPLOAD_BUCKET,
+        "upload/file",
+        GOOGLE_ACL_DATA_BUCKET,
+        "target/file",
+        progress=progress,
+        existing_object=None,
+    )
+
+    backend.requests.clear()
+    assert copy().name == "target/file"
+    assert not any("rewriteTo" in r[1] for r in backend.requests)
+    assert ("GET", f"{GOOGLE_ACL_DATA_BUCKET}/target/file") in backend.requests
+
+    # unless the target no longer matches the source
+    backend.checksums["target/file"] = "stale_crc32c"
+    backend.requests.clear()
+    copy()
+    assert any("rewriteTo" in r[1] for r in backend.requests)
+
+
+@with_app_context
+def test_ingest_upload_resumes_copies(monkeypatch):
+    """Check that a retried ingest_upload resumes copies from their saved rewrite tokens"""
+    TRIAL_ID = "CIMAC-12345"
+    file_map = {f"/path/to/file{i}{UPLOAD_DATE_PATH}": f"uuid{i}" for i in range(4)}
+
+    # each object takes 4 rewrite calls to copy
+    backend = _FakeStorageBackend(object_size=400, rewrite_chunk_size=100)
+    backend.add_uploads(file_map)
+    monkeypatch.setattr(util, "_storage_client", backend)
+    monkeypatch.setattr(util, "_bucket_cache", {})
+    monkeypatch.setattr(uploads, "ENV", "prod")
+    monkeypatch.setattr(uploads, "INGEST_COPY_PROGRESS_SAVE_INTERVAL_SECONDS", -1)
+
+    find_by_id = MagicMock()
+    monkeypatch.setattr(UploadJobs, "find_by_id", find_by_id)
+    merge_gcs_artifacts = MagicMock()
+    merge_gcs_artifacts.return_value = ({prism.PROTOCOL_ID_FIELD_NAME: TRIAL_ID}, [])
+    monkeypatch.setattr(TrialMetadata, "merge_gcs_artifacts", merge_gcs_artifacts)
+    monkeypatch.setattr(TrialMetadata, "patch_assays", MagicMock())
+    monkeypatch.setattr(DownloadableFiles, "create_from_blob", MagicMock())
+    monkeypatch.setattr(uploads, "_encode_and_publish", MagicMock())
+    monkeypatch.setattr(
+        uploads.Permissions, "grant_download_permissions_for_upload_job", MagicMock()
+    )
+
+    def make_job():
+        job = UploadJobs(
+            id=JOB_ID,
+            uploader_email="test@email.com",
+            trial_id=TRIAL_ID,
+            gcs_xlsx_uri="test.xlsx",
+            gcs_file_map=file_map,
+            metadata_patch={prism.PROTOCOL_ID_FIELD_NAME: TRIAL_ID},
+            status=UploadJobStatus.UPLOAD_COMPLETED.value,
+            upload_type="wes_bam",
+        )
+        job.ingestion_success = MagicMock()
+        find_by_id.return_value = job
+        return job
+
+    # the first attempt dies partway through copying file1
+    backend.fail_rewrites = lambda target_url, token: (
+        target_url.endswith("file1") and token == "200"
+    )
+    job = make_job()
+    with pytest.raises(uploads.BadRequest):
+        ingest_upload(make_pubsub_event(str(job.id)), None)
+    progress_key = (GOOGLE_UPLOAD_BUCKET, f"_ingest_progress/{JOB_ID}.json")
+    assert progress_key in backend.objects
+    # the job is marked failed, so the uploader sees the error
+    assert job.status == UploadJobStatus.MERGE_FAILED.value
+    assert job.status_details == "400 rewrite failed"
+
+    # a manual re-ingest (with the job's status reset in the database) finishes file1
+    # from its token, and doesn't recopy anything the first attempt finished
+    backend.fail_rewrites = None
+    ingest_upload(make_pubsub_event(str(make_job().id)), None)
+    rewrites = [r[1].rsplit("/", 1)[1] for r in backend.requests if "rewriteTo" in r[1]]
+    assert rewrites.count("file0") == 4
+    assert rewrites.count("file1") == 3 + 2
+    assert rewrites.count("file2") == rewrites.count("file3") == 4
+    # and cleans up its progress once the upload is ingested
+    assert progress_key not in backend.objects
+
+    destination_objects = list(merge_gcs_artifacts.call_args[0][2])
+    assert sorted(blob.name for _, blob in destination_objects) == [
+        f"/path/to/file{i}" for i in range(4)
+    ]
+
+    # copies that differ from their uploads are redone
+    backend.checksums["/path/to/file2"] = "stale_crc32c"
+    backend.requests.clear()
+    ingest_upload(make_pubsub_event(str(make_job().id)), None)
+    rewrites = [r[1].rsplit("/", 1)[1] for r in backend.requests if "rewriteTo" in r[1]]
+    assert rewrites == ["file2"] * 4
+
+    # a job whose copies keep failing is marked failed every time, and its
+    # progress is cleaned up once it's out of attempts
+    backend.checksums["/path/to/file3"] = "stale_crc32c"
+    backend.fail_rewrites = lambda target_url, token: target_url.endswith("file3")
+    for attempt in range(1, INGEST_COPY_MAX_ATTEMPTS + 1):
+        job = make_job()
+        with pytest.raises(uploads.BadRequest):
+            ingest_upload(make_pubsub_event(str(job.id)), None)
+        assert job.status == UploadJobStatus.MERGE_FAILED.value
+        assert (progress_key in backend.objects) == (attempt < INGEST_COPY_MAX_ATTEMPTS)
+
+
+@with_app_context
+@pytest.mark.parametrize("pipelined", [True, False])
+def test_ingest_upload_pipelined(monkeypatch, pipelined):
+    """Check that ingest_upload merges copied artifacts and publishes while other stages run"""
+    TRIAL_ID = "CIMAC-12345"
+    file_map = {f"/path/to/file{i}{UPLOAD_DATE_PATH}": f"uuid{i}" for i in range(6)}
+
+    backend = _FakeStorageBackend()
+    backend.add_uploads(file_map)
+    monkeypatch.setattr(util, "_storage_client", backend)
+    monkeypatch.setattr(util, "_bucket_cache", {})
+    monkeypatch.setattr(uploads, "ENV", "prod")
+    monkeypatch.setattr(uploads, "INGEST_UPLOAD_PIPELINED", pipelined)
+    monkeypatch.setattr(uploads, "INGEST_MERGE_BATCH_SIZE", 2)
+
+    merged = threading.Event()
+    # file5 can't finish copying until something has been merged
+    backend.fail_rewrites = lambda target_url, token: (
+        pipelined and target_url.endswith("file5") and not merged.wait(5)
+    )
+
+    def merge_gcs_artifacts(metadata, upload_type, uuids_and_objects):
+        merged.set()
+        return metadata, [({}, {}) for _ in uuids_and_objects]
+
+    merge_gcs_artifacts = MagicMock(side_effect=merge_gcs_artifacts)
+    monkeypatch.setattr(TrialMetadata, "merge_gcs_artifacts", merge_gcs_artifacts)
+    monkeypatch.setattr(TrialMetadata, "patch_assays", MagicMock())
+    monkeypatch.setattr(DownloadableFiles, "create_from_blob", MagicMock())
+    save_files = MagicMock()
+    monkeypatch.setattr(uploads, "_bulk_create_downloadable_files", save_files)
+
+    job = UploadJobs(
+        id=JOB_ID,
+        uploader_email="test@email.com",
+        trial_id=TRIAL_ID,
+        gcs_xlsx_uri="test.xlsx",
+        gcs_file_map=file_map,
+        metadata_patch={prism.PROTOCOL_ID_FIELD_NAME: TRIAL_ID},
+        status=UploadJobStatus.UPLOAD_COMPLETED.value,
+        upload_type="wes_bam",
+    )
+    job.ingestion_success = MagicMock()
+    monkeypatch.setattr(UploadJobs, "find_by_id", lambda *args, **kwargs: job)
+
+    # record whether each message was published after the upload was committed,
+    # and whether permissions were granted while publishing
+    events = []
+    publishing = threading.Event()
+
+    def publish(message, topic):
+        events.append(("publish", job.ingestion_success.called))
+        publishing.set()
+
+    monkeypatch.setattr(uploads, "_encode_and_publish", publish)
+
+    def grant(*args, **kwargs):
+        events.append(("grant", publishing.wait(5) if pipelined else None))
+
+    monkeypatch.setattr(
+        uploads.Permissions, "grant_download_permissions_for_upload_job", grant
+    )
+
+    ingest_upload(make_pubsub_event(str(job.id)), None)
+
+    merged_uuids = [
+        uuid for c in merge_gcs_artifacts.call_args_list for uuid, _ in c[0][2]
+    ]
+    assert sorted(merged_uuids) == sorted(file_map.values())
+    if pipelined:
+        assert [len(c[0][2]) for c in merge_gcs_artifacts.call_args_list] == [2] * 3
+    else:
+        merge_gcs_artifacts.assert_called_once()
+    assert len(save_files.call_args[0][2]) == 6
+
+    assert ("publish", False) not in events
+    assert events.count(("publish", True)) == 2
+    assert ("grant", True if pipelined else None) in events
+
+
+def test_byte_budget():
+    """Check that _ByteBudget limits the bytes reserved at once"""
+    budget = uploads._ByteBudget(100)
+    with budget.reserve(60), budget.reserve(40):
+        assert budget.in_use == 100
+    # reservations bigger than the budget get all of it
+    with budget.reserve(1000):
+        assert budget.in_use == 100
+    assert budget.in_use == 0
+
+
+@compiles(JSONB, "sqlite")
+def _compile_jsonb_sqlite(type_, compiler, **kw):
+    """Let DownloadableFiles be created in a SQLite stand-in for Postgres"""
+    return "JSON"
+
+
+def _sqlite_session():
+    engine = create_engine("sqlite://")
+    DownloadableFiles.__table__.create(engine)
+    return sessionmaker(bind=engine)()
+
+
+def _fake_downloadable_files(num_artifacts: int, size: int = 100):
+    return [
+        (
+            {
+                "object_url": f"CIMAC-12345/wes/CTTTPP{i:04d}S1.01/reads_{i}.bam",
+                "file_size_bytes": size,
+                "md5_hash": f"md5-{i}-{size}",
+                "crc32c_hash": f"crc32c-{i}-{size}",
+                "uploaded_timestamp": datetime.datetime(2022, 1, 1),
+                "facet_group": "/wes/reads_.bam",
+                "data_format": "BAM",
+                "upload_placeholder": f"uuid{i}",  # not a column
+            },
+            {"wes.records.cimac_id": f"CTTTPP{i:04d}S1.01"},
+        )
+        for i in range(num_artifacts)
+    ]
+
+
+def _downloadable_files_rows(session) -> list:
+    ignored = {"id", "_created", "_updated"}
+    return [
+        {k: v for k, v in df.to_dict().items() if k not in ignored}
+        for df in session.query(DownloadableFiles).order_by(
+            DownloadableFiles.object_url
+        )
+    ]
+
+
+def _create_from_metadata_rows(downloadable_files, session):
+    """The row-at-a-time path _bulk_create_downloadable_files replaces"""
+    for artifact_metadata, additional_metadata in downloadable_files:
+        DownloadableFiles.create_from_metadata(
+            "CIMAC-12345",
+            "wes_bam",
+            artifact_metadata,
+            additional_metadata=additional_metadata,
+            session=session,
+            commit=False,
+        )
+
+
+def test_bulk_create_downloadable_files():
+    """Check that bulk-created downloadable_files match those created one at a time"""
+    row_session, bulk_session = _sqlite_session(), _sqlite_session()
+
+    # new records, then updates to existing records alongside new ones
+    for downloadable_files in [
+        _fake_downloadable_files(10),
+        _fake_downloadable_files(15, size=200),
+    ]:
+        _create_from_metadata_rows(downloadable_files, row_session)
+        row_session.commit()
+        uploads._bulk_create_downloadable_files(
+            "CIMAC-12345", "wes_bam", downloadable_files, session=bulk_session
+        )
+        bulk_session.commit()
+
+        bulk_rows = _downloadable_files_rows(bulk_session)
+        assert len(bulk_rows) == len(downloadable_files)
+        assert bulk_rows == _downloadable_files_rows(row_session)
+
+    # no artifacts is a no-op
+    session = MagicMock()
+    uploads._bulk_create_downloadable_files("CIMAC-12345", "wes_bam", [], session)
+    session.query.assert_not_called()
+
+
+def test_bulk_create_downloadable_files_defaults():
+    """Check that bulk-created downloadable_files get the model's column defaults"""
+    session = _sqlite_session()
+    statements = []
+    event.listen(
+        session.get_bind(),
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement.split()[0]),
+    )
+    downloadable_files = _fake_downloadable_files(3)
+    # metadata that sets a defaulted column wins, and the rows are still inserted together
+    downloadable_files[0][0]["analysis_friendly"] = True
+    uploads._bulk_create_downloadable_files(
+        "CIMAC-12345", "wes_bam", downloadable_files, session=session
+    )
+    session.commit()
+    assert statements == ["SELECT", "INSERT"]
+
+    columns = DownloadableFiles.__table__.columns
+    scalar_defaults = {
+        c.name: c.default.arg for c in columns if c.default and c.default.is_scalar
+    }
+    assert set(scalar_defaults) >= {"visible", "analysis_friendly"}
+    records = session.query(DownloadableFiles).order_by(DownloadableFiles.object_url)
+    for i, record in enumerate(records):
+        for name, default in scalar_defaults.items():
+            if i == 0 and name == "analysis_friendly":
+                assert record.analysis_friendly is True
+            else:
+                assert getattr(record, name) == default, name
+        # SQL defaults are applied by the database
+        for c in columns:
+            if c.default is not None and not c.default.is_scalar:
+                assert getattr(record, c.name) is not None, c.name
+        assert record._etag
+
+
+def test_bulk_create_downloadable_files_round_trips():
+    """Check that bulk creation takes the same few statements however many artifacts there are"""
+    session = _sqlite_session()
+    statements = []
+    event.listen(
+        session.get_bind(),
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement.split()[0]),
+    )
+
+    # a query for existing records, then one insert for all of them
+    uploads._bulk_create_downloadable_files(
+        "CIMAC-12345", "wes_bam", _fake_downloadable_files(500), session=session
+    )
+    session.commit()
+    assert statements == ["SELECT", "INSERT"]
+
+    # plus one update for all the existing records
+    statements.clear()
+    uploads._bulk_create_downloadable_files(
+        "CIMAC-12345",
+        "wes_bam",
+        _fake_downloadable_files(1000, size=200),
+        session=session,
+    )
+    session.commit()
+    assert statements == ["SELECT", "INSERT", "UPDATE"]
+    assert session.query(DownloadableFiles).count() == 1000
+
+
+class FakePolicyBucket:
+    """
+    A bucket whose IAM policy writes fail if the policy has changed since it was read,
+    like GCS's. Each of the first `concurrent_writes` reads is followed by another
+    writer adding its own binding.
+    """
+
+    def __init__(self, bindings=(), concurrent_writes=0):
+        self.bindings = list(bindings)
+        self.etag = 0
+        self.concurrent_writes = concurrent_writes
+        self.writes = 0
+
+    def get_iam_policy(self, requested_policy_version):
+        assert requested_policy_version == 3
+        policy = Policy(etag=str(self.etag))
+        policy.bindings = copy.deepcopy(self.bindings)
+
+        if self.concurrent_writes:
+            self.concurrent_writes -= 1
+            self._write(
+                self.bindings
+                + [{"role": "roles/viewer", "members": {f"user:{self.etag}"}}]
+            )
+        return policy
+
+    def set_iam_policy(self, policy):
+        if policy.etag != str(self.etag):
+            raise PreconditionFailed("policy etag mismatch")
+        assert policy.version == 3
+        self._write(copy.deepcopy(policy.bindings))
+        self.writes += 1
+
+    def _write(self, bindings):
+        self.bindings = bindings
+        self.etag += 1
+
+    def grants(self) -> dict:
+        """Get {(member, expression)} for every conditional binding"""
+        return {
+            (member, binding["condition"]["expression"])
+            for binding in self.bindings
+            if "condition" in binding
+            for member in binding["members"]
+        }
+
+
+def _prefix_reader_expression(prefix: str, expiry: datetime.date) -> str:
+    return (
+        f'resource.name.startsWith("projects/_/buckets/{GOOGLE_ACL_DATA_BUCKET}/objects/{prefix}/")'
+        f' && request.time < timestamp("{expiry.isoformat()}T00:00:00Z")'
+    )
+
+
+def test_gcs_add_prefix_reader_permission(monkeypatch):
+    """Test that prefix reader grants replace existing ones, retrying on conflicts"""
+    monkeypatch.setattr(uploads.time, "sleep", lambda seconds: None)
+    today = datetime.datetime.now().date()
+    expiry = today + datetime.timedelta(GOOGLE_ANALYSIS_PERMISSIONS_GRANT_FOR_DAYS)
+    unrelated_binding = {"role": "roles/storage.admin", "members": {"user:admin"}}
+    existing_binding = {
+        "role": uploads.GOOGLE_ANALYSIS_GROUP_ROLE,
+        "members": {"group:a@example.com"},
+        "condition": {
+            "title": "Biofx trial/wes until 2026-01-01",
+            "expression": _prefix_reader_expression(
+                "trial/wes", datetime.date(2026, 1, 1)
+            ),
+        },
+    }
+    # a binding for the same prefix in another bucket isn't the data bucket's to replace
+    other_bucket_binding = copy.deepcopy(existing_binding)
+    other_bucket_binding["condition"]["expression"] = other_bucket_binding["condition"][
+        "expression"
+    ].replace(GOOGLE_ACL_DATA_BUCKET, "some-other-bucket")
+    bucket = FakePolicyBucket(
+        [unrelated_binding, existing_binding, other_bucket_binding]
+    )
+    monkeypatch.setattr(uploads, "get_bucket", lambda name: bucket)
+
+    uploads._gcs_add_prefix_reader_permission("a@example.com", "/trial/wes")
+    uploads._gcs_add_prefix_reader_permission("b@example.com", 'trial/"quoted"')
+    assert bucket.writes == 2
+    assert unrelated_binding in bucket.bindings
+    assert other_bucket_binding in bucket.bindings
+    # the existing binding is replaced
+    assert existing_binding not in bucket.bindings
+    assert bucket.grants() == {
+        ("group:a@example.com", other_bucket_binding["condition"]["expression"]),
+        ("group:a@example.com", _prefix_reader_expression("trial/wes", expiry)),
+        (
+            "group:b@example.com",
+            _prefix_reader_expression('trial/\\"quoted\\"', expiry),
+        ),
+    }
+
+    # granting what's already granted doesn't write the policy
+    uploads._gcs_add_prefix_reader_permission("a@example.com", "trial/wes")
+    assert bucket.writes == 2
+
+    # concurrent writes are retried on top of, and so preserve, the other writers' changes
+    bucket.concurrent_writes = 2
+    uploads._gcs_add_prefix_reader_permission("c@example.com", "trial/wes")
+    assert bucket.writes == 3
+    assert len(bucket.bindings) == 7
+    assert len(bucket.grants()) == 4
+
+    # and give up after GOOGLE_IAM_POLICY_MAX_ATTEMPTS
+    bucket.concurrent_writes = uploads.GOOGLE_IAM_POLICY_MAX_ATTEMPTS
+    with pytest.raises(PreconditionFailed):
+        uploads._gcs_add_prefix_reader_permission("d@example.com", "trial/wes")
+    assert bucket.writes == 3
+
+
+def test_remove_expired_gcs_bindings(monkeypatch):
+    """Test that expired conditional bindings are removed in one policy update"""
+    today = datetime.date.today()
+    expired = _prefix_reader_expression("trial/wes", today - datetime.timedelta(1))
+    current = _prefix_reader_expression("trial/olink", today + datetime.timedelta(1))
+    bindings = [
+        {"role": "roles/storage.admin", "members": {"user:admin"}},
+        {"role": "r", "members": {"group:a"}, "condition": {"expression": expired}},
+        {"role": "r", "members": {"group:b"}, "condition": {"expression": expired}},
+        {"role": "r", "members": {"group:c"}, "condition": {"expression": current}},
+        # only expired conjunctions are known to be dead
+        {
+            "role": "r",
+            "members": {"group:d"},
+            "condition": {"expression": expired.replace(" && ", " || ")},
+        },
+        {
+            "role": "r",
+            "members": {"group:e"},
+            "condition": {"expression": 'request.time < timestamp("garbage")'},
+        },
+    ]
+    bucket = FakePolicyBucket(bindings, concurrent_writes=1)
+    monkeypatch.setattr(uploads, "get_bucket", lambda name: bucket)
+
+    assert uploads.remove_expired_gcs_bindings({}, {}) == 2
+    assert bucket.writes == 1
+    members = [binding["members"] for binding in bucket.bindings]
+    assert {"group:a"} not in members and {"group:b"} not in members
+    # the concurrent writer's binding survives the retry
+    assert len(bucket.bindings) == 5
+
+    assert uploads.remove_expired_gcs_bindings({}, {}) == 0
+    assert bucket.writes == 1
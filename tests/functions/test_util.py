@@ -1,10 +1,16 @@
+import time
+import timeit
+import tracemalloc
+from functools import partial
 from io import BytesIO, StringIO
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, call
 
 import pytest
+from google.api_core.exceptions import ServiceUnavailable
 
-from tests.util import make_pubsub_event
+from tests.util import make_pubsub_event, FakeTopic
 from functions import util
+from functions.settings import GOOGLE_ARTIFACT_UPLOAD_TOPIC
 
 
 def test_extract_pubsub_data():
@@ -75,3 +81,362 @@ def test_get_blob_as_stream(monkeypatch):
     stream = util.get_blob_as_stream("", as_string=True)
     assert isinstance(stream, StringIO)
     assert stream.read() == blob_str
+
+
+class _FakeChunkedBlob:
+    """Writes `size` bytes to a file object in `chunk_size` pieces, like a ranged download."""
+
+    def __init__(self, size: int, chunk: bytes):
+        self.size = size
+        self.chunk = chunk
+        self.chunk_size = None
+
+    def download_to_file(self, file_obj):
+        for _ in range(self.size // len(self.chunk)):
+            file_obj.write(self.chunk)
+
+
+def test_get_blob_as_stream_streaming(monkeypatch):
+    """Ensure streamed blob downloads end up in memory or on disk depending on size"""
+    bucket = MagicMock()
+    monkeypatch.setattr(util, "get_bucket", lambda name: bucket)
+    monkeypatch.setattr(util, "BLOB_SPOOL_MAX_MEMORY_BYTES", 1024)
+
+    # small blobs stay in memory
+    bucket.get_blob.return_value = blob = _FakeChunkedBlob(16, b"foo,bar\n")
+    stream = util.get_blob_as_stream("foo.csv", streaming=True)
+    assert isinstance(stream, BytesIO)
+    assert stream.read() == b"foo,bar\nfoo,bar\n"
+    assert blob.chunk_size == util.BLOB_DOWNLOAD_CHUNK_SIZE
+
+    stream = util.get_blob_as_stream("foo.csv", as_string=True, streaming=True)
+    assert stream.read() == "foo,bar\nfoo,bar\n"
+
+    # big blobs go to disk
+    bucket.get_blob.return_value = _FakeChunkedBlob(2048, b"foo,bar\n")
+    stream = util.get_blob_as_stream("foo.csv", as_string=True, streaming=True)
+    assert not isinstance(stream.buffer, BytesIO)
+    assert stream.read() == "foo,bar\n" * 256
+
+    # missing blobs raise
+    bucket.get_blob.return_value = None
+    with pytest.raises(FileNotFoundError, match="Could not find file"):
+        util.get_blob_as_stream("foo.csv", streaming=True)
+
+
+def test_get_blob_as_stream_streaming_memory(monkeypatch):
+    """Check that peak memory use while streaming a large blob is bounded by the chunk size"""
+    chunk_size = 256 * 1024
+    blob_size = 32 * chunk_size
+    chunk = b"x" * chunk_size
+
+    bucket = MagicMock()
+    bucket.get_blob.return_value = _FakeChunkedBlob(blob_size, chunk)
+    monkeypatch.setattr(util, "get_bucket", lambda name: bucket)
+    monkeypatch.setattr(util, "BLOB_SPOOL_MAX_MEMORY_BYTES", 4 * chunk_size)
+
+    tracemalloc.start()
+    try:
+        stream = util.get_blob_as_stream("big.bin", streaming=True)
+        stream.seek(0, 2)
+        assert stream.tell() == blob_size
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        stream.close()
+
+    assert peak < 2 * chunk_size
+
+
+def test_get_bucket(monkeypatch):
+    """Check that the shared storage client and bucket handles are reused until they expire"""
+    client = MagicMock()
+    storage_client = MagicMock()
+    storage_client.return_value = client
+    monkeypatch.setattr(util.storage, "Client", storage_client)
+    monkeypatch.setattr(util, "_storage_client", None)
+    monkeypatch.setattr(util, "_bucket_cache", {})
+
+    assert util.get_storage_client() is util.get_storage_client()
+    storage_client.assert_called_once()
+
+    bucket = util.get_bucket("foo")
+    assert util.get_bucket("foo") is bucket
+    client.get_bucket.assert_called_once_with("foo")
+
+    util.get_bucket("bar")
+    assert client.get_bucket.call_count == 2
+
+    # Once the TTL elapses, the bucket metadata is fetched again
+    monkeypatch.setattr(util, "GOOGLE_BUCKET_CACHE_TTL_SECONDS", 0)
+    util.get_bucket("foo")
+    assert client.get_bucket.call_count == 3
+
+    util.clear_storage_cache()
+    util.get_storage_client()
+    assert storage_client.call_count == 2
+
+
+def test_pubsub_message_codec(monkeypatch):
+    """Check that pub/sub messages round-trip, including legacy and compressed forms"""
+    data = {"trial_id": "foo", "upload_type": ["bar", "baz"], "revoke": True}
+
+    message = util.encode_pubsub_message(data)
+    assert util.decode_pubsub_message(message) == data
+
+    # legacy str(dict) and plain JSON messages are still accepted
+    assert util.decode_pubsub_message(str(data)) == data
+    assert util.decode_pubsub_message('{"trial_id": "foo"}') == {"trial_id": "foo"}
+
+    # large messages are compressed
+    monkeypatch.setattr(util, "PUBSUB_COMPRESSION_THRESHOLD_BYTES", 10)
+    compressed = util.encode_pubsub_message(data)
+    assert "zlib" in compressed
+    assert util.decode_pubsub_message(compressed) == data
+
+    # schema validation
+    schema = {"trial_id": (str, type(None)), "revoke": (bool,)}
+    assert util.decode_pubsub_message(message, schema=schema) == data
+    with pytest.raises(TypeError, match="revoke must be bool, got str"):
+        util.decode_pubsub_message(str({"revoke": "True"}), schema=schema)
+
+    # malformed messages
+    for bad_message in ["", "foo", "__import__('os')", "[1, 2]", '{"_v": 100}']:
+        with pytest.raises(ValueError):
+            util.decode_pubsub_message(bad_message)
+
+
+def _permissions_worker_message(num_blobs: int) -> dict:
+    return {
+        "_fn": "permissions_worker",
+        "user_email_list": ["foo@bar.com", "user@test.com"],
+        "blob_name_list": [
+            f"CIMAC-12345/wes/CTTTPP{n:05d}S1.01/reads_{n}.bam"
+            for n in range(num_blobs)
+        ],
+        "revoke": False,
+    }
+
+
+@pytest.mark.parametrize("num_blobs", [100, 10000])
+def test_pubsub_message_codec_worker_messages(num_blobs):
+    """Check that worker messages round-trip, compressed when they're big"""
+    data = _permissions_worker_message(num_blobs)
+    legacy_message = str(data)
+    message = util.encode_pubsub_message(data)
+    assert util.decode_pubsub_message(message) == data
+    assert util.decode_pubsub_message(legacy_message) == data
+
+    if len(legacy_message) >= util.PUBSUB_COMPRESSION_THRESHOLD_BYTES:
+        assert "zlib" in message
+        assert len(message) < len(legacy_message) / 2
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("num_blobs", [100, 1000, 10000])
+def test_pubsub_message_codec_benchmark(num_blobs):
+    """Compare encoding and decoding worker messages with the codec against the legacy str(dict) format"""
+    data = _permissions_worker_message(num_blobs)
+    legacy_message = str(data)
+    message = util.encode_pubsub_message(data)
+
+    best_of = lambda f: min(timeit.repeat(f, number=5, repeat=3))
+    encode_time = best_of(lambda: util.encode_pubsub_message(data))
+    legacy_encode_time = best_of(lambda: str(data))
+    decode_time = best_of(lambda: util.decode_pubsub_message(message))
+    legacy_decode_time = best_of(lambda: util.decode_pubsub_message(legacy_message))
+    print(
+        f"{num_blobs} blobs: encode {encode_time / 5 * 1000:.2f}ms "
+        f"(legacy {legacy_encode_time / 5 * 1000:.2f}ms), "
+        f"decode {decode_time / 5 * 1000:.2f}ms "
+        f"(legacy {legacy_decode_time / 5 * 1000:.2f}ms)"
+    )
+    # the codec costs more to encode, but that's paid once per message by the publisher
+    assert encode_time + decode_time < legacy_encode_time + legacy_decode_time
+
+
+def test_batch_publisher():
+    """Check that BatchPublisher overlaps publishes, bounds concurrency and reports failures"""
+    latency, num_messages, max_in_flight = 0.05, 40, 10
+    topic = FakeTopic(latency=latency, fail=lambda message: message.endswith("7"))
+    publisher = util.BatchPublisher(topic, "some-topic", max_in_flight=max_in_flight)
+
+    for i in range(num_messages):
+        publisher.publish(f"message {i}")
+    failures = publisher.wait()
+
+    assert [m for m, _ in topic.messages] == [f"message {i}" for i in range(40)]
+    assert all(t == "some-topic" for _, t in topic.messages)
+    # publishes overlap, up to max_in_flight at once
+    assert 1 < topic.max_in_flight <= max_in_flight
+    assert topic.in_flight == 0
+
+    assert publisher.published == num_messages
+    assert sorted(m for m, _ in failures) == [
+        "message 17",
+        "message 27",
+        "message 37",
+        "message 7",
+    ]
+    assert all("failed to publish" in str(e) for _, e in failures)
+
+    # errors raised while publishing are reported too, and None futures are fine
+    def publish_fn(message, topic):
+        if message == "bad":
+            raise ValueError("bad message")
+        return None
+
+    publisher = util.BatchPublisher(publish_fn, "some-topic", max_in_flight=1)
+    for message in ["good", "bad", "good"]:
+        publisher.publish(message)
+    failures = publisher.wait()
+    assert [(m, str(e)) for m, e in failures] == [("bad", "bad message")]
+
+
+def test_batch_publisher_retries(monkeypatch):
+    """Check that BatchPublisher retries transient failures and gives up at its deadline"""
+    monkeypatch.setattr(util, "PUBSUB_PUBLISH_RETRY_DELAY_SECONDS", 0.01)
+
+    # transient failures are retried, up to max_attempts tries in all
+    topic = FakeTopic(fail_rate=0.5, fail=lambda message: message == "message 0")
+    publisher = util.BatchPublisher(topic, "some-topic", max_attempts=10)
+    for i in range(20):
+        publisher.publish(f"message {i}")
+    failures = publisher.wait()
+    assert [m for m, _ in failures] == ["message 0"]
+    assert publisher.retried > 0
+    assert len(topic.messages) == 20 + publisher.retried
+    assert publisher.summary() == (
+        f"19 of 20 some-topic messages confirmed ({publisher.retried} retries, 1 failed)"
+    )
+
+    topic = FakeTopic(fail_rate=1)
+    publisher = util.BatchPublisher(topic, "some-topic", max_attempts=3)
+    publisher.publish("message")
+    failures = publisher.wait()
+    assert len(topic.messages) == 3
+    assert [type(e) for _, e in failures] == [ServiceUnavailable]
+
+    # messages that aren't confirmed by the deadline fail
+    topic = FakeTopic(latency=1)
+    publisher = util.BatchPublisher(topic, "some-topic")
+    for i in range(5):
+        publisher.publish(f"message {i}")
+    start = time.monotonic()
+    failures = publisher.wait(timeout_seconds=0.1)
+    assert time.monotonic() - start < 0.5
+    assert len(failures) == 5
+    assert all(isinstance(e, TimeoutError) for _, e in failures)
+
+
+def test_batch_publisher_stalled():
+    """Check that BatchPublisher stops waiting for slots when confirmations stall"""
+    # futures that are never confirmed never free up their slots
+    publish_fn = MagicMock()
+    publisher = util.BatchPublisher(
+        publish_fn, "some-topic", max_in_flight=2, timeout_seconds=0.1
+    )
+    start = time.monotonic()
+    for i in range(10):
+        publisher.publish(f"message {i}")
+    # only the first message without a slot waits for one
+    assert time.monotonic() - start < 0.5
+    assert publish_fn.call_count == 2
+    assert [m for m, _ in publisher.failures] == [f"message {i}" for i in range(2, 10)]
+    assert all(isinstance(e, TimeoutError) for _, e in publisher.failures)
+
+
+def test_publish_artifact_upload_batches(monkeypatch, capsys):
+    """Check that an upload's object URLs are published in batches."""
+    monkeypatch.setattr(util, "VIS_PREPROCESSING_BATCH_SIZE", 2)
+    publish = MagicMock()
+
+    object_urls = [f"trial/file{i}" for i in range(5)]
+    util.publish_artifact_upload_batches(publish, object_urls)
+    assert publish.call_args_list == [
+        call(
+            util.encode_pubsub_message({"object_urls": batch}),
+            GOOGLE_ARTIFACT_UPLOAD_TOPIC,
+        )
+        for batch in [object_urls[0:2], object_urls[2:4], object_urls[4:]]
+    ]
+
+    # publishing failures are logged, not raised
+    publish.return_value.result.side_effect = Exception("pubsub is down")
+    util.publish_artifact_upload_batches(publish, object_urls)
+    assert (
+        "Failed to publish 3 of 3 artifact_upload messages" in capsys.readouterr().out
+    )
+
+    # as are messages that never get a slot to publish in
+    monkeypatch.setattr(
+        util,
+        "BatchPublisher",
+        partial(util.BatchPublisher, max_in_flight=1, timeout_seconds=0.1),
+    )
+    publish = MagicMock()
+    util.publish_artifact_upload_batches(publish, object_urls)
+    assert publish.call_count == 1
+    assert (
+        "Failed to publish 2 of 3 artifact_upload messages" in capsys.readouterr().out
+    )
+
+
+@pytest.mark.benchmark
+def test_batch_publisher_throughput(monkeypatch):
+    """Measure BatchPublisher's throughput against a slow, unreliable topic"""
+    monkeypatch.setattr(util, "PUBSUB_PUBLISH_RETRY_DELAY_SECONDS", 0.01)
+    latency, num_messages = 0.02, 1000
+    topic = FakeTopic(latency=latency, fail_rate=0.1)
+    publisher = util.BatchPublisher(topic, "some-topic", max_attempts=5)
+
+    start = time.monotonic()
+    for i in range(num_messages):
+        publisher.publish(f"message {i}")
+    failures = publisher.wait()
+    elapsed = time.monotonic() - start
+
+    assert failures == []
+    assert publisher.retried > 0
+    # one at a time, even without retries, would take num_messages * latency
+    assert elapsed < num_messages * latency / 4
+
+
+def _add(a, b):
+    return a + b
+
+
+def _raise_value_error():
+    raise ValueError("bad input")
+
+
+def _sleep(seconds):
+    time.sleep(seconds)
+
+
+def _allocate(num_bytes):
+    return len(bytearray(num_bytes))
+
+
+def test_run_with_budget():
+    """Check that run_with_budget returns results and enforces its budgets"""
+    run = lambda fn, *args, timeout=30: util.run_with_budget(
+        fn, *args, timeout_seconds=timeout, max_memory_bytes=256 * 1024 * 1024
+    )
+
+    assert run(_add, 1, 2) == 3
+
+    # exceptions from the function are re-raised
+    with pytest.raises(ValueError, match="bad input"):
+        run(_raise_value_error)
+
+    # the worker is killed when it runs too long
+    start = time.time()
+    with pytest.raises(util.BudgetExceeded, match="time budget"):
+        run(_sleep, 30, timeout=1)
+    assert time.time() - start < 10
+
+    # and can't allocate past its memory budget
+    with pytest.raises(util.BudgetExceeded, match="memory budget"):
+        run(_allocate, 1024 * 1024 * 1024)
+    assert run(_allocate, 1024 * 1024) == 1024 * 1024
@@ -1,22 +1,47 @@
+import json
 import os
-from io import StringIO
+import re
+import time
+import zipfile
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from io import BytesIO, StringIO
 from unittest.mock import MagicMock
 
 import pytest
+import numpy as np
 import pandas as pd
+from deepdiff import DeepSearch
+from openpyxl import Workbook, load_workbook
 
 import functions.visualizations
 from functions.visualizations import (
+    CLUSTERGRAMMER_MAX_CATEGORY_CARDINALITY,
     vis_preprocessing,
     DownloadableFiles,
     TrialMetadata,
+    _ClustergrammerCache,
     _ClustergrammerTransform,
     _cytof_summary_to_dataframe,
+    _ihc_combined_transform,
+    _to_columnar,
+    _downsample,
     _npx_to_dataframe,
     _metadata_to_categories,
+    prism,
     _add_antibody_metadata,
+    _build_artifact_index,
+    _get_metadata_df,
+    _merge_metadata,
+    _MetadataDFCache,
+    _TransformContext,
+    invalidate_metadata_df_cache,
+    update_metadata_snapshot,
+    metadata_df_cache_info,
 )
 
+from functions.util import encode_pubsub_message
 from tests.util import make_pubsub_event
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
@@ -66,6 +91,450 @@ def test_loading_lazily(monkeypatch, metadata_df):
     get_blob_as_stream.assert_not_called()
 
 
+def test_vis_preprocessing_batch(monkeypatch, metadata_df):
+    """Test that a batch of files is processed with one metadata load per trial and one commit"""
+    records = {}
+    for i, trial_id in enumerate(["trial-1", "trial-1", "trial-2"]):
+        record = MagicMock()
+        record.object_url = f"{trial_id}/file{i}.txt"
+        record.trial_id = trial_id
+        record.upload_type = "something"
+        records[record.object_url] = record
+    monkeypatch.setattr(
+        DownloadableFiles,
+        "get_by_object_url",
+        lambda object_url, session: records.get(object_url),
+    )
+
+    session = MagicMock()
+
+    @contextmanager
+    def sqlalchemy_session():
+        yield session
+
+    monkeypatch.setattr(
+        functions.visualizations, "sqlalchemy_session", sqlalchemy_session
+    )
+
+    _get_metadata_df = MagicMock()
+    _get_metadata_df.return_value = metadata_df
+    monkeypatch.setattr(functions.visualizations, "_get_metadata_df", _get_metadata_df)
+
+    transform = MagicMock()
+    transform.return_value = {"foo": "bar"}
+    monkeypatch.setattr(
+        functions.visualizations, "_get_transforms", lambda: {"foo": transform}
+    )
+
+    message = encode_pubsub_message({"object_urls": list(records)})
+    vis_preprocessing(make_pubsub_event(message), {})
+    assert transform.call_count == 3
+    assert [c[0][0] for c in transform.call_args_list] == list(records.values())
+    # every transform in the invocation shares one context
+    assert len({id(c[0][2]) for c in transform.call_args_list}) == 1
+    assert all(record.foo == {"foo": "bar"} for record in records.values())
+    assert _get_metadata_df.call_args_list == [(("trial-1",),), (("trial-2",),)]
+    session.commit.assert_called_once()
+
+    # a file that fails doesn't hold back the rest of its batch
+    transform.reset_mock()
+    session.reset_mock()
+    for record in records.values():
+        record.foo = None
+    failing_record = records["trial-1/file1.txt"]
+    transform.side_effect = lambda record, *args: (
+        1 / 0 if record is failing_record else {"foo": "bar"}
+    )
+    message = encode_pubsub_message({"object_urls": [*records, "trial-1/missing"]})
+    with pytest.raises(
+        Exception,
+        match="Failed to generate visualization data for 2 of 4 files: trial-1/file1.txt, trial-1/missing",
+    ) as excinfo:
+        vis_preprocessing(make_pubsub_event(message), {})
+    assert isinstance(excinfo.value.__cause__, ZeroDivisionError)
+    assert transform.call_count == 3
+    assert [record.foo for record in records.values()] == [
+        {"foo": "bar"},
+        None,
+        {"foo": "bar"},
+    ]
+    session.commit.assert_called_once()
+
+    # and if every file fails, nothing is saved
+    session.reset_mock()
+    message = encode_pubsub_message({"object_urls": ["trial-1/missing"]})
+    with pytest.raises(Exception, match="No downloadable file with object URL"):
+        vis_preprocessing(make_pubsub_event(message), {})
+    session.commit.assert_not_called()
+
+    with pytest.raises(ValueError, match="no object_urls"):
+        vis_preprocessing(make_pubsub_event(encode_pubsub_message({})), {})
+
+
+def test_antibody_metadata_loads_trial_once(monkeypatch, metadata_df):
+    """Test that a batch of files loads its trial's metadata once, in the invocation's session"""
+    records = {}
+    for i in range(2):
+        record = MagicMock()
+        record.object_url = f"trial-1/mif/file{i}.txt"
+        record.trial_id = "trial-1"
+        record.upload_type = "mif"
+        record.additional_metadata = {}
+        records[record.object_url] = record
+    monkeypatch.setattr(
+        DownloadableFiles,
+        "get_by_object_url",
+        lambda object_url, session: records.get(object_url),
+    )
+
+    session = MagicMock()
+
+    @contextmanager
+    def sqlalchemy_session():
+        yield session
+
+    monkeypatch.setattr(
+        functions.visualizations, "sqlalchemy_session", sqlalchemy_session
+    )
+    monkeypatch.setattr(
+        functions.visualizations, "_get_metadata_df", lambda trial_id: metadata_df
+    )
+
+    ct = MagicMock()
+    ct.metadata_json = {
+        "assays": {
+            "mif": [
+                {"antibodies": [{"export_name": f"Foo{i}"}], "object_url": url}
+                for i, url in enumerate(records)
+            ]
+        }
+    }
+    find_by_trial_id = MagicMock()
+    find_by_trial_id.return_value = ct
+    monkeypatch.setattr(TrialMetadata, "find_by_trial_id", find_by_trial_id)
+
+    message = encode_pubsub_message({"object_urls": list(records)})
+    vis_preprocessing(make_pubsub_event(message), {})
+    find_by_trial_id.assert_called_once_with("trial-1", session=session)
+    assert [r.additional_metadata for r in records.values()] == [
+        {"mif.antibodies": "Foo0"},
+        {"mif.antibodies": "Foo1"},
+    ]
+
+
+def test_build_artifact_index():
+    """Test that object URLs are indexed by the assay instance they appear in"""
+    trial_metadata = {
+        "assays": {
+            "mif": [
+                {"records": [{"files": {"a": {"object_url": "mif/1/a"}}}]},
+                {
+                    "records": [
+                        {"files": {"a": {"object_url": "mif/2/a"}}},
+                        {"files": {"a": {"object_url": "shared"}}},
+                    ]
+                },
+            ],
+            "ihc": [{"object_url": "shared"}, {"object_url": "shared"}],
+            "olink": {"object_url": "olink/a"},
+        }
+    }
+    assert _build_artifact_index(trial_metadata) == {
+        "mif/1/a": [("mif", 0)],
+        "mif/2/a": [("mif", 1)],
+        "shared": [("mif", 1), ("ihc", 0), ("ihc", 1)],
+    }
+
+
+def test_artifact_index_cache(monkeypatch):
+    """Test that a trial's cached artifact index is rebuilt when its metadata changes"""
+    trial = MagicMock()
+    trial._etag = "unchanged"
+    trial.metadata_json = {"assays": {"mif": [{"object_url": "mif/a"}]}}
+    monkeypatch.setattr(TrialMetadata, "find_by_trial_id", lambda *a, **kw: trial)
+    monkeypatch.setattr(
+        functions.visualizations, "_artifact_index_cache", OrderedDict()
+    )
+    build_artifact_index = MagicMock(side_effect=_build_artifact_index)
+    monkeypatch.setattr(
+        functions.visualizations, "_build_artifact_index", build_artifact_index
+    )
+
+    get_index = lambda: _TransformContext(MagicMock()).get_artifact_index("trial-1")
+    assert get_index() == {"mif/a": [("mif", 0)]}
+    assert get_index() == {"mif/a": [("mif", 0)]}
+    assert build_artifact_index.call_count == 1
+
+    # e.g. file derivation rewrites metadata_json without touching _etag
+    trial.metadata_json = {
+        "assays": {"mif": [{"object_url": "mif/b"}, {"object_url": "mif/a"}]}
+    }
+    assert get_index() == {"mif/b": [("mif", 0)], "mif/a": [("mif", 1)]}
+    assert build_artifact_index.call_count == 2
+
+
+def _mif_trial_metadata(num_instances: int) -> dict:
+    return {
+        "assays": {
+            "mif": [
+                {
+                    "assay_creator": "DFCI",
+                    "antibodies": [{"export_name": f"CD{i}", "fluor_wavelength": 500}],
+                    "records": [
+                        {
+                            "cimac_id": f"CTTTPP{i:04d}S1.01",
+                            "files": {
+                                "multispectral_image": {
+                                    "object_url": f"CIMAC-12345/mif/CTTTPP{i:04d}S1.01/image.tif",
+                                    "upload_placeholder": f"{i}",
+                                },
+                                "score_data": {
+                                    "object_url": f"CIMAC-12345/mif/CTTTPP{i:04d}S1.01/score.txt",
+                                    "upload_placeholder": f"{i}",
+                                },
+                            },
+                        }
+                    ],
+                }
+                for i in range(num_instances)
+            ]
+        }
+    }
+
+
+def test_artifact_index_matches_deepsearch():
+    """Check that the index finds the same assay instance for each file as DeepSearch did"""
+    assay_instances = _mif_trial_metadata(20)["assays"]["mif"]
+    index = _build_artifact_index({"assays": {"mif": assay_instances}})
+
+    for instance in assay_instances:
+        for file in instance["records"][0]["files"].values():
+            ds = DeepSearch(assay_instances, file["object_url"])
+            # e.g., "root[3]['records'][0]['files']['score_data']['object_url']"
+            (path,) = ds["matched_values"]
+            position = int(path[len("root[") : path.index("]")])
+            assert index[file["object_url"]] == [("mif", position)]
+
+
+@pytest.mark.benchmark
+def test_artifact_index_benchmark():
+    """Compare finding each file's assay instance with the index against DeepSearch"""
+    trial_metadata = _mif_trial_metadata(2000)
+    assay_instances = trial_metadata["assays"]["mif"]
+    object_urls = [
+        instance["records"][0]["files"]["score_data"]["object_url"]
+        for instance in assay_instances
+    ]
+
+    # one DeepSearch walks every instance, so time a sample of files and scale up
+    sample = object_urls[::200]
+    start = time.perf_counter()
+    for object_url in sample:
+        DeepSearch(assay_instances, object_url)
+    deepsearch_time = (time.perf_counter() - start) * len(object_urls) / len(sample)
+
+    start = time.perf_counter()
+    index = _build_artifact_index(trial_metadata)
+    for object_url in object_urls:
+        index[object_url]
+    index_time = time.perf_counter() - start
+
+    assert index_time < deepsearch_time / 100
+
+
+def test_get_metadata_df_cache(monkeypatch):
+    """Test that metadata dataframes are reused until the trial's CSVs change"""
+    monkeypatch.setattr(
+        functions.visualizations, "_metadata_df_cache", _MetadataDFCache(2, 2**20)
+    )
+
+    csvs = {
+        "participants.csv": "cimac_participant_id,cohort_name\nCTTTTPP,Arm_A",
+        "samples.csv": "cimac_id,participants.cimac_participant_id\nCTTTTPPS1.01,CTTTTPP",
+    }
+    generations = {}
+
+    def get_data_blob(object_name):
+        blob = MagicMock()
+        blob.name = object_name
+        blob.generation = generations.get(object_name, 1)
+        return blob
+
+    stream_blob = MagicMock(
+        side_effect=lambda blob, as_string: StringIO(csvs[blob.name.split("/")[1]])
+    )
+    monkeypatch.setattr(functions.visualizations, "get_data_blob", get_data_blob)
+    monkeypatch.setattr(functions.visualizations, "stream_blob", stream_blob)
+
+    metadata_df = _get_metadata_df("trial-1")
+    assert list(metadata_df.index) == ["CTTTTPPS1.01"]
+    assert _get_metadata_df("trial-1") is metadata_df
+    assert stream_blob.call_count == 2
+    assert metadata_df_cache_info()[:3] == (1, 1, 1)
+
+    # a rewritten samples.csv has a new generation, so is re-read
+    generations["trial-1/samples.csv"] = 2
+    assert _get_metadata_df("trial-1") is not metadata_df
+    assert stream_blob.call_count == 4
+    assert metadata_df_cache_info()[:3] == (1, 2, 1)
+
+    # least recently used trials are evicted past the entry limit
+    _get_metadata_df("trial-2")
+    _get_metadata_df("trial-3")
+    assert metadata_df_cache_info().entries == 2
+    stream_blob.reset_mock()
+    _get_metadata_df("trial-1")
+    assert stream_blob.call_count == 2
+
+    invalidate_metadata_df_cache("trial-1")
+    assert metadata_df_cache_info().entries == 1
+    invalidate_metadata_df_cache()
+    assert metadata_df_cache_info().entries == 0
+
+    # dataframes larger than the memory cap aren't cached at all
+    functions.visualizations._metadata_df_cache.max_bytes = 1
+    _get_metadata_df("trial-1")
+    assert metadata_df_cache_info().entries == 0
+
+
+def test_metadata_snapshot(monkeypatch):
+    """Test that metadata dataframes are read from up-to-date metadata snapshots"""
+    monkeypatch.setattr(functions.visualizations, "_metadata_snapshots_enabled", True)
+    monkeypatch.setattr(
+        functions.visualizations, "_metadata_df_cache", _MetadataDFCache(0, 0)
+    )
+
+    participants_csv = "cimac_participant_id,cohort_name\nCTTTTPP,Arm_A\nCTTTTPQ,Arm_B"
+    samples_csv = (
+        "cimac_id,participants.cimac_participant_id,collection_event_name\n"
+        "CTTTTPPS1.01,CTTTTPP,Baseline\nCTTTTPQS1.01,CTTTTPQ,\n"
+    )
+    # object name -> (data, generation, custom metadata)
+    bucket = {
+        "trial-1/participants.csv": (participants_csv, 1, None),
+        "trial-1/samples.csv": (samples_csv, 1, None),
+    }
+
+    def get_data_blob(object_name):
+        if object_name not in bucket:
+            raise FileNotFoundError(object_name)
+        data, generation, metadata = bucket[object_name]
+        blob = MagicMock()
+        blob.name = object_name
+        blob.generation = generation
+        blob.metadata = metadata
+
+        def patch():
+            bucket[object_name] = (data, generation, blob.metadata)
+
+        blob.patch.side_effect = patch
+        return blob
+
+    def get_internal_blob(object_name):
+        assert object_name.startswith("_cache/metadata/")
+        try:
+            return get_data_blob(object_name)
+        except FileNotFoundError:
+            return None
+
+    def upload_to_internal_bucket(object_name, data, metadata=None):
+        generation = bucket.get(object_name, (None, 0))[1] + 1
+        bucket[object_name] = (data, generation, metadata)
+
+    read_objects = []
+
+    def stream_blob(blob, as_string=False):
+        read_objects.append(blob.name)
+        data = bucket[blob.name][0]
+        return StringIO(data) if as_string else BytesIO(data)
+
+    monkeypatch.setattr(functions.visualizations, "get_data_blob", get_data_blob)
+    monkeypatch.setattr(functions.visualizations, "stream_blob", stream_blob)
+    monkeypatch.setattr(
+        functions.visualizations, "get_internal_blob", get_internal_blob
+    )
+    monkeypatch.setattr(
+        functions.visualizations, "upload_to_internal_bucket", upload_to_internal_bucket
+    )
+
+    # without a snapshot, metadata comes from the CSVs
+    csv_metadata_df = _get_metadata_df("trial-1")
+    assert read_objects == ["trial-1/participants.csv", "trial-1/samples.csv"]
+
+    snapshot_name = "_cache/metadata/trial-1.parquet"
+    update_metadata_snapshot(
+        "trial-1",
+        get_data_blob("trial-1/participants.csv"),
+        participants_csv,
+        get_data_blob("trial-1/samples.csv"),
+        samples_csv,
+    )
+    assert bucket[snapshot_name][1:] == (
+        1,
+        {"participants_generation": "1", "samples_generation": "1"},
+    )
+
+    read_objects.clear()
+    snapshot_metadata_df = _get_metadata_df("trial-1")
+    assert read_objects == [snapshot_name]
+    pd.testing.assert_frame_equal(snapshot_metadata_df, csv_metadata_df)
+    # missing values come back as NaN, as from the CSVs, not None
+    assert snapshot_metadata_df.equals(csv_metadata_df)
+    categories = _metadata_to_categories(csv_metadata_df)
+    assert "Collection Event: nan" in categories[1]
+    assert _metadata_to_categories(snapshot_metadata_df) == categories
+
+    # CSVs rewritten with the same contents only update the snapshot's metadata
+    bucket["trial-1/samples.csv"] = (samples_csv, 2, None)
+    read_objects.clear()
+    update_metadata_snapshot(
+        "trial-1",
+        get_data_blob("trial-1/participants.csv"),
+        participants_csv,
+        get_data_blob("trial-1/samples.csv"),
+        samples_csv,
+    )
+    assert bucket[snapshot_name][1:] == (
+        1,
+        {"participants_generation": "1", "samples_generation": "2"},
+    )
+    _get_metadata_df("trial-1")
+    assert read_objects == [snapshot_name, snapshot_name]
+
+    # snapshots that don't match the current CSVs are ignored
+    bucket["trial-1/samples.csv"] = (samples_csv, 3, None)
+    read_objects.clear()
+    _get_metadata_df("trial-1")
+    assert read_objects == ["trial-1/participants.csv", "trial-1/samples.csv"]
+
+
+def test_metadata_snapshot_mixed_types():
+    """Check that columns mixing strings and numbers can be snapshotted, and give the same categories"""
+    participants_df = pd.DataFrame(
+        {
+            "cimac_participant_id": ["CTTTTPP", "CTTTTPQ", "CTTTTPR"],
+            "cohort_name": ["Arm_A", 2, np.nan],
+        }
+    )
+    samples_df = pd.DataFrame(
+        {
+            "cimac_id": ["CTTTTPPS1.01", "CTTTTPQS1.01", "CTTTTPRS1.01"],
+            "participants.cimac_participant_id": ["CTTTTPP", "CTTTTPQ", "CTTTTPR"],
+            "collection_event_name": ["Baseline", None, "Baseline"],
+        }
+    )
+    csv_metadata_df = _merge_metadata(participants_df, samples_df)
+    assert csv_metadata_df["cohort_name"].tolist()[:2] == ["Arm_A", "2"]
+
+    snapshot_metadata_df = functions.visualizations._normalize_metadata_df(
+        pd.read_parquet(BytesIO(csv_metadata_df.to_parquet()))
+    )
+    assert snapshot_metadata_df.equals(csv_metadata_df)
+    assert _metadata_to_categories(snapshot_metadata_df) == _metadata_to_categories(
+        csv_metadata_df
+    )
+
+
 def test_add_antibody_metadata_validation(monkeypatch, metadata_df):
     """Test that the validation checks in _add_antibody_metadata throw errors as expected"""
     record = MagicMock()
@@ -82,11 +551,20 @@ def test_add_antibody_metadata_validation(monkeypatch, metadata_df):
         with pytest.raises(TypeError, match="Issue loading antibodies"):
             _add_antibody_metadata(record, metadata_df)
 
-    ct_nonunique = {"assays": {"mif": ["foo.txt", "foo.txt"]}}
+    ct_nonunique = {
+        "assays": {"mif": [{"object_url": "foo.txt"}, {"object_url": "foo.txt"}]}
+    }
     get_trial_by_id.return_value.metadata_json = ct_nonunique
     with monkeypatch.context() as m:
         m.setattr(TrialMetadata, "find_by_trial_id", get_trial_by_id)
-        with pytest.raises(Exception, match="Issue loading antibodies"):
+        with pytest.raises(Exception, match="Issue loading antibodies.*not unique"):
+            _add_antibody_metadata(record, metadata_df)
+
+    ct_missing = {"assays": {"mif": [{"object_url": "bar.txt"}]}}
+    get_trial_by_id.return_value.metadata_json = ct_missing
+    with monkeypatch.context() as m:
+        m.setattr(TrialMetadata, "find_by_trial_id", get_trial_by_id)
+        with pytest.raises(Exception, match="Issue loading antibodies.*not found"):
             _add_antibody_metadata(record, metadata_df)
 
 
@@ -123,7 +601,7 @@ def test_cytof_antibody_metadata_end_to_end(monkeypatch, metadata_df):
                             "antibody": "Baz",
                         },
                     ],
-                    "object_url": "foo.txt",  # for DeepSearch
+                    "object_url": "foo.txt",
                 }
             ]
         }
@@ -180,7 +658,7 @@ def test_elisa_antibody_metadata_end_to_end(monkeypatch, metadata_df):
                             "antibody": "Baz",
                         },
                     ],
-                    "object_url": "foo.txt",  # for DeepSearch
+                    "object_url": "foo.txt",
                 }
             ]
         }
@@ -222,7 +700,7 @@ def test_ihc_antibody_metadata_end_to_end(monkeypatch, metadata_df):
             "ihc": [
                 {
                     "antibody": {"antibody": "Bar", "clone": "Nx/xxx"},
-                    "object_url": "foo.txt",  # for DeepSearch
+                    "object_url": "foo.txt",
                 }
             ]
         }
@@ -267,7 +745,7 @@ def test_micsss_antibody_metadata_end_to_end(monkeypatch, metadata_df):
                         {"antibody": "Bar", "clone": "Nx/xxx"},
                         {"antibody": "Baz"},
                     ],
-                    "object_url": "foo.txt",  # for DeepSearch
+                    "object_url": "foo.txt",
                 }
             ]
         }
@@ -313,7 +791,7 @@ def test_mif_antibody_metadata_end_to_end(monkeypatch, metadata_df):
                         {"antibody": "Bar", "clone": "Nx/xxx", "fluor_wavelength": 500},
                         {"antibody": "Baz", "fluor_wavelength": 500},
                     ],
-                    "object_url": "foo.txt",  # for DeepSearch
+                    "object_url": "foo.txt",
                 }
             ]
         }
@@ -386,6 +864,125 @@ def test_ihc_combined_end_to_end(monkeypatch, metadata_df):
     ]
 
 
+def test_ihc_combined_columnar(monkeypatch, metadata_df):
+    """Test the IHC combined transform's columnar format."""
+    monkeypatch.setattr(
+        functions.visualizations, "IHC_COMBINED_PLOT_FORMAT", "columnar"
+    )
+    ihc_record = MagicMock()
+    ihc_record.upload_type = "ihc marker combined"
+    combined_csv = StringIO(
+        "cimac_id,foo,bar,tumor\n"
+        "CTTTTPPS1.01,1,2.5,yes\n"
+        "CTTTTPPS2.01,3,,yes\n"
+        "CTTTTPPS2.01,5,4.5,\n"
+        "CTTTTPPS3.01,7,8.5,no\n"
+    )
+    monkeypatch.setattr(
+        functions.visualizations,
+        "get_blob_as_stream",
+        lambda *args, **kwargs: combined_csv,
+    )
+
+    assert _ihc_combined_transform(ihc_record, metadata_df) == {
+        "format": "columnar",
+        "columns": [
+            "cimac_id",
+            "foo",
+            "bar",
+            "tumor",
+            "cimac_participant_id",
+            "cohort_name",
+            "collection_event_name",
+        ],
+        "data": [
+            ["CTTTTPPS1.01", "CTTTTPPS2.01", "CTTTTPPS2.01"],
+            [1, 3, 5],
+            [2.5, None, 4.5],
+            [0, 0, None],
+            [0, 0, 0],
+            [0, 0, 0],
+            ["Event1", "Event2", "Event2"],
+        ],
+        # only strings with few distinct values are dictionary-encoded
+        "categories": {
+            "tumor": ["yes"],
+            "cimac_participant_id": ["CTTTTPP"],
+            "cohort_name": ["Arm_A"],
+        },
+    }
+
+
+def _wide_ihc_df(num_rows: int) -> pd.DataFrame:
+    """A joined IHC combined dataframe with `num_rows` rows"""
+    rng = np.random.default_rng(0)
+    num_samples = max(num_rows // 10, 1)
+    cimac_ids = [f"CTTT{i // 100:03d}{i % 100:02d}.01" for i in range(num_samples)]
+    return pd.DataFrame(
+        {
+            "cimac_id": rng.choice(cimac_ids, num_rows),
+            "marker_positivity": rng.choice(["positive", "negative"], num_rows),
+            "tumor_proportion_score": rng.uniform(size=num_rows),
+            "combined_positive_score": rng.integers(0, 100, num_rows),
+            "intensity": rng.choice([0, 1, 2, 3], num_rows),
+            "cimac_participant_id": rng.choice(cimac_ids, num_rows).astype("U7"),
+            "cohort_name": rng.choice(["Arm_A", "Arm_B", "Arm_C"], num_rows),
+            "collection_event_name": rng.choice(["Baseline", "On_Treatment"], num_rows),
+        }
+    )
+
+
+def _from_columnar(columnar: dict) -> pd.DataFrame:
+    """Decode the columnar IHC combined format back into a dataframe"""
+    data = {}
+    for name, values in zip(columnar["columns"], columnar["data"]):
+        levels = columnar["categories"].get(name)
+        if levels is not None:
+            values = [None if code is None else levels[code] for code in values]
+        data[name] = values
+    return pd.DataFrame(data, columns=columnar["columns"])
+
+
+def test_ihc_combined_columnar_round_trip():
+    """Check that the columnar IHC combined format decodes to the original data and is smaller"""
+    full_df = _wide_ihc_df(2000)
+    full_df.loc[::7, "tumor_proportion_score"] = np.nan
+    full_df.loc[::11, "cohort_name"] = None
+
+    columnar = json.loads(json.dumps(_to_columnar(full_df)))
+    assert set(columnar["categories"]) == {
+        "cimac_id",
+        "marker_positivity",
+        "cimac_participant_id",
+        "cohort_name",
+        "collection_event_name",
+    }
+    # the records format, as the plot would read it, for comparison
+    records_df = pd.DataFrame(json.loads(full_df.to_json(orient="records")))
+    pd.testing.assert_frame_equal(
+        _from_columnar(columnar), records_df, check_dtype=False
+    )
+
+    records_size = len(full_df.to_json(orient="records"))
+    assert len(json.dumps(columnar)) < records_size / 2
+
+
+@pytest.mark.benchmark
+def test_ihc_combined_columnar_benchmark():
+    """Compare the time to serialize the columnar and records formats for a large plot"""
+    full_df = _wide_ihc_df(200_000)
+
+    start = time.perf_counter()
+    json.dumps(json.loads(full_df.to_json(orient="records")))
+    records_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    json.dumps(_to_columnar(full_df))
+    columnar_time = time.perf_counter() - start
+
+    assert columnar_time < records_time
+
+
 def test_npx_clustergrammer_end_to_end(monkeypatch, metadata_df):
     """Test the NPX-clustergrammer transform."""
     # Test no file found
@@ -442,6 +1039,84 @@ def test_npx_clustergrammer_end_to_end(monkeypatch, metadata_df):
     fake_npx.close()
 
 
+def test_clustergrammer_cache(monkeypatch, metadata_df):
+    """Test that clustergrammer configs are reused for unchanged data and metadata"""
+    monkeypatch.setattr(
+        functions.visualizations,
+        "_clustergrammer_cache",
+        _ClustergrammerCache(enabled=True),
+    )
+
+    bucket = {}
+
+    def get_internal_blob(object_name):
+        if object_name not in bucket:
+            return None
+        blob = MagicMock()
+        blob.download_as_string.return_value = bucket[object_name]
+        return blob
+
+    def upload_to_internal_bucket(object_name, data):
+        bucket[object_name] = data
+
+    monkeypatch.setattr(
+        functions.visualizations, "get_internal_blob", get_internal_blob
+    )
+    monkeypatch.setattr(
+        functions.visualizations, "upload_to_internal_bucket", upload_to_internal_bucket
+    )
+
+    npx_record = MagicMock()
+    npx_record.object_url = "npx.xlsx"
+    npx_record.md5_hash = "md5"
+    npx_record.crc32c_hash = "crc32c"
+    get_blob_as_stream = MagicMock(
+        side_effect=lambda *args, **kwargs: open(NPX_PATH, "rb")
+    )
+    monkeypatch.setattr(
+        functions.visualizations, "get_blob_as_stream", get_blob_as_stream
+    )
+
+    transform = _ClustergrammerTransform()
+    viz = transform(npx_record, metadata_df)
+    assert len(bucket) == 1
+    assert list(bucket)[0].startswith("_cache/clustergrammer/")
+
+    # an unchanged file is served from the cache, without downloading or clustering it
+    # the mock network isn't visible to worker processes
+    monkeypatch.setattr(functions.visualizations, "VIS_CLUSTERING_ISOLATED", False)
+    CGNetwork = MagicMock()
+    monkeypatch.setattr(functions.visualizations, "CGNetwork", CGNetwork)
+    get_blob_as_stream.reset_mock()
+    assert transform(npx_record, metadata_df) == viz
+    get_blob_as_stream.assert_not_called()
+    CGNetwork.assert_not_called()
+    cache = functions.visualizations._clustergrammer_cache
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # new data or new metadata aren't
+    npx_record.md5_hash = "new-md5"
+    transform(npx_record, metadata_df)
+    npx_record.md5_hash = "md5"
+    new_metadata_df = metadata_df.copy()
+    new_metadata_df["cohort_name"] = ["Arm_A", "Arm_B"]
+    transform(npx_record, new_metadata_df)
+    assert CGNetwork.call_count == 2
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    # nor are configs clustered with other downsampling limits
+    monkeypatch.setattr(functions.visualizations, "CLUSTERGRAMMER_MAX_ROWS", 10)
+    transform(npx_record, metadata_df)
+    assert CGNetwork.call_count == 3
+    assert (cache.hits, cache.misses) == (1, 4)
+
+    # files without checksums aren't cached
+    npx_record.md5_hash = npx_record.crc32c_hash = None
+    transform(npx_record, metadata_df)
+    assert CGNetwork.call_count == 4
+    assert (cache.hits, cache.misses) == (1, 4)
+
+
 @pytest.mark.parametrize(
     "upload_type",
     ("cell counts compartment", "cell counts assignment", "cell counts profiling"),
@@ -535,6 +1210,91 @@ def test_clustergrammerify_single_sample(metadata_df):
         cg._clustergrammerify(data_df, metadata_df)
 
 
+def test_clustergrammerify_over_budget(monkeypatch, metadata_df):
+    """Check that clustering is skipped if it exceeds its budget"""
+    run_with_budget = MagicMock()
+    run_with_budget.side_effect = functions.visualizations.BudgetExceeded(
+        "_cluster exceeded its 300s time budget"
+    )
+    monkeypatch.setattr(functions.visualizations, "run_with_budget", run_with_budget)
+    monkeypatch.setattr(functions.visualizations, "VIS_CLUSTERING_ISOLATED", True)
+
+    monkeypatch.setattr(
+        functions.visualizations,
+        "_clustergrammer_cache",
+        _ClustergrammerCache(enabled=False),
+    )
+    monkeypatch.setattr(functions.visualizations, "ENV", "prod")
+    upload_to_internal_bucket = MagicMock()
+    monkeypatch.setattr(
+        functions.visualizations, "upload_to_internal_bucket", upload_to_internal_bucket
+    )
+    monkeypatch.setattr(
+        functions.visualizations,
+        "get_blob_as_stream",
+        lambda *args, **kwargs: open(NPX_PATH, "rb"),
+    )
+
+    npx_record = MagicMock()
+    npx_record.object_url = "trial/olink/npx.xlsx"
+    npx_record.md5_hash = "md5"
+    npx_record.crc32c_hash = "crc32c"
+    assert _ClustergrammerTransform()(npx_record, metadata_df) is None
+    run_with_budget.assert_called_once()
+
+    # the skip is recorded where it can be found later
+    upload_to_internal_bucket.assert_called_once()
+    object_name, data = upload_to_internal_bucket.call_args[0]
+    assert object_name == "_skipped/clustergrammer/trial/olink/npx.xlsx.json"
+    record = json.loads(data)
+    assert record["object_url"] == "trial/olink/npx.xlsx"
+    assert record["md5_hash"] == "md5"
+    assert record["reason"] == "_cluster exceeded its 300s time budget"
+
+
+def test_downsample():
+    """Check that _downsample keeps the highest-variance rows and evenly spaced columns"""
+    data_df = pd.DataFrame(
+        [[0, 0, 0, 0, 0], [1, 5, 1, 5, 1], [2, 2, 3, 2, 2], [0, 9, 0, 9, 0]],
+        index=["flat", "high", "low", "highest"],
+        columns=["a", "b", "c", "d", "e"],
+    )
+
+    same_df, downsampling = _downsample(data_df, 4, 5)
+    assert same_df is data_df and downsampling is None
+    assert _downsample(data_df, None, None)[1] is None
+
+    reduced_df, downsampling = _downsample(data_df, 2, 3)
+    # row order is preserved
+    assert list(reduced_df.index) == ["high", "highest"]
+    assert list(reduced_df.columns) == ["a", "c", "e"]
+    assert reduced_df.loc["highest"].tolist() == [0, 0, 0]
+    assert downsampling == {
+        "rows": {"original": 4, "kept": 2, "selection": "variance"},
+        "columns": {"original": 5, "kept": 3, "selection": "even spacing"},
+    }
+
+
+def test_clustergrammerify_downsampling(monkeypatch, metadata_df):
+    """Check that the downsampling applied before clustering is recorded in the config"""
+    monkeypatch.setattr(functions.visualizations, "VIS_CLUSTERING_ISOLATED", False)
+    monkeypatch.setattr(functions.visualizations, "CLUSTERGRAMMER_MAX_ROWS", 2)
+    CGNetwork = MagicMock()
+    CGNetwork.return_value.viz = {"row_nodes": []}
+    monkeypatch.setattr(functions.visualizations, "CGNetwork", CGNetwork)
+
+    data_df = pd.DataFrame(
+        {"CTTTTPPS1.01": [1, 2, 3], "CTTTTPPS2.01": [3, 2, 1]},
+        index=["row1", "row2", "row3"],
+    )
+    viz = _ClustergrammerTransform()._clustergrammerify(data_df, metadata_df)
+    assert viz["downsampling"] == {
+        "rows": {"original": 3, "kept": 2, "selection": "variance"}
+    }
+    clustered_df = CGNetwork.return_value.load_df.call_args[0][0]
+    assert list(clustered_df.index) == ["row1", "row3"]
+
+
 def test_metadata_to_categories():
     # Converts names as expected
     md_names = pd.DataFrame(
@@ -591,3 +1351,426 @@ def test_metadata_to_categories():
 
     categories = _metadata_to_categories(md_names)
     assert cat_names == categories
+
+
+@pytest.fixture
+def mixed_metadata_df():
+    """Metadata with missing values and a mix of string, int, and float columns"""
+    metadata_df = pd.DataFrame(
+        {
+            "cimac_id": [f"CTTTPP{i}S1.01" for i in range(6)],
+            "cimac_participant_id": [f"CTTTPP{i // 2}" for i in range(6)],
+            "cohort_name": ["Arm_A", "Arm_B", None, "Arm_A", "Arm_B", "Arm_A"],
+            "collection_event_name": [
+                "Baseline",
+                "Baseline",
+                "On_Treatment",
+                "On_Treatment",
+                "Baseline",
+                "Baseline",
+            ],
+            "arbitrary_trial_specific_clinical_annotations.Treatment (1=Yes,0=No)": [
+                1,
+                0,
+                np.nan,
+                1,
+                0,
+                1,
+            ],
+            "arbitrary_trial_specific_clinical_annotations.Disease progression": [
+                1.5,
+                2.0,
+                2.0,
+                np.nan,
+                1.5,
+                2.0,
+            ],
+            "arbitrary_trial_specific_clinical_annotations.RECIST clinical benefit status": [
+                1,
+                2,
+                1,
+                2,
+                1,
+                2,
+            ],
+            "participants.cimac_participant_id": [f"CTTTPP{i // 2}" for i in range(6)],
+            "box_number": [1] * 6,
+        }
+    )
+    metadata_df.set_index("cimac_id", inplace=True)
+    return metadata_df
+
+
+def test_metadata_to_categories_golden(mixed_metadata_df):
+    """Check _metadata_to_categories against output recorded from the row-at-a-time implementation"""
+    assert _metadata_to_categories(mixed_metadata_df) == [
+        (
+            "CIMAC Id: CTTTPP0S1.01",
+            "Collection Event: Baseline",
+            "Treatment: True",
+            "Clin benefit: 1",
+            "Participant Id: CTTTPP0",
+            "Cohort: Arm_A",
+            "Disease prog: 1.5",
+        ),
+        (
+            "CIMAC Id: CTTTPP1S1.01",
+            "Collection Event: Baseline",
+            "Treatment: False",
+            "Clin benefit: 2",
+            "Participant Id: CTTTPP0",
+            "Cohort: Arm_B",
+            "Disease prog: 2.0",
+        ),
+        (
+            "CIMAC Id: CTTTPP2S1.01",
+            "Collection Event: On_Treatment",
+            "Treatment: True",
+            "Clin benefit: 1",
+            "Participant Id: CTTTPP1",
+            "Cohort: None",
+            "Disease prog: 2.0",
+        ),
+        (
+            "CIMAC Id: CTTTPP3S1.01",
+            "Collection Event: On_Treatment",
+            "Treatment: True",
+            "Clin benefit: 2",
+            "Participant Id: CTTTPP1",
+            "Cohort: Arm_A",
+            "Disease prog: nan",
+        ),
+        (
+            "CIMAC Id: CTTTPP4S1.01",
+            "Collection Event: Baseline",
+            "Treatment: False",
+            "Clin benefit: 1",
+            "Participant Id: CTTTPP2",
+            "Cohort: Arm_B",
+            "Disease prog: 1.5",
+        ),
+        (
+            "CIMAC Id: CTTTPP5S1.01",
+            "Collection Event: Baseline",
+            "Treatment: True",
+            "Clin benefit: 2",
+            "Participant Id: CTTTPP2",
+            "Cohort: Arm_A",
+            "Disease prog: 2.0",
+        ),
+    ]
+
+    # with only numeric columns, ints are formatted as floats, as iterrows does
+    numeric_df = pd.DataFrame(
+        {
+            "cohort_name": [1, 2, 1, 2],
+            "arbitrary_trial_specific_clinical_annotations.Disease progression": [
+                0.5,
+                1.0,
+                np.nan,
+                1.0,
+            ],
+        },
+        index=pd.Index([f"CTTTPP{i}S1.01" for i in range(4)], name="cimac_id"),
+    )
+    assert _metadata_to_categories(numeric_df) == [
+        ("CIMAC Id: CTTTPP0S1.01", "Cohort: 1.0", "Disease prog: 0.5"),
+        ("CIMAC Id: CTTTPP1S1.01", "Cohort: 2.0", "Disease prog: 1.0"),
+        ("CIMAC Id: CTTTPP2S1.01", "Cohort: 1.0", "Disease prog: nan"),
+        ("CIMAC Id: CTTTPP3S1.01", "Cohort: 2.0", "Disease prog: 1.0"),
+    ]
+
+
+def _legacy_metadata_to_categories(metadata_df: pd.DataFrame) -> list:
+    """The row-at-a-time implementation of `_metadata_to_categories`, for comparison"""
+    metadata_df = metadata_df.copy()  # so don't modify original
+
+    CLINICAL_FIELD_PREFIX = "arbitrary_trial_specific_clinical_annotations."
+    columns = []
+    for c in metadata_df.columns:
+        # go through and check cardinality = # unique
+        # also rename the columns to pretty things
+        cardinality = len(metadata_df[c].unique())
+        if (
+            cardinality > CLUSTERGRAMMER_MAX_CATEGORY_CARDINALITY
+            or cardinality <= 1
+            or cardinality == metadata_df.shape[0]
+        ):
+            # only want if not all the same, not too many, and not each unique to sample
+
+            if c not in [
+                "cimac_participant_id",
+                "cohort_name",
+                "collection_event_name",
+            ]:
+                # we want to keep the above no matter what
+                metadata_df.pop(c)
+                continue
+
+        if "(1=Yes,0=No)" in c:
+            # these are boolean! let's treat them that way
+            metadata_df[c] = metadata_df[c].astype(bool)
+
+        if c.startswith(CLINICAL_FIELD_PREFIX):
+            # for 10021 participants.csv:
+            ## remove the prefix
+            ## remove any parentheses
+
+            cat = c[len(CLINICAL_FIELD_PREFIX) :]
+            if "(" in cat and ")" in cat and cat.index(")") > cat.index("("):
+                cat = cat.split("(", 1)[0] + cat.rsplit(")", 1)[1]
+        else:
+            # otherwise
+            ## break up underscores
+            ## title case
+            ## drop 'CIDC' / 'CIMAC' anywhere
+            ## drop trailing 'Name'
+            cat = c.replace("_", " ").title().replace("Cidc", "").replace("Cimac", "")
+            if cat.endswith("Name") and not cat == "Name":
+                cat = cat[:-4]
+
+        # strip so it's pretty!
+        if cat.strip() not in columns:
+            columns.append(cat.strip())
+        else:
+            # if it's a repeated name, pop it
+            metadata_df.pop(c)
+
+    metadata_df.columns = columns
+
+    # cut down to only the categories we want
+    columns = [
+        c
+        for c in [
+            "Participant Id",
+            "Collection Event",
+            "Cohort",
+            "Treatment",
+            "Disease progression",
+            "RECIST clinical benefit status",
+        ]
+        if c in metadata_df.columns
+    ]
+    columns = sorted(columns, key=lambda c: len(metadata_df[c].unique()))
+    metadata_df = metadata_df[columns]
+
+    if "Disease progression" in columns:
+        columns[columns.index("Disease progression")] = "Disease prog"
+    if "RECIST clinical benefit status" in columns:
+        columns[columns.index("RECIST clinical benefit status")] = "Clin benefit"
+    metadata_df.columns = columns
+
+    # build the output str in ClusterGrammer compatible format
+    categories = []
+    for idx, row in metadata_df.iterrows():
+        temp = [f"CIMAC Id: {idx}"]
+
+        for cat, val in row.items():
+            temp.append(f"{cat}: {val}")
+
+        categories.append(tuple(temp))
+
+    return categories
+
+
+def _wide_metadata_df(num_samples: int, num_columns: int) -> pd.DataFrame:
+    """Synthetic participants/samples metadata with a wide clinical annotation table"""
+    rng = np.random.default_rng(0)
+    prefix = "arbitrary_trial_specific_clinical_annotations."
+    data = {
+        "cimac_id": [f"CTTTPP{i:05d}S1.01" for i in range(num_samples)],
+        "cimac_participant_id": [f"CTTTPP{i // 2:05d}" for i in range(num_samples)],
+        "cohort_name": rng.choice(["Arm_A", "Arm_B", "Arm_C"], num_samples),
+        "collection_event_name": rng.choice(["Baseline", "C1D1"], num_samples),
+        f"{prefix}Treatment (1=Yes,0=No)": rng.choice([0, 1, np.nan], num_samples),
+        f"{prefix}Disease progression": rng.choice([1.0, 2.5], num_samples),
+        f"{prefix}RECIST clinical benefit status": rng.choice([1, 2, 3], num_samples),
+    }
+    for j in range(num_columns - len(data) + 1):
+        name = f"{prefix}annotation_{j} (units)"
+        kind = j % 4
+        if kind == 0:
+            data[name] = rng.choice(["a", "b", "c", None], num_samples)
+        elif kind == 1:
+            data[name] = rng.integers(0, 3, num_samples)
+        elif kind == 2:
+            data[name] = rng.normal(size=num_samples)
+        else:
+            data[name] = ["constant"] * num_samples
+    return pd.DataFrame(data).set_index("cimac_id")
+
+
+def test_metadata_to_categories_matches_row_at_a_time():
+    """Check that _metadata_to_categories agrees with the row-at-a-time implementation"""
+    metadata_df = _wide_metadata_df(200, 30)
+    categories = _metadata_to_categories(metadata_df)
+    assert len(categories) == 200
+    assert categories == _legacy_metadata_to_categories(metadata_df)
+
+
+@pytest.mark.benchmark
+def test_metadata_to_categories_benchmark():
+    """Compare _metadata_to_categories against the row-at-a-time implementation"""
+    metadata_df = _wide_metadata_df(10_000, 200)
+
+    start = time.perf_counter()
+    _legacy_metadata_to_categories(metadata_df)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _metadata_to_categories(metadata_df)
+    new_time = time.perf_counter() - start
+
+    assert new_time < legacy_time / 2
+
+
+def _legacy_npx_to_dataframe(fname, sheet_name="NPX Data") -> pd.DataFrame:
+    """The full-workbook implementation of `_npx_to_dataframe`, for comparison"""
+
+    wb = load_workbook(fname)
+    if sheet_name not in wb.sheetnames:
+        raise ValueError(f"Couldn't locate expected worksheet '{sheet_name}'.")
+    ws = wb[sheet_name]
+
+    extract_values = lambda xlsx_row: [cell.value for cell in xlsx_row]
+
+    # Assay labels (row 5 of the spreadsheet)
+    assay_labels = extract_values(ws[4][1:-2])
+
+    # Raw data (row 8 of the spreadsheet onwards)
+    rows = []
+    num_cols = len(assay_labels) + 1
+    for row in ws.iter_rows(min_row=8):
+        sample_id = row[0].value
+        # If we hit a blank line, there's no more data to read.
+        if not sample_id:
+            break
+        # Only include rows pertaining to CIMAC ids
+        if prism.cimac_id_regex.match(sample_id):
+            new_row = extract_values(row[0:num_cols])
+            rows.append(new_row)
+    raw = pd.DataFrame(rows).set_index(0)
+    raw.index.name = "cimac_id"
+    raw.columns = assay_labels
+
+    # Drop columns that don't have raw data
+    raw.drop(columns=["Plate ID", "QC Warning"], inplace=True)
+
+    # Data is later z-scored, so remove data that would introduce NaN's
+    raw.drop(columns=raw.columns[raw.std() == 0], inplace=True)
+
+    return raw.T
+
+
+def _write_fake_npx(path, num_samples: int, num_assays: int):
+    """Write an NPX workbook laid out like `fake_npx.xlsx`, with `num_samples` CIMAC ID rows"""
+    rng = np.random.default_rng(0)
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "NPX Data"
+    assays = [f"Assay{i}" for i in range(num_assays)]
+    trailer = ["QC Deviation from median"] * 2 + ["Ext Ctrl"]
+    ws.append(["Fake Olink Data", "Olink NPX Manager"])
+    ws.append(["NPX data"])
+    ws.append(["Panel"] + ["Olink IMMUNO-ONCOLOGY"] * (num_assays + 5))
+    ws.append(["Assay"] + assays + ["Plate ID", "QC Warning"] + trailer)
+    ws.append(["Uniprot ID"] + [f"P{i:05d}" for i in range(num_assays)])
+    ws.append(["OlinkID"] + [f"OID{i:05d}" for i in range(num_assays)])
+    ws.append([])
+    for i in range(num_samples):
+        sample_id = f"CTTT{i // 100:03d}{i % 100:02d}.01" if i % 50 else "control"
+        npx = rng.normal(size=num_assays).round(3).tolist()
+        if i % 7 == 0:
+            npx[i % num_assays] = None
+        ws.append([sample_id] + npx + [f"plate_{i // 88}", "Pass", 0, 0, 0])
+    ws.append([])
+    ws.append(["LOD"] + [0] * num_assays)
+    wb.save(path)
+
+
+def test_npx_to_dataframe_matches_full_workbook(tmp_path):
+    """Check that read-only parsing gives the same dataframe as loading the full workbook"""
+    with open(NPX_PATH, "rb") as fake_npx:
+        expected_df = _legacy_npx_to_dataframe(fake_npx)
+    with open(NPX_PATH, "rb") as fake_npx:
+        pd.testing.assert_frame_equal(_npx_to_dataframe(fake_npx), expected_df)
+
+    npx_path = tmp_path / "npx.xlsx"
+    _write_fake_npx(npx_path, num_samples=200, num_assays=10)
+    pd.testing.assert_frame_equal(
+        _npx_to_dataframe(npx_path), _legacy_npx_to_dataframe(npx_path)
+    )
+
+    # some writers leave out the sheet dimensions that read-only mode relies on
+    unsized_path = tmp_path / "unsized_npx.xlsx"
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("NPX Data")
+    for row in load_workbook(npx_path)["NPX Data"].iter_rows(values_only=True):
+        ws.append(row)
+    wb.save(unsized_path)
+    assert load_workbook(unsized_path, read_only=True)["NPX Data"].max_row is None
+    pd.testing.assert_frame_equal(
+        _npx_to_dataframe(unsized_path), _legacy_npx_to_dataframe(npx_path)
+    )
+
+    # and others declare dimensions smaller than the sheet's contents
+    understated_path = tmp_path / "understated_npx.xlsx"
+    with zipfile.ZipFile(npx_path) as src, zipfile.ZipFile(
+        understated_path, "w"
+    ) as dst:
+        for item in src.infolist():
+            data = src.read(item.filename)
+            if item.filename == "xl/worksheets/sheet1.xml":
+                data = re.sub(
+                    rb'<dimension ref="[^"]*"', b'<dimension ref="A1:E20"', data
+                )
+            dst.writestr(item, data)
+    assert load_workbook(understated_path, read_only=True)["NPX Data"].max_row == 20
+    pd.testing.assert_frame_equal(
+        _npx_to_dataframe(understated_path), _legacy_npx_to_dataframe(npx_path)
+    )
+
+    with pytest.raises(ValueError, match="Couldn't locate expected worksheet"):
+        _npx_to_dataframe(npx_path, sheet_name="foo")
+
+
+def test_npx_to_dataframe_read_only(monkeypatch, tmp_path):
+    """Check that NPX workbooks are opened read-only and closed once parsed"""
+    npx_path = tmp_path / "npx.xlsx"
+    _write_fake_npx(npx_path, num_samples=20, num_assays=5)
+
+    workbooks = []
+
+    def spy_load_workbook(*args, **kwargs):
+        wb = load_workbook(*args, **kwargs)
+        wb.close = MagicMock(side_effect=wb.close)
+        workbooks.append(wb)
+        return wb
+
+    monkeypatch.setattr(functions.visualizations, "load_workbook", spy_load_workbook)
+    _npx_to_dataframe(npx_path)
+    assert len(workbooks) == 1
+    assert workbooks[0].read_only
+    workbooks[0].close.assert_called_once()
+
+
+@pytest.mark.benchmark
+def test_npx_to_dataframe_benchmark(tmp_path):
+    """Compare time and peak memory parsing a large NPX workbook, read-only vs. in full"""
+    npx_path = tmp_path / "npx.xlsx"
+    _write_fake_npx(npx_path, num_samples=5000, num_assays=48)
+
+    def measure(parse):
+        start = time.perf_counter()
+        tracemalloc.start()
+        try:
+            parse(npx_path)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return time.perf_counter() - start, peak
+
+    legacy_time, legacy_peak = measure(_legacy_npx_to_dataframe)
+    new_time, new_peak = measure(_npx_to_dataframe)
+    assert new_peak < legacy_peak / 2
+    assert new_time < legacy_time
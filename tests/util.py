@@ -1,7 +1,12 @@
 import base64
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import wraps
 
 from flask import Flask
+from google.api_core.exceptions import ServiceUnavailable
 
 
 def make_pubsub_event(data: str) -> dict:
@@ -20,3 +25,47 @@ def with_app_context(f):
             return f(*args, **kwargs)
 
     return wrapped
+
+
+class FakeTopic:
+    """
+    In-process stand-in for a pub/sub topic, usable in place of `_encode_and_publish`.
+    Records published messages and confirms each one after `latency` seconds,
+    failing any message for which `fail(message)` is truthy, and failing a random
+    `fail_rate` fraction of publishes with a transient error.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0,
+        fail=lambda message: False,
+        fail_rate: float = 0,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.fail = fail
+        self.fail_rate = fail_rate
+        self._random = random.Random(seed)
+        self.messages = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(64)
+
+    def __call__(self, message: str, topic: str) -> Future:
+        with self._lock:
+            self.messages.append((message, topic))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return self._executor.submit(self._confirm, message)
+
+    def _confirm(self, message: str):
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+            unavailable = self._random.random() < self.fail_rate
+        if self.fail(message):
+            raise Exception("failed to publish message")
+        if unavailable:
+            raise ServiceUnavailable("pub/sub is unavailable")
+        return "message-id"